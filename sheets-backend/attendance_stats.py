@@ -0,0 +1,169 @@
+"""Attendance statistics for the storage engines"""
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_THRESHOLDS = {
+    "excellent": 95.000,
+    "good": 90.000,
+    "moderate": 85.000,
+    "atRisk": 85.000
+}
+
+
+def attendance_percentages(counts: List[Tuple[int, int, int, int]]) -> List[Optional[float]]:
+    """(present + late) / total * 100 per row - None for rows without any marks"""
+    return [((p + l) / t * 100.0) if t > 0 else None for p, l, _, t in counts]
+
+
+def summarize_class(counts: List[Tuple[int, int, int, int]], thresholds: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """avg_attendance / excellent / at-risk buckets from per-student counts"""
+    if thresholds is None:
+        thresholds = DEFAULT_THRESHOLDS
+    excellent_at = thresholds.get("excellent", 95.000)
+    moderate_at = thresholds.get("moderate", 85.000)
+
+    percentages = attendance_percentages(counts)
+    marked = [p for p in percentages if p is not None]
+    excellent = 0
+    at_risk = 0
+    for percentage in marked:
+        if percentage >= excellent_at:
+            excellent += 1
+        elif percentage < moderate_at:
+            at_risk += 1
+
+    # Students with no marks yet count as 0% in the average but land in no bucket
+    avg_attendance = (sum(marked) / len(counts)) if counts else 0.0
+    return {
+        "total_students": len(counts),
+        "avg_attendance": round(avg_attendance, 3),
+        "at_risk_count": at_risk,
+        "excellent_count": excellent
+    }
+
+
+def summarize_student(present: int, late: int, absent: int, total: int,
+                      thresholds: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Percentage and status bucket for a single student's counts"""
+    if not thresholds:
+        thresholds = DEFAULT_THRESHOLDS
+    if not total:
+        return {
+            "total_classes": 0,
+            "present": 0,
+            "absent": 0,
+            "late": 0,
+            "percentage": 0.0,
+            "status": "no data"
+        }
+
+    percentage = (present + late) / total * 100
+    if percentage >= thresholds.get("excellent", 95.0):
+        status = "excellent"
+    elif percentage >= thresholds.get("good", 90.0):
+        status = "good"
+    elif percentage >= thresholds.get("moderate", 85.0):
+        status = "moderate"
+    else:
+        status = "at risk"
+
+    return {
+        "total_classes": total,
+        "present": present,
+        "absent": absent,
+        "late": late,
+        "percentage": round(percentage, 3),
+        "status": status
+    }
+
+
+def count_attendance(attendance: Dict[str, Any]) -> Tuple[int, int, int, int]:
+    """(present, late, absent, total) of one attendance dict in a single pass"""
+    present = late = absent = 0
+    for status in attendance.values():
+        if status == "P":
+            present += 1
+        elif status == "L":
+            late += 1
+        elif status == "A":
+            absent += 1
+    return present, late, absent, len(attendance)
+
+
+# ---- Running counters -------------------------------------------------------
+# Every student record carries {"present", "late", "absent", "total"} and the
+# class carries the same totals over all of its records, so stats are O(students)
+
+COUNTER_FIELDS = {"P": "present", "L": "late", "A": "absent"}
+
+
+def new_counts(attendance: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+    """Fresh counters for an attendance dict"""
+    present, late, absent, total = count_attendance(attendance or {})
+    return {"present": present, "late": late, "absent": absent, "total": total}
+
+
+def shift_counts(counts: Dict[str, int], old_status: Optional[str], new_status: Optional[str]):
+    """Move one cell's contribution from old_status to new_status (None = no mark)"""
+    if old_status is not None:
+        field = COUNTER_FIELDS.get(old_status)
+        if field:
+            counts[field] -= 1
+        counts["total"] -= 1
+    if new_status is not None:
+        field = COUNTER_FIELDS.get(new_status)
+        if field:
+            counts[field] += 1
+        counts["total"] += 1
+
+
+def record_counts(record: Dict[str, Any]) -> Dict[str, int]:
+    """A record's counters, recounted when missing or out of step with its attendance"""
+    counts = record.get("counts")
+    attendance = record.get("attendance") or {}
+    if (not isinstance(counts, dict)
+            or any(not isinstance(counts.get(k), int) for k in ("present", "late", "absent", "total"))
+            or counts["total"] != len(attendance)):
+        counts = new_counts(attendance)
+        record["counts"] = counts
+    return counts
+
+
+def class_counts(class_data: Dict[str, Any]) -> Dict[str, int]:
+    """Class-level counters, summed from the records when missing"""
+    counts = class_data.get("attendance_counts")
+    if not isinstance(counts, dict) or "total" not in counts:
+        counts = sum_counts(class_data.get("students", []))
+        class_data["attendance_counts"] = counts
+    return counts
+
+
+def sum_counts(records: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Sum the counters of a list of records"""
+    totals = {"present": 0, "late": 0, "absent": 0, "total": 0}
+    for record in records:
+        counts = record_counts(record)
+        for field in totals:
+            totals[field] += counts[field]
+    return totals
+
+
+def apply_mark(record: Dict[str, Any], date: str, status: Optional[str],
+               totals: Optional[Dict[str, int]] = None) -> bool:
+    """Set (or clear, with status None) one attendance cell and update the counters"""
+    counts = record_counts(record)
+    attendance = record.setdefault("attendance", {})
+    old_status = attendance.get(date)
+    if old_status == status:
+        return False
+    if status is None:
+        attendance.pop(date, None)
+    else:
+        attendance[date] = status
+    shift_counts(counts, old_status, status)
+    if totals is not None:
+        shift_counts(totals, old_status, status)
+    return True
+
+
+def counts_tuple(counts: Dict[str, int]) -> Tuple[int, int, int, int]:
+    return counts["present"], counts["late"], counts["absent"], counts["total"]
@@ -0,0 +1,185 @@
+"""In-memory stand-in for the Supabase client, shared by the backend tests"""
+import copy
+import sys
+import threading
+import types
+
+import pytest
+
+# PostgREST's default max-rows: a select returns at most this many rows
+POSTGREST_MAX_ROWS = 1000
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class FakeQuery:
+    """The subset of the postgrest query builder the backend uses"""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.op = "select"
+        self.columns = "*"
+        self.filters = []
+        self.payload = None
+        self.on_conflict = ""
+        self.ignore_duplicates = False
+        self.order_by = []
+        self.row_limit = None
+        self.row_range = None
+        self.single = False
+
+    def select(self, columns="*", count=None):
+        self.op = "select"
+        self.columns = columns
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def upsert(self, payload, on_conflict="", ignore_duplicates=False):
+        self.op, self.payload = "upsert", payload
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row.get(column) > value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: str(row.get(column)) >= str(value))
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: str(row.get(column)) <= str(value))
+        return self
+
+    def in_(self, column, values):
+        values = list(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def range(self, start, end):
+        self.row_range = (start, end)
+        return self
+
+    def maybe_single(self):
+        self.single = True
+        return self
+
+    def execute(self):
+        return self.client._execute(self)
+
+
+class FakeSupabase:
+    """Tables are lists of row dicts; calls records (table, op) per executed query"""
+
+    def __init__(self):
+        self.tables = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rows(self, table):
+        return self.tables.setdefault(table, [])
+
+    def _execute(self, query):
+        with self._lock:
+            self.calls.append((query.table, query.op))
+            rows = self.rows(query.table)
+            matched = [r for r in rows if all(f(r) for f in query.filters)]
+
+            if query.op == "select":
+                for column, desc in reversed(query.order_by):
+                    matched.sort(key=lambda r: r[column], reverse=desc)
+                if query.row_range:
+                    start, end = query.row_range
+                    matched = matched[start:end + 1]
+                matched = matched[:POSTGREST_MAX_ROWS]
+                if query.row_limit is not None:
+                    matched = matched[:query.row_limit]
+                if query.columns != "*":
+                    columns = [c.strip() for c in query.columns.split(",")]
+                    matched = [{c: r.get(c) for c in columns} for r in matched]
+                matched = copy.deepcopy(matched)
+                if query.single:
+                    if len(matched) > 1:
+                        raise RuntimeError("maybe_single() matched several rows")
+                    return FakeResponse(matched[0]) if matched else None
+                return FakeResponse(matched, len(matched))
+
+            if query.op == "update":
+                for row in matched:
+                    row.update(copy.deepcopy(query.payload))
+                return FakeResponse(copy.deepcopy(matched))
+
+            if query.op == "delete":
+                self.tables[query.table] = [r for r in rows if r not in matched]
+                return FakeResponse(matched)
+
+            payload = query.payload if isinstance(query.payload, list) else [query.payload]
+            if query.op == "insert":
+                rows.extend(copy.deepcopy(payload))
+                return FakeResponse(copy.deepcopy(payload))
+
+            keys = query.on_conflict.split(",")
+            written = []
+            for new in payload:
+                existing = [r for r in rows if all(r.get(k) == new.get(k) for k in keys)]
+                if existing and query.ignore_duplicates:
+                    continue
+                if existing:
+                    existing[0].update(copy.deepcopy(new))
+                else:
+                    rows.append(copy.deepcopy(new))
+                written.append(new)
+            return FakeResponse(copy.deepcopy(written))
+
+    def count(self, table, op):
+        return sum(1 for call in self.calls if call == (table, op))
+
+
+# main.py and qr_sessions.py import `supabase` from supabase_client, which
+# needs real credentials - give them a placeholder to import instead
+if "supabase_client" not in sys.modules:
+    _stub = types.ModuleType("supabase_client")
+    _stub.supabase = FakeSupabase()
+    sys.modules["supabase_client"] = _stub
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    """A fresh FakeSupabase wired into every module that holds the client"""
+    client = FakeSupabase()
+    for name in ("supabase_client", "qr_sessions", "main"):
+        module = sys.modules.get(name)
+        if module is not None and hasattr(module, "supabase"):
+            monkeypatch.setattr(module, "supabase", client)
+    return client
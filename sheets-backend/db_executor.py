@@ -0,0 +1,117 @@
+"""Runs the synchronous Supabase client off the event loop"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# Max Supabase round trips in flight at once - further calls wait their turn
+SUPABASE_MAX_WORKERS = int(os.getenv("SUPABASE_MAX_WORKERS", "16"))
+# Calls queued longer than this are logged as a sign the pool is saturated
+SUPABASE_SLOW_WAIT_SECONDS = float(os.getenv("SUPABASE_SLOW_WAIT_SECONDS", "0.5"))
+
+
+class DBExecutor:
+    """Bounded thread pool plus a semaphore so blocking calls never stall the loop"""
+
+    def __init__(self, max_workers: int = SUPABASE_MAX_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="supabase")
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = 0
+        self._peak_in_flight = 0
+        self._peak_queued = 0
+        self._total_calls = 0
+        self._total_errors = 0
+        self._total_wait = 0.0
+        self._total_run = 0.0
+        self._max_wait = 0.0
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._semaphore
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) on the pool, waiting for a free slot first"""
+        semaphore = self._get_semaphore()
+        queued_at = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            self._peak_queued = max(self._peak_queued, self._queued)
+
+        try:
+            await semaphore.acquire()
+        finally:
+            with self._lock:
+                self._queued -= 1
+
+        started_at = time.perf_counter()
+        wait = started_at - queued_at
+        with self._lock:
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+            self._total_calls += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        if wait > SUPABASE_SLOW_WAIT_SECONDS:
+            print(f"[DB_POOL] Call waited {wait:.3f}s for a free worker ({self.max_workers} max)")
+
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, lambda: fn(*args, **kwargs))
+        except Exception:
+            with self._lock:
+                self._total_errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._total_run += time.perf_counter() - started_at
+            semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool occupancy and timing counters"""
+        with self._lock:
+            calls = self._total_calls
+            return {
+                "max_workers": self.max_workers,
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "peak_in_flight": self._peak_in_flight,
+                "peak_queued": self._peak_queued,
+                "saturated": self._in_flight >= self.max_workers,
+                "total_calls": calls,
+                "total_errors": self._total_errors,
+                "avg_wait_ms": round(self._total_wait / calls * 1000, 3) if calls else 0.0,
+                "max_wait_ms": round(self._max_wait * 1000, 3),
+                "avg_run_ms": round(self._total_run / calls * 1000, 3) if calls else 0.0,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+db_executor = DBExecutor()
+
+
+async def run_db(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run any blocking callable on the shared Supabase pool"""
+    return await db_executor.run(fn, *args, **kwargs)
+
+
+async def db_call(query) -> Any:
+    """Execute a Supabase query builder on the pool and return its response"""
+    return await db_executor.run(query.execute)
+
+
+async def fetch_one(query) -> Optional[Dict[str, Any]]:
+    """Execute query.maybe_single() on the pool and return the row (None when missing)"""
+    res = await db_executor.run(query.maybe_single().execute)
+    # Newer postgrest clients return None instead of an empty response when no row matches
+    if res is None:
+        return None
+    return res.data or None
@@ -1,18 +1,94 @@
+import hashlib
 import json
 import os
-from typing import Optional, Dict, Any, List
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 from datetime import datetime
 import shutil
 
-class DatabaseManager:
+try:
+    import fcntl
+except ImportError:  # non-POSIX: locks only serialize threads of this process
+    fcntl = None
+
+from storage_codecs import get_codec, decode_any
+from attendance_stats import apply_mark, class_counts, new_counts, record_counts, shift_counts, sum_counts
+from storage_engine import BACKUP_KEEP, BACKUP_WORKERS, StorageEngine
+
+# Email lookup indexes (email -> id), stored under data/indexes
+USER_EMAIL_INDEX = "users_by_email"
+STUDENT_EMAIL_INDEX = "students_by_email"
+# class_id -> teacher_id routing table (snapshot plus an append-only change log,
+# folded into the snapshot past CLASS_ROUTES_LOG_BYTES), and its in-memory LRU layer
+CLASS_ROUTES_INDEX = "class_routes"
+CLASS_ROUTES_LOG_BYTES = 256 * 1024
+CLASS_ROUTE_CACHE_SIZE = 4096
+# Attendance journals are folded back into the class snapshot past this size
+JOURNAL_COMPACT_BYTES = 256 * 1024
+# Upper bound for the parsed-file read cache
+READ_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Persisted get_database_stats counters
+DATABASE_STATS_INDEX = "database_stats"
+# Contact messages: append-only JSON-lines segments rotated at this size,
+# plus an append-only email -> (segment, offset) log under data/indexes
+CONTACT_SEGMENT_BYTES = 4 * 1024 * 1024
+CONTACT_EMAIL_INDEX = "contact_by_email"
+
+
+class DatabaseManager(StorageEngine):
     """Manages file-based database operations with student support"""
     
-    def __init__(self, base_dir: str = "data"):
-        self.base_dir = base_dir
+    def __init__(
+        self,
+        base_dir: str = "data",
+        codec: str = "json",
+        read_cache: bool = True,
+        read_cache_max_bytes: int = READ_CACHE_MAX_BYTES,
+        sharded_layout: bool = True,
+    ):
+        super().__init__(base_dir)
+        # New users/students go to users/ab/cd/<id>; flat users/<id> trees keep working
+        self.sharded_layout = sharded_layout
+        # Format used for writes; reads detect the format of each file
+        self.codec = get_codec(codec)
         self.users_dir = os.path.join(base_dir, "users")
         self.students_dir = os.path.join(base_dir, "students")
         self.contact_dir = os.path.join(base_dir, "contact")
         self.enrollments_dir = os.path.join(base_dir, "enrollments")
+        self.indexes_dir = os.path.join(base_dir, "indexes")
+        self.journals_dir = os.path.join(base_dir, "journals")
+        self.locks_dir = os.path.join(base_dir, "locks")
+        # In-memory mirror of the on-disk email indexes
+        self._email_indexes: Dict[str, Dict[str, str]] = {}
+        self._email_index_signatures: Dict[str, tuple] = {}
+        self._index_lock = threading.RLock()
+        self._class_route_cache: "OrderedDict[str, str]" = OrderedDict()
+        # In-memory mirror of the routing table: snapshot signature, how far into
+        # the change log (inode, bytes) it has been read, and class ids already
+        # probed for on disk without success since the table last changed
+        self._class_routes: Dict[str, str] = {}
+        self._class_routes_signature: Optional[tuple] = None
+        self._class_routes_log_position = (None, 0)
+        self._class_route_misses: "OrderedDict[str, None]" = OrderedDict()
+        # Advisory file locks: per-thread holdings (for re-entry)
+        self._held_locks = threading.local()
+        self._thread_locks: Dict[str, threading.Lock] = {}
+        # Read cache: path -> ((inode, mtime_ns, size), pickled data), in LRU order
+        self.read_cache_enabled = read_cache
+        self._read_cache_max_bytes = read_cache_max_bytes
+        self._read_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._read_cache_bytes = 0
+        self._read_cache_lock = threading.Lock()
+        self._read_cache_counters = {"hits": 0, "misses": 0, "evictions": 0}
+        # In-memory mirror of the contact email log: email -> [(segment, offset)],
+        # plus how far into the log (inode, bytes) it has been read
+        self._contact_index: Dict[str, List[Tuple[int, int]]] = {}
+        self._contact_index_position = (None, 0)
         self._ensure_directories()
     
     def _ensure_directories(self):
@@ -21,14 +97,67 @@ class DatabaseManager:
         os.makedirs(self.students_dir, exist_ok=True)
         os.makedirs(self.contact_dir, exist_ok=True)
         os.makedirs(self.enrollments_dir, exist_ok=True)
+        os.makedirs(self.indexes_dir, exist_ok=True)
+        os.makedirs(self.journals_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+    
+    @staticmethod
+    def _shard_parts(entity_id: str) -> Tuple[str, str]:
+        digest = hashlib.sha1(entity_id.encode("utf-8")).hexdigest()
+        return digest[:2], digest[2:4]
+    
+    def _entity_dir(self, root: str, entity_id: str, marker: str) -> str:
+        """Sharded directory of an entity, unless it still lives in the flat layout"""
+        flat = os.path.join(root, entity_id)
+        if not self.sharded_layout:
+            return flat
+        sharded = os.path.join(root, *self._shard_parts(entity_id), entity_id)
+        if not os.path.isdir(sharded) and os.path.exists(os.path.join(flat, marker)):
+            return flat
+        return sharded
+    
+    def _iter_entity_ids(self, root: str, marker: str) -> Iterator[str]:
+        """Entity ids under root in both layouts (flat <id>/ and sharded ab/cd/<id>/)"""
+        if not os.path.exists(root):
+            return
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                continue
+            if len(name) != 2 or os.path.exists(os.path.join(path, marker)):
+                yield name
+                continue
+            for shard in os.listdir(path):
+                shard_path = os.path.join(path, shard)
+                if os.path.isdir(shard_path):
+                    for entity_id in os.listdir(shard_path):
+                        if self._shard_parts(entity_id) == (name, shard):
+                            yield entity_id
+    
+    def _iter_user_ids(self) -> Iterator[str]:
+        return self._iter_entity_ids(self.users_dir, "user.json")
+    
+    def _iter_student_ids(self) -> Iterator[str]:
+        return self._iter_entity_ids(self.students_dir, "student.json")
+    
+    def _sharded_equivalent(self, file_path: str) -> Optional[str]:
+        """Where a flat-layout user/student path lives once migrated (None if not applicable)"""
+        if not self.sharded_layout:
+            return None
+        for root in (self.users_dir, self.students_dir):
+            if file_path.startswith(root + os.sep):
+                parts = os.path.relpath(file_path, root).split(os.sep)
+                if len(parts) >= 2 and not (len(parts) >= 3 and self._shard_parts(parts[2]) == (parts[0], parts[1])):
+                    return os.path.join(root, *self._shard_parts(parts[0]), *parts)
+        return None
     
     def get_user_dir(self, user_id: str) -> str:
         """Get user directory path"""
-        return os.path.join(self.users_dir, user_id)
+        return self._entity_dir(self.users_dir, user_id, "user.json")
     
     def get_student_dir(self, student_id: str) -> str:
         """Get student directory path"""
-        return os.path.join(self.students_dir, student_id)
+        return self._entity_dir(self.students_dir, student_id, "student.json")
     
     def get_user_classes_dir(self, user_id: str) -> str:
         """Get user classes directory path"""
@@ -50,26 +179,224 @@ class DatabaseManager:
         """Get enrollment file for a class"""
         return os.path.join(self.enrollments_dir, f"class_{class_id}_enrollments.json")
     
+    def get_attendance_journal_file(self, class_id: str) -> str:
+        """Get the append-only attendance journal for a class"""
+        return os.path.join(self.journals_dir, f"class_{class_id}.jsonl")
+    
+    def get_index_file(self, index_name: str) -> str:
+        """Get index json file path"""
+        return os.path.join(self.indexes_dir, f"{index_name}.json")
+    
+    def get_contact_segment_file(self, segment: int) -> str:
+        """Get the JSON-lines file of one contact message segment"""
+        return os.path.join(self.contact_dir, f"messages-{segment:06d}.jsonl")
+    
+    def get_contact_index_log(self) -> str:
+        """Get the append-only contact email index log"""
+        return os.path.join(self.indexes_dir, f"{CONTACT_EMAIL_INDEX}.jsonl")
+    
+    # ==================== FILE LOCKS ====================
+
+    def _lock_rank(self, file_path: str) -> int:
+        """
+        Global lock order: class -> enrollment -> QR session -> student -> user -> index -> other.
+        Nested locks must only ever be taken in increasing rank.
+        """
+        if file_path.startswith(self.users_dir) and f"{os.sep}classes{os.sep}" in file_path:
+            return 0
+        if file_path.startswith(self.enrollments_dir):
+            return 1
+        if file_path.startswith(self.get_qr_sessions_dir()):
+            return 2
+        if file_path.startswith(self.students_dir):
+            return 3
+        if file_path.startswith(self.users_dir):
+            return 4
+        if file_path.startswith(self.indexes_dir):
+            return 5
+        return 6
+
+    def _get_lock_file(self, file_path: str) -> str:
+        """Lock file for a data file - the same in the flat and sharded layouts"""
+        parts = os.path.relpath(file_path, self.base_dir).split(os.sep)
+        if (len(parts) >= 4 and parts[0] in ("users", "students")
+                and self._shard_parts(parts[3]) == (parts[1], parts[2])):
+            del parts[1:3]
+        return os.path.join(self.locks_dir, "__".join(parts) + ".lock")
+
+    def _acquire_file_lock(self, lock_file: str):
+        """Take an exclusive lock, recording how long we waited when contended"""
+        if fcntl is not None:
+            handle = os.open(lock_file, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                waited = None
+            except BlockingIOError:
+                started = time.monotonic()
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                waited = (time.monotonic() - started) * 1000
+        else:
+            with self._lock_stats_lock:
+                handle = self._thread_locks.setdefault(lock_file, threading.Lock())
+            waited = None
+            if not handle.acquire(blocking=False):
+                started = time.monotonic()
+                handle.acquire()
+                waited = (time.monotonic() - started) * 1000
+
+        with self._lock_stats_lock:
+            self._lock_counters["acquired"] += 1
+            if waited is not None:
+                self._lock_counters["contended"] += 1
+                self._lock_counters["total_wait_ms"] += waited
+                self._lock_counters["max_wait_ms"] = max(self._lock_counters["max_wait_ms"], waited)
+        return handle
+
+    def _release_file_lock(self, handle):
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            os.close(handle)
+        else:
+            handle.release()
+
+    @contextmanager
+    def _locked(self, *file_paths: Optional[str]):
+        """
+        Hold cross-process locks on data files for a read-modify-write.
+        Locks are taken in rank order and are re-entrant within a thread.
+        """
+        held = getattr(self._held_locks, "lock_files", None)
+        if held is None:
+            held = self._held_locks.lock_files = set()
+
+        # Keyed by lock file, so a flat and a sharded path to one file share a lock
+        wanted = {}
+        for file_path in file_paths:
+            if file_path:
+                lock_file = self._get_lock_file(file_path)
+                if lock_file not in held:
+                    wanted.setdefault(lock_file, file_path)
+        acquired = []
+        try:
+            for lock_file, file_path in sorted(wanted.items(), key=lambda item: (self._lock_rank(item[1]), item[0])):
+                acquired.append((lock_file, self._acquire_file_lock(lock_file)))
+                held.add(lock_file)
+            yield
+        finally:
+            for lock_file, handle in reversed(acquired):
+                held.discard(lock_file)
+                self._release_file_lock(handle)
+
+    def _class_lock_paths(self, class_id: str, *extra: str) -> List[str]:
+        """Files guarded together by class-level mutations (class file, enrollments, extras)"""
+        teacher_id = self.resolve_class_teacher(class_id)
+        paths = [self.get_enrollment_file(class_id), *extra]
+        if teacher_id:
+            paths.append(self.get_class_file(teacher_id, class_id))
+        return paths
+
+    # ==================== READ CACHE ====================
+
+    def _cache_get(self, file_path: str, signature: tuple) -> Optional[bytes]:
+        with self._read_cache_lock:
+            entry = self._read_cache.get(file_path)
+            if entry is None or entry[0] != signature:
+                self._read_cache_counters["misses"] += 1
+                return None
+            self._read_cache.move_to_end(file_path)
+            self._read_cache_counters["hits"] += 1
+            return entry[1]
+
+    def _cache_put(self, file_path: str, signature: tuple, data: Any):
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._read_cache_lock:
+            self._cache_discard_locked(file_path)
+            if len(blob) > self._read_cache_max_bytes // 4:
+                return  # never let one file flush the whole cache
+            self._read_cache[file_path] = (signature, blob)
+            self._read_cache_bytes += len(blob)
+            while self._read_cache_bytes > self._read_cache_max_bytes:
+                _, (_, evicted) = self._read_cache.popitem(last=False)
+                self._read_cache_bytes -= len(evicted)
+                self._read_cache_counters["evictions"] += 1
+
+    def _cache_discard_locked(self, file_path: str):
+        entry = self._read_cache.pop(file_path, None)
+        if entry is not None:
+            self._read_cache_bytes -= len(entry[1])
+
+    def clear_read_cache(self):
+        """Drop every cached file"""
+        with self._read_cache_lock:
+            self._read_cache.clear()
+            self._read_cache_bytes = 0
+
+    def get_read_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and current size of the read cache"""
+        with self._read_cache_lock:
+            lookups = self._read_cache_counters["hits"] + self._read_cache_counters["misses"]
+            return {
+                **self._read_cache_counters,
+                "enabled": self.read_cache_enabled,
+                "entries": len(self._read_cache),
+                "bytes": self._read_cache_bytes,
+                "max_bytes": self._read_cache_max_bytes,
+                "hit_rate": round(self._read_cache_counters["hits"] / lookups, 3) if lookups else 0.0,
+            }
+
     def read_json(self, file_path: str) -> Optional[Dict[Any, Any]]:
-        """Read JSON file safely"""
+        """Read a data file (any codec) safely, served from the read cache while the file is unchanged"""
         try:
-            if not os.path.exists(file_path):
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
+                if self.read_cache_enabled:
+                    with self._read_cache_lock:
+                        self._cache_discard_locked(file_path)
+                # The entity may have been moved to the sharded layout after the path was built
+                moved_path = self._sharded_equivalent(file_path)
+                if moved_path and os.path.exists(moved_path):
+                    return self.read_json(moved_path)
                 return None
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            
+            # Atomic writes replace the inode, so this catches same-tick rewrites too
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if self.read_cache_enabled:
+                blob = self._cache_get(file_path, signature)
+                if blob is not None:
+                    # Hand out a private copy - callers mutate what they read
+                    return pickle.loads(blob)
+            
+            with open(file_path, 'rb') as f:
+                data = decode_any(f.read())
+            if self.read_cache_enabled:
+                self._cache_put(file_path, signature, data)
+            return data
         except Exception as e:
             print(f"Error reading {file_path}: {e}")
             return None
     
     def write_json(self, file_path: str, data: Dict[Any, Any]):
-        """Write JSON file safely"""
+        """Write a data file with the configured codec (temp file + atomic rename, so readers never see a partial file)"""
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
         try:
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            with open(tmp_path, 'wb') as f:
+                f.write(self.codec.encode(data))
+                f.flush()
+                os.fsync(f.fileno())
+                # rename keeps inode and mtime, so this is the final file's signature
+                st = os.fstat(f.fileno())
+            os.replace(tmp_path, file_path)
         except Exception as e:
             print(f"Error writing {file_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             raise
+        
+        if self.read_cache_enabled:
+            # Write-through so the next read of a hot file skips the parse
+            self._cache_put(file_path, (st.st_ino, st.st_mtime_ns, st.st_size), data)
 
     def scan_qr_code(self, student_id: str, class_id: str, qr_code: str) -> Dict[str, Any]:
         """
@@ -78,80 +405,75 @@ class DatabaseManager:
         - Validates there is an active session for the class
         - Validates the current code matches qr_code
         - Marks the student's attendance as Present (P) for that date
-        - Records the student_record_id in scanned_students so stop_qr_session knows who scanned
+        - Journals the student_record_id in the session's scan log so stop_qr_session knows who scanned
         """
-        # 1) Load session
-        session_file = self.get_qr_session_file(class_id)
-        session_data = self.read_json(session_file)
+        with self._locked(*self._class_lock_paths(class_id, self.get_qr_session_file(class_id))):
+            # 1) Load session
+            session_file = self.get_qr_session_file(class_id)
+            session_data = self.read_json(session_file)
 
-        if not session_data or session_data.get("status") != "active":
-            raise ValueError("No active session")
+            if not session_data or session_data.get("status") != "active":
+                raise ValueError("No active session")
 
-        current_code = session_data.get("current_code")
-        if current_code != qr_code:
-            raise ValueError("Invalid or expired QR code")
+            current_code = session_data.get("current_code")
+            if current_code != qr_code:
+                raise ValueError("Invalid or expired QR code")
 
-        attendance_date = session_data["attendance_date"]
+            attendance_date = session_data["attendance_date"]
 
-        # 2) Find enrollment for this student
-        enrollment_file = self.get_enrollment_file(class_id)
-        all_enrollments: List[Dict[str, Any]] = self.read_json(enrollment_file) or []
+            # 2) Find enrollment for this student
+            enrollment_file = self.get_enrollment_file(class_id)
+            all_enrollments: List[Dict[str, Any]] = self.read_json(enrollment_file) or []
 
-        enrollment: Optional[Dict[str, Any]] = None
-        for e in all_enrollments:
-            if e.get("student_id") == student_id and e.get("status") == "active":
-                enrollment = e
-                break
+            enrollment: Optional[Dict[str, Any]] = None
+            for e in all_enrollments:
+                if e.get("student_id") == student_id and e.get("status") == "active":
+                    enrollment = e
+                    break
 
-        if not enrollment:
-            raise ValueError("Student not actively enrolled in this class")
+            if not enrollment:
+                raise ValueError("Student not actively enrolled in this class")
 
-        student_record_id = enrollment.get("student_record_id")
+            student_record_id = enrollment.get("student_record_id")
 
-        # 3) Load class and mark attendance = 'P'
-        class_data = self.get_class_by_id(class_id)
-        if not class_data:
-            raise ValueError("Class not found")
-
-        students = class_data.get("students", [])
-        found = False
-        for s in students:
-            if s.get("id") == student_record_id:
-                s.setdefault("attendance", {})
-                s["attendance"][attendance_date] = "P"
-                found = True
-                break
-
-        if not found:
-            # create record if somehow missing
-            new_student = {
-                "id": student_record_id,
-                "name": enrollment.get("name"),
-                "rollNo": enrollment.get("roll_no"),
-                "email": enrollment.get("email"),
-                "attendance": {attendance_date: "P"},
-            }
-            students.append(new_student)
-            class_data["students"] = students
-
-        # save class
-        teacher_id = class_data.get("teacher_id")
-        class_file = self.get_class_file(teacher_id, class_id)
-        self.write_json(class_file, class_data)
-
-        # 4) Record scan in session
-        scanned: List[str] = session_data.get("scanned_students", [])
-        if student_record_id not in scanned:
-            scanned.append(student_record_id)
-        session_data["scanned_students"] = scanned
-        session_data["last_scan_at"] = datetime.utcnow().isoformat()
-        self.write_json(session_file, session_data)
+            # 3) Load class and journal the 'P' mark (no snapshot rewrite)
+            class_data = self.get_class_by_id(class_id)
+            if not class_data:
+                raise ValueError("Class not found")
 
-        return {
-            "success": True,
-            "message": "Attendance marked as Present",
-            "date": attendance_date,
-    }
+            students = class_data.get("students", [])
+            found = any(s.get("id") == student_record_id for s in students)
+
+            self._append_attendance_marks(class_id, [(attendance_date, student_record_id, "P")])
+
+            if not found:
+                # create record if somehow missing - this one needs the snapshot
+                new_student = {
+                    "id": student_record_id,
+                    "name": enrollment.get("name"),
+                    "rollNo": enrollment.get("roll_no"),
+                    "email": enrollment.get("email"),
+                    "attendance": {attendance_date: "P"},
+                    "counts": new_counts({attendance_date: "P"}),
+                }
+                shift_counts(class_counts(class_data), None, "P")
+                students.append(new_student)
+                class_data["students"] = students
+                teacher_id = class_data.get("teacher_id")
+                self.write_json(self.get_class_file(teacher_id, class_id), class_data)
+
+            # 4) Journal the scan (folded into the session file on stop)
+            scan_line = json.dumps({"record_id": student_record_id, "ts": datetime.utcnow().isoformat()}) + "\n"
+            with open(self.get_qr_scan_journal_file(class_id), 'a', encoding='utf-8') as f:
+                f.write(scan_line)
+                f.flush()
+                os.fsync(f.fileno())
+
+            return {
+                "success": True,
+                "message": "Attendance marked as Present",
+                "date": attendance_date,
+            }
 
 
     def stop_qr_session(self, class_id: str, teacher_id: str) -> Dict[str, Any]:
@@ -161,62 +483,421 @@ class DatabaseManager:
         - Leaves scanned students as already marked Present (P)
         - Closes the QR session
         """
-        # 1) Load session
-        session_file = self.get_qr_session_file(class_id)
-        session_data = self.read_json(session_file)
+        with self._locked(*self._class_lock_paths(class_id, self.get_qr_session_file(class_id))):
+            # 1) Load session
+            session_file = self.get_qr_session_file(class_id)
+            session_data = self.read_json(session_file)
 
-        if not session_data or session_data.get("status") != "active":
-            raise ValueError("No active session")
+            if not session_data or session_data.get("status") != "active":
+                raise ValueError("No active session")
 
-        if session_data.get("teacher_id") != teacher_id:
-            raise ValueError("Unauthorized")
+            if session_data.get("teacher_id") != teacher_id:
+                raise ValueError("Unauthorized")
 
-        attendance_date = session_data["attendance_date"]
-        scanned_ids = set(session_data.get("scanned_students", []))
+            attendance_date = session_data["attendance_date"]
+            self._merge_qr_scans(class_id, session_data)
+            scanned_ids = set(session_data["scanned_students"])
 
-        # 2) Load class and enrollments
-        class_data = self.get_class_by_id(class_id)
-        if not class_data:
-            raise ValueError("Class not found")
+            # 2) Load class and enrollments
+            class_data = self.get_class_by_id(class_id)
+            if not class_data:
+                raise ValueError("Class not found")
 
-        students = class_data.get("students", [])
+            students = class_data.get("students", [])
 
-        enrollment_file = self.get_enrollment_file(class_id)
-        all_enrollments = self.read_json(enrollment_file) or []
-        active_student_ids = {
-            e.get("student_record_id")
-            for e in all_enrollments
-            if e.get("status") == "active"
-        }
+            enrollment_file = self.get_enrollment_file(class_id)
+            all_enrollments = self.read_json(enrollment_file) or []
+            active_student_ids = {
+                e.get("student_record_id")
+                for e in all_enrollments
+                if e.get("status") == "active"
+            }
 
-        # 3) Mark absents for enrolled but not scanned
-        marked_absent = 0
-        for student in students:
-            sid = student.get("id")
-            if sid in active_student_ids and sid not in scanned_ids:
-                student.setdefault("attendance", {})
-                # Only mark if not already marked P by scan_qr_code
-                if student["attendance"].get(attendance_date) is None:
-                    student["attendance"][attendance_date] = "A"
-                    marked_absent += 1
-
-        # 4) Save updated class
-        # use the same helper as update_class: get_class_file
-        teacher_in_class = class_data.get("teacher_id")
-        class_file = self.get_class_file(teacher_in_class, class_id)
-        self.write_json(class_file, class_data)
-
-        # 5) Close session
-        session_data["status"] = "stopped"
-        session_data["stopped_at"] = datetime.utcnow().isoformat()
-        self.write_json(session_file, session_data)
+            # 3) Mark absents for enrolled but not scanned
+            absent_marks = []
+            for student in students:
+                sid = student.get("id")
+                if sid in active_student_ids and sid not in scanned_ids:
+                    # Only mark if not already marked P by scan_qr_code
+                    if student.get("attendance", {}).get(attendance_date) is None:
+                        absent_marks.append((attendance_date, sid, "A"))
+            marked_absent = len(absent_marks)
 
-        return {
-            "success": True,
-            "scanned_count": len(scanned_ids),
-            "absent_count": marked_absent,
-            "date": attendance_date,
-        }
+            # 4) Journal the absences and fold the session's marks into the snapshot
+            self._append_attendance_marks(class_id, absent_marks, compact=False)
+            self.compact_attendance_journal(class_id)
+
+            # 5) Close session, its scans now part of the session file
+            session_data["status"] = "stopped"
+            session_data["stopped_at"] = datetime.utcnow().isoformat()
+            self.write_json(session_file, session_data)
+            self._remove_qr_scan_journal(class_id)
+
+            return {
+                "success": True,
+                "scanned_count": len(scanned_ids),
+                "absent_count": marked_absent,
+                "date": attendance_date,
+            }
+
+    def convert_storage(self) -> int:
+        """
+        Rewrite every data file under base_dir in this manager's codec.
+        File names keep their .json suffix whatever the codec; reads detect the format.
+        """
+        converted = 0
+        for root, _dirs, files in os.walk(self.base_dir):
+            for filename in files:
+                if not filename.endswith(".json"):
+                    continue  # journals (.jsonl) and temp files stay as they are
+                file_path = os.path.join(root, filename)
+                data = self.read_json(file_path)
+                if data is None:
+                    print(f"[CONVERT] Skipping unreadable {file_path}")
+                    continue
+                self.write_json(file_path, data)
+                converted += 1
+        print(f"[CONVERT] Rewrote {converted} files as {self.codec.name}")
+        return converted
+
+    # ==================== EMAIL INDEX ====================
+
+    def _get_index_signature(self, index_name: str) -> Optional[tuple]:
+        """(inode, mtime) of an index file - changes on every atomic rewrite"""
+        try:
+            st = os.stat(self.get_index_file(index_name))
+            return (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def _load_email_index(self, index_name: str) -> Dict[str, str]:
+        """Load an email index into memory, reloading if another process rewrote it"""
+        with self._index_lock:
+            signature = self._get_index_signature(index_name)
+            if signature is None:
+                # No index on disk yet (fresh or pre-index data dir) - build it once
+                self.rebuild_email_indexes()
+                return self._email_indexes[index_name]
+            if index_name not in self._email_indexes or self._email_index_signatures.get(index_name) != signature:
+                self._email_indexes[index_name] = self.read_json(self.get_index_file(index_name)) or {}
+                self._email_index_signatures[index_name] = signature
+            return self._email_indexes[index_name]
+
+    def _save_email_index(self, index_name: str, index: Dict[str, str]):
+        """Persist an email index atomically and refresh the in-memory mirror"""
+        with self._index_lock:
+            self.write_json(self.get_index_file(index_name), index)
+            self._email_indexes[index_name] = index
+            self._email_index_signatures[index_name] = self._get_index_signature(index_name)
+
+    def _lookup_email(self, index_name: str, email: str) -> Optional[str]:
+        """Resolve email -> id from the in-memory mirror"""
+        return self._load_email_index(index_name).get(email)
+
+    def _index_email(self, index_name: str, email: Optional[str], entity_id: str, old_email: Optional[str] = None):
+        """Point email at entity_id (dropping old_email if the address changed)"""
+        if not email:
+            return
+        with self._index_lock, self._locked(self.get_index_file(index_name)):
+            index = dict(self._load_email_index(index_name))
+            changed = False
+            if old_email and old_email != email and index.get(old_email) == entity_id:
+                del index[old_email]
+                changed = True
+            if index.get(email) != entity_id:
+                index[email] = entity_id
+                changed = True
+            if changed:
+                self._save_email_index(index_name, index)
+
+    def _unindex_email(self, index_name: str, email: Optional[str], entity_id: str):
+        """Remove email from the index if it still points at entity_id"""
+        if not email:
+            return
+        with self._index_lock, self._locked(self.get_index_file(index_name)):
+            index = dict(self._load_email_index(index_name))
+            if index.get(email) != entity_id:
+                return
+            del index[email]
+            self._save_email_index(index_name, index)
+
+    def rebuild_email_indexes(self) -> Dict[str, int]:
+        """Rebuild the email -> id indexes by scanning every user and student directory"""
+        with self._index_lock:
+            users_index: Dict[str, str] = {}
+            for user_id in self._iter_user_ids():
+                user_data = self.read_json(self.get_user_file(user_id))
+                if user_data and user_data.get("email"):
+                    users_index.setdefault(user_data["email"], user_id)
+
+            students_index: Dict[str, str] = {}
+            for student_id in self._iter_student_ids():
+                student_data = self.read_json(self.get_student_file(student_id))
+                if student_data and student_data.get("email"):
+                    students_index.setdefault(student_data["email"], student_id)
+
+            self._save_email_index(USER_EMAIL_INDEX, users_index)
+            self._save_email_index(STUDENT_EMAIL_INDEX, students_index)
+
+        print(f"[INDEX] Rebuilt email indexes: {len(users_index)} users, {len(students_index)} students")
+        return {"users": len(users_index), "students": len(students_index)}
+
+    # ==================== CLASS ROUTING ====================
+
+    def _remember_class_route(self, class_id: str, teacher_id: str):
+        """Insert/refresh a route in the LRU layer, evicting the least recently used"""
+        with self._index_lock:
+            self._class_route_cache[class_id] = teacher_id
+            self._class_route_cache.move_to_end(class_id)
+            while len(self._class_route_cache) > CLASS_ROUTE_CACHE_SIZE:
+                self._class_route_cache.popitem(last=False)
+
+    def _forget_class_route(self, class_id: str):
+        with self._index_lock:
+            self._class_route_cache.pop(class_id, None)
+
+    def get_class_routes_log(self) -> str:
+        """Get the append-only class route change log"""
+        return os.path.join(self.indexes_dir, f"{CLASS_ROUTES_INDEX}.jsonl")
+
+    def _load_class_routes(self) -> Dict[str, str]:
+        """
+        Bring the in-memory routing table up to date: reload the snapshot only when its
+        signature changed, then apply the unread tail of the change log. Built on first use.
+        """
+        log_file = self.get_class_routes_log()
+        with self._index_lock:
+            signature = self._get_index_signature(CLASS_ROUTES_INDEX)
+            if signature is None and not os.path.exists(log_file):
+                self.rebuild_class_routes()
+                signature = self._get_index_signature(CLASS_ROUTES_INDEX)
+            if signature != self._class_routes_signature:
+                self._class_routes = self.read_json(self.get_index_file(CLASS_ROUTES_INDEX)) or {}
+                self._class_routes_signature = signature
+                self._class_routes_log_position = (None, 0)
+                self._class_route_misses.clear()
+
+            try:
+                stat = os.stat(log_file)
+            except FileNotFoundError:
+                self._class_routes_log_position = (None, 0)
+                return self._class_routes
+            inode, position = self._class_routes_log_position
+            if inode != stat.st_ino or stat.st_size < position:
+                # A different log than the one we were reading - its entries are
+                # last-write-wins, so replaying it over the snapshot is safe
+                position = 0
+            if stat.st_size > position:
+                with open(log_file, 'rb') as f:
+                    f.seek(position)
+                    tail = f.read()
+                # Only consume complete lines; a partial one is picked up next time
+                complete = tail[:tail.rfind(b"\n") + 1]
+                for line in complete.splitlines():
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    route_class_id, teacher_id = entry.get("class_id"), entry.get("teacher_id")
+                    if teacher_id is None:
+                        self._class_routes.pop(route_class_id, None)
+                        self._class_route_cache.pop(route_class_id, None)
+                    else:
+                        self._class_routes[route_class_id] = teacher_id
+                position += len(complete)
+                if complete:
+                    self._class_route_misses.clear()
+            self._class_routes_log_position = (stat.st_ino, position)
+            return self._class_routes
+
+    def _set_class_route(self, class_id: str, teacher_id: Optional[str]):
+        """Persist class_id -> teacher_id (or drop the route when teacher_id is None) by appending to the log"""
+        with self._index_lock, self._locked(self.get_index_file(CLASS_ROUTES_INDEX)):
+            routes = self._load_class_routes()
+            if teacher_id is None:
+                self._forget_class_route(class_id)
+                if class_id not in routes:
+                    return
+            else:
+                self._remember_class_route(class_id, teacher_id)
+                self._class_route_misses.pop(class_id, None)
+                if routes.get(class_id) == teacher_id:
+                    return
+
+            with open(self.get_class_routes_log(), 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"class_id": class_id, "teacher_id": teacher_id}) + "\n")
+                size = f.tell()
+            routes = self._load_class_routes()
+            if size >= CLASS_ROUTES_LOG_BYTES:
+                self._save_class_routes(dict(routes))
+
+    def _save_class_routes(self, routes: Dict[str, str]):
+        """Write routes as the new snapshot and drop the change log (caller holds the table's file lock)"""
+        with self._index_lock:
+            self.write_json(self.get_index_file(CLASS_ROUTES_INDEX), routes)
+            log_file = self.get_class_routes_log()
+            if os.path.exists(log_file):
+                os.remove(log_file)
+            self._class_routes = routes
+            self._class_routes_signature = self._get_index_signature(CLASS_ROUTES_INDEX)
+            self._class_routes_log_position = (None, 0)
+            self._class_route_misses.clear()
+
+    def _probe_class_teacher(self, class_id: str) -> Optional[str]:
+        """Look for the class file in every teacher's directory (route lost or never written)"""
+        for teacher_id in self._iter_user_ids():
+            if os.path.exists(self.get_class_file(teacher_id, class_id)):
+                return teacher_id
+        return None
+
+    def resolve_class_teacher(self, class_id: str) -> Optional[str]:
+        """
+        Resolve which teacher owns class_id: LRU, then the routing table mirror, then
+        (once per table change) a probe of the teacher directories that heals the route
+        """
+        class_id = str(class_id)
+        with self._index_lock:
+            teacher_id = self._class_route_cache.get(class_id)
+            # Another worker may have deleted or moved the class since we cached it
+            if teacher_id is not None and os.path.exists(self.get_class_file(teacher_id, class_id)):
+                self._class_route_cache.move_to_end(class_id)
+                return teacher_id
+            self._class_route_cache.pop(class_id, None)
+
+            teacher_id = self._load_class_routes().get(class_id)
+            if teacher_id is not None:
+                self._remember_class_route(class_id, teacher_id)
+                return teacher_id
+            if class_id in self._class_route_misses:
+                return None
+
+        # Outside the index lock: this walks every teacher directory
+        teacher_id = self._probe_class_teacher(class_id)
+        if teacher_id is not None:
+            print(f"[INDEX] Class {class_id} was missing from the routing table, re-added for {teacher_id}")
+            self._set_class_route(class_id, teacher_id)
+        else:
+            with self._index_lock:
+                self._class_route_misses[class_id] = None
+                while len(self._class_route_misses) > CLASS_ROUTE_CACHE_SIZE:
+                    self._class_route_misses.popitem(last=False)
+        return teacher_id
+
+    def rebuild_class_routes(self) -> int:
+        """Rebuild the class routing table by scanning every teacher's classes directory"""
+        routes: Dict[str, str] = {}
+        for teacher_id in self._iter_user_ids():
+            classes_dir = self.get_user_classes_dir(teacher_id)
+            if not os.path.exists(classes_dir):
+                continue
+            for filename in os.listdir(classes_dir):
+                if filename.startswith("class_") and filename.endswith(".json"):
+                    routes[filename[len("class_"):-len(".json")]] = teacher_id
+
+        with self._index_lock, self._locked(self.get_index_file(CLASS_ROUTES_INDEX)):
+            self._save_class_routes(routes)
+            self._class_route_cache.clear()
+
+        print(f"[INDEX] Rebuilt class routes: {len(routes)} classes")
+        return len(routes)
+
+    # ==================== ATTENDANCE JOURNAL ====================
+
+    def _read_journal_entries(self, journal_file: str) -> List[Dict[str, Any]]:
+        """Read journal lines, skipping a torn trailing line from a crashed append"""
+        entries = []
+        try:
+            with open(journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _append_attendance_marks(self, class_id: str, marks: List[tuple], compact: bool = True):
+        """
+        Append (date, record_id, status) marks to the class journal.
+        status None records that the cell was cleared.
+        """
+        if not marks:
+            return
+        timestamp = datetime.utcnow().isoformat()
+        lines = "".join(
+            json.dumps({"date": date, "record_id": record_id, "status": status, "ts": timestamp}) + "\n"
+            for date, record_id, status in marks
+        )
+        with self._locked(*self._class_lock_paths(class_id)):
+            journal_file = self.get_attendance_journal_file(class_id)
+            with open(journal_file, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+
+        if compact and size >= JOURNAL_COMPACT_BYTES:
+            self.compact_attendance_journal(class_id)
+
+    def _replay_attendance_journal(self, class_data: Dict[str, Any], entries: List[Dict[str, Any]]):
+        """Apply journal entries on top of a class snapshot (idempotent, last write wins)"""
+        if not entries:
+            return
+        students_by_id = {s.get("id"): s for s in class_data.get("students", [])}
+        totals = class_counts(class_data)
+        for entry in entries:
+            student = students_by_id.get(entry.get("record_id"))
+            if student is None:
+                continue
+            apply_mark(student, entry.get("date"), entry.get("status"), totals)
+
+    def _read_class_file(self, user_id: str, class_id: str) -> Optional[Dict[str, Any]]:
+        """Read a class snapshot with its pending journal entries applied"""
+        journal_file = self.get_attendance_journal_file(class_id)
+        # Journal before compacting file before snapshot: any interleaving with a
+        # concurrent compaction still yields a state at least as new as the snapshot
+        pending = self._read_journal_entries(journal_file)
+        compacting = self._read_journal_entries(f"{journal_file}.compacting")
+
+        class_data = self.read_json(self.get_class_file(user_id, class_id))
+        if class_data is None:
+            return None
+        self._replay_attendance_journal(class_data, compacting + pending)
+        return class_data
+
+    def compact_attendance_journal(self, class_id: str) -> bool:
+        """Fold a class's attendance journal back into its snapshot file"""
+        class_id = str(class_id)
+        journal_file = self.get_attendance_journal_file(class_id)
+        compacting_file = f"{journal_file}.compacting"
+
+        with self._locked(*self._class_lock_paths(class_id)):
+            teacher_id = self.resolve_class_teacher(class_id)
+            if not teacher_id:
+                return False
+            if not os.path.exists(compacting_file):
+                if not os.path.exists(journal_file):
+                    return False
+                # New appends go to a fresh journal while we fold this one in
+                os.replace(journal_file, compacting_file)
+
+            class_data = self.read_json(self.get_class_file(teacher_id, class_id))
+            if class_data is None:
+                return False
+            entries = self._read_journal_entries(compacting_file)
+            self._replay_attendance_journal(class_data, entries)
+            self.write_json(self.get_class_file(teacher_id, class_id), class_data)
+            os.remove(compacting_file)
+
+        print(f"[JOURNAL] Compacted {len(entries)} marks into class {class_id}")
+        return True
+
+    def _remove_attendance_journal(self, class_id: str):
+        journal_file = self.get_attendance_journal_file(class_id)
+        for path in (journal_file, f"{journal_file}.compacting"):
+            if os.path.exists(path):
+                os.remove(path)
 
     # ==================== USER OPERATIONS ====================
     
@@ -225,6 +906,7 @@ class DatabaseManager:
         user_dir = self.get_user_dir(user_id)
         classes_dir = self.get_user_classes_dir(user_id)
         os.makedirs(classes_dir, exist_ok=True)
+        is_new = not os.path.exists(self.get_user_file(user_id))
         
         user_data = {
             "id": user_id,
@@ -242,12 +924,16 @@ class DatabaseManager:
         }
         
         self.write_json(self.get_user_file(user_id), user_data)
+        self._index_email(USER_EMAIL_INDEX, email, user_id)
+        if is_new:
+            self._bump_database_stats(users=1)
         return user_data
     
     def create_student(self, student_id: str, email: str, name: str, password_hash: str) -> Dict[str, Any]:
         """Create a new student user"""
         student_dir = self.get_student_dir(student_id)
         os.makedirs(student_dir, exist_ok=True)
+        is_new = not os.path.exists(self.get_student_file(student_id))
         
         student_data = {
             "id": student_id,
@@ -261,10 +947,13 @@ class DatabaseManager:
         }
         
         self.write_json(self.get_student_file(student_id), student_data)
+        self._index_email(STUDENT_EMAIL_INDEX, email, student_id)
+        if is_new:
+            self._bump_database_stats(students=1)
         return student_data
     
-    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
-        """Get user data"""
+    def _read_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Read the user file as stored (internal reads skip the overview refresh)"""
         return self.read_json(self.get_user_file(user_id))
     
     def get_student(self, student_id: str) -> Optional[Dict[str, Any]]:
@@ -272,50 +961,70 @@ class DatabaseManager:
         return self.read_json(self.get_student_file(student_id))
     
     def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
-        """Get user by email (searches all users - teachers)"""
-        if not os.path.exists(self.users_dir):
+        """Get user by email (teachers) via the email index"""
+        user_id = self._lookup_email(USER_EMAIL_INDEX, email)
+        if not user_id:
             return None
         
-        for user_id in os.listdir(self.users_dir):
-            user_file = self.get_user_file(user_id)
-            user_data = self.read_json(user_file)
-            if user_data and user_data.get("email") == email:
-                return user_data
+        user_data = self.get_user(user_id)
+        if user_data and user_data.get("email") == email:
+            return user_data
+        
+        # Stale entry (user deleted or email changed outside DatabaseManager)
+        self._unindex_email(USER_EMAIL_INDEX, email, user_id)
         return None
     
     def get_student_by_email(self, email: str) -> Optional[Dict[str, Any]]:
-        """Get student by email"""
-        if not os.path.exists(self.students_dir):
+        """Get student by email via the email index"""
+        student_id = self._lookup_email(STUDENT_EMAIL_INDEX, email)
+        if not student_id:
             return None
         
-        for student_id in os.listdir(self.students_dir):
-            student_file = self.get_student_file(student_id)
-            student_data = self.read_json(student_file)
-            if student_data and student_data.get("email") == email:
-                return student_data
+        student_data = self.get_student(student_id)
+        if student_data and student_data.get("email") == email:
+            return student_data
+        
+        self._unindex_email(STUDENT_EMAIL_INDEX, email, student_id)
         return None
     
     def update_user(self, user_id: str, **updates) -> Dict[str, Any]:
         """Update user data"""
-        user_data = self.get_user(user_id)
-        if not user_data:
-            raise ValueError(f"User {user_id} not found")
-        
-        user_data.update(updates)
-        user_data["updated_at"] = datetime.utcnow().isoformat()
-        self.write_json(self.get_user_file(user_id), user_data)
-        return user_data
+        with self._locked(self.get_user_file(user_id)):
+            user_data = self._read_user(user_id)
+            if not user_data:
+                raise ValueError(f"User {user_id} not found")
+        
+            old_email = user_data.get("email")
+            user_data.update(updates)
+            user_data["updated_at"] = datetime.utcnow().isoformat()
+            self.write_json(self.get_user_file(user_id), user_data)
+            if user_data.get("email") != old_email:
+                self._index_email(USER_EMAIL_INDEX, user_data.get("email"), user_id, old_email=old_email)
+            return user_data
     
     def update_student(self, student_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
         """Update student data"""
-        student_data = self.get_student(student_id)
-        if not student_data:
-            raise ValueError(f"Student {student_id} not found")
-        
-        student_data.update(updates)
-        student_data["updated_at"] = datetime.utcnow().isoformat()
-        self.write_json(self.get_student_file(student_id), student_data)
-        return student_data
+        with self._locked(self.get_student_file(student_id)):
+            student_data = self.get_student(student_id)
+            if not student_data:
+                raise ValueError(f"Student {student_id} not found")
+        
+            old_email = student_data.get("email")
+            student_data.update(updates)
+            student_data["updated_at"] = datetime.utcnow().isoformat()
+            self.write_json(self.get_student_file(student_id), student_data)
+            if student_data.get("email") != old_email:
+                self._index_email(STUDENT_EMAIL_INDEX, student_data.get("email"), student_id, old_email=old_email)
+            return student_data
+    
+    def _drop_enrolled_class(self, student_id: str, class_id: str):
+        """Remove class_id from a student's enrolled_classes list"""
+        with self._locked(self.get_student_file(student_id)):
+            student_data = self.get_student(student_id)
+            if student_data:
+                enrolled_classes = student_data.get("enrolled_classes", [])
+                enrolled_classes = [ec for ec in enrolled_classes if ec.get("class_id") != class_id]
+                self.update_student(student_id, {"enrolled_classes": enrolled_classes})
     
     def delete_user(self, user_id: str) -> bool:
         """Delete user and all associated data"""
@@ -324,26 +1033,34 @@ class DatabaseManager:
             return False
         
         try:
+            user_data = self._read_user(user_id)
             classes = self.get_all_classes(user_id)
             for cls in classes:
                 class_id = str(cls.get("id"))
-                enrollment_file = self.get_enrollment_file(class_id)
-                if os.path.exists(enrollment_file):
-                    enrollments = self.read_json(enrollment_file) or []
-                    for enrollment in enrollments:
-                        student_id = enrollment.get("student_id")
-                        if student_id:
-                            try:
-                                student_data = self.get_student(student_id)
-                                if student_data:
-                                    enrolled_classes = student_data.get("enrolled_classes", [])
-                                    enrolled_classes = [ec for ec in enrolled_classes if ec.get("class_id") != class_id]
-                                    self.update_student(student_id, {"enrolled_classes": enrolled_classes})
-                            except Exception as e:
-                                print(f"Error updating student {student_id} during teacher deletion: {e}")
-                    os.remove(enrollment_file)
+                with self._locked(*self._class_lock_paths(class_id)):
+                    self._remove_attendance_journal(class_id)
+                    self._set_class_route(class_id, None)
+                    enrollment_file = self.get_enrollment_file(class_id)
+                    if os.path.exists(enrollment_file):
+                        enrollments = self.read_json(enrollment_file) or []
+                        for enrollment in enrollments:
+                            student_id = enrollment.get("student_id")
+                            if student_id:
+                                try:
+                                    self._drop_enrolled_class(student_id, class_id)
+                                except Exception as e:
+                                    print(f"Error updating student {student_id} during teacher deletion: {e}")
+                        os.remove(enrollment_file)
             
-            shutil.rmtree(user_dir)
+            # Re-resolve: a layout migration may have moved the directory meanwhile
+            shutil.rmtree(self.get_user_dir(user_id))
+            if user_data:
+                self._unindex_email(USER_EMAIL_INDEX, user_data.get("email"), user_id)
+            self._bump_database_stats(
+                users=-1,
+                classes=-len(classes),
+                class_students=-sum(len(cls.get("students", [])) for cls in classes),
+            )
             return True
         except Exception as e:
             print(f"Error deleting user {user_id}: {e}")
@@ -368,24 +1085,30 @@ class DatabaseManager:
                 
                 print(f"[DELETE_STUDENT] Processing class {class_id}")
                 enrollment_file = self.get_enrollment_file(class_id)
-                if os.path.exists(enrollment_file):
-                    enrollments = self.read_json(enrollment_file) or []
-                    original_count = len(enrollments)
-                    updated_enrollments = [e for e in enrollments if e.get("student_id") != student_id]
-                    self.write_json(enrollment_file, updated_enrollments)
-                    print(f"[DELETE_STUDENT] Updated enrollments for class {class_id}: {original_count} -> {len(updated_enrollments)}")
+                was_active = False
+                with self._locked(enrollment_file):
+                    if os.path.exists(enrollment_file):
+                        enrollments = self.read_json(enrollment_file) or []
+                        original_count = len(enrollments)
+                        was_active = any(
+                            e.get("student_id") == student_id and e.get("status") == "active" for e in enrollments
+                        )
+                        updated_enrollments = [e for e in enrollments if e.get("student_id") != student_id]
+                        self.write_json(enrollment_file, updated_enrollments)
+                        print(f"[DELETE_STUDENT] Updated enrollments for class {class_id}: {original_count} -> {len(updated_enrollments)}")
                 
-                class_data = self.get_class_by_id(class_id)
-                if class_data:
-                    teacher_id = class_data.get("teacher_id")
-                    if teacher_id:
-                        self.update_user_overview(teacher_id)
-                        print(f"[DELETE_STUDENT] Updated teacher {teacher_id} overview")
+                teacher_id = self.resolve_class_teacher(class_id)
+                if teacher_id and was_active:
+                    self._adjust_user_overview(teacher_id, students=-1)
+                    self._bump_database_stats(class_students=-1)
+                    print(f"[DELETE_STUDENT] Updated teacher {teacher_id} overview")
             
             student_dir = self.get_student_dir(student_id)
             if os.path.exists(student_dir):
                 shutil.rmtree(student_dir)
+                self._bump_database_stats(students=-1)
                 print(f"[DELETE_STUDENT] Deleted student directory")
+            self._unindex_email(STUDENT_EMAIL_INDEX, student_data.get("email"), student_id)
             
             print(f"[DELETE_STUDENT] ✅ Successfully deleted student {student_id}\n")
             return True
@@ -393,33 +1116,71 @@ class DatabaseManager:
             print(f"[DELETE_STUDENT] ❌ ERROR: {e}")
             return False
     
-    def update_user_overview(self, user_id: str):
-        """Update user overview statistics - counts only ACTIVE enrollments"""
-        user_data = self.get_user(user_id)
-        if not user_data:
-            return
+    def update_user_overview(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Recompute user overview statistics from scratch - counts only ACTIVE enrollments"""
+        with self._locked(self.get_user_file(user_id)):
+            user_data = self._read_user(user_id)
+            if not user_data:
+                return None
         
-        classes = self.get_all_classes(user_id)
-        total_active_students = 0
+            classes = self.get_all_classes(user_id)
+            total_active_students = 0
         
-        for cls in classes:
-            class_id = cls.get("id")
-            enrollments = self.get_class_enrollments(str(class_id))
-            total_active_students += len(enrollments)
+            for cls in classes:
+                class_id = cls.get("id")
+                enrollments = self.get_class_enrollments(str(class_id))
+                total_active_students += len(enrollments)
         
-        user_data["overview"] = {
-            "total_classes": len(classes),
-            "total_students": total_active_students,
-            "last_updated": datetime.utcnow().isoformat()
-        }
+            user_data["overview"] = {
+                "total_classes": len(classes),
+                "total_students": total_active_students,
+                "last_updated": datetime.utcnow().isoformat()
+            }
         
-        self.write_json(self.get_user_file(user_id), user_data)
+            self.write_json(self.get_user_file(user_id), user_data)
+            return user_data
+
+    def _adjust_user_overview(self, user_id: str, classes: int = 0, students: int = 0):
+        """
+        Apply a class/active-student delta to the overview instead of recomputing it.
+        An overview that cannot take the delta is marked stale for get_user to rebuild.
+        """
+        with self._locked(self.get_user_file(user_id)):
+            user_data = self._read_user(user_id)
+            if not user_data:
+                return
+        
+            overview = dict(user_data.get("overview") or {})
+            if not overview.get("stale"):
+                try:
+                    overview["total_classes"] = int(overview["total_classes"]) + classes
+                    overview["total_students"] = int(overview["total_students"]) + students
+                except (KeyError, TypeError, ValueError):
+                    overview["stale"] = True
+                else:
+                    if overview["total_classes"] < 0 or overview["total_students"] < 0:
+                        overview["stale"] = True
+            overview["last_updated"] = datetime.utcnow().isoformat()
+        
+            user_data["overview"] = overview
+            self.write_json(self.get_user_file(user_id), user_data)
+
+    def invalidate_user_overview(self, user_id: str):
+        """Mark the overview stale so the next get_user recomputes it"""
+        with self._locked(self.get_user_file(user_id)):
+            user_data = self._read_user(user_id)
+            if user_data and not (user_data.get("overview") or {}).get("stale"):
+                user_data["overview"] = {**(user_data.get("overview") or {}), "stale": True}
+                self.write_json(self.get_user_file(user_id), user_data)
 
     # ==================== CLASS OPERATIONS ====================
     
     def create_class(self, user_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create a new class"""
         class_id = str(class_data["id"])
+        for student in class_data.get("students", []):
+            student["counts"] = new_counts(student.get("attendance"))
+        class_data["attendance_counts"] = sum_counts(class_data.get("students", []))
         full_class_data = {
             **class_data,
             "teacher_id": user_id,
@@ -428,16 +1189,24 @@ class DatabaseManager:
             "statistics": self.calculate_class_statistics(class_data, class_id)
         }
         
-        class_file = self.get_class_file(user_id, class_id)
-        self.write_json(class_file, full_class_data)
-        self.update_user_overview(user_id)
+        # The user file lock keeps the class from landing in a tree migrate_to_sharded_layout is moving
+        with self._locked(self.get_class_file(user_id, class_id), self.get_enrollment_file(class_id),
+                          self.get_user_file(user_id)):
+            class_file = self.get_class_file(user_id, class_id)
+            replaced = os.path.exists(class_file)
+            self.write_json(class_file, full_class_data)
+            self._set_class_route(class_id, user_id)
+        if replaced:
+            self.invalidate_user_overview(user_id)
+        else:
+            self._adjust_user_overview(user_id, classes=1)
+            self._bump_database_stats(classes=1)
         
         return full_class_data
     
     def get_class(self, user_id: str, class_id: str) -> Optional[Dict[str, Any]]:
         """Get a specific class - FILTERS to show only ACTIVE students"""
-        class_file = self.get_class_file(user_id, class_id)
-        class_data = self.read_json(class_file)
+        class_data = self._read_class_file(user_id, class_id)
         
         if not class_data:
             return None
@@ -460,16 +1229,16 @@ class DatabaseManager:
     
     def get_class_by_id(self, class_id: str) -> Optional[Dict[str, Any]]:
         """Get a class by ID - returns RAW data with ALL students (for internal use)"""
-        if not os.path.exists(self.users_dir):
+        class_id = str(class_id)
+        teacher_id = self.resolve_class_teacher(class_id)
+        if not teacher_id:
             return None
         
-        for teacher_id in os.listdir(self.users_dir):
-            classes_dir = self.get_user_classes_dir(teacher_id)
-            if os.path.exists(classes_dir):
-                class_file = os.path.join(classes_dir, f"class_{class_id}.json")
-                if os.path.exists(class_file):
-                    return self.read_json(class_file)
-        return None
+        class_data = self._read_class_file(teacher_id, class_id)
+        if class_data is None:
+            # Route points at a class file that no longer exists
+            self._set_class_route(class_id, None)
+        return class_data
     
     def get_all_classes(self, user_id: str) -> List[Dict[str, Any]]:
         """Get all classes for a user - FILTERS to show only ACTIVE students"""
@@ -480,8 +1249,7 @@ class DatabaseManager:
         classes = []
         for filename in os.listdir(classes_dir):
             if filename.startswith("class_") and filename.endswith(".json"):
-                class_file = os.path.join(classes_dir, filename)
-                class_data = self.read_json(class_file)
+                class_data = self._read_class_file(user_id, filename[len("class_"):-len(".json")])
                 if class_data:
                     class_id = str(class_data.get('id'))
                     
@@ -501,162 +1269,123 @@ class DatabaseManager:
     
     def update_class(self, user_id: str, class_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
         """Update class data - preserves inactive students"""
-        # Get FULL current class (with ALL students including inactive)
-        class_file = self.get_class_file(user_id, class_id)
-        current_class = self.read_json(class_file)
+        with self._locked(*self._class_lock_paths(class_id, self.get_class_file(user_id, class_id))):
+            # Get FULL current class (with ALL students including inactive)
+            class_file = self.get_class_file(user_id, class_id)
+            current_class = self._read_class_file(user_id, class_id)
         
-        if not current_class:
-            raise ValueError(f"Class {class_id} not found")
+            if not current_class:
+                raise ValueError(f"Class {class_id} not found")
         
-        all_students_in_file = current_class.get('students', [])
-        incoming_students = class_data.get('students', [])
+            all_students_in_file = current_class.get('students', [])
+            incoming_students = class_data.get('students', [])
         
-        # Check for deleted students
-        current_ids = {s.get('id') for s in all_students_in_file}
-        new_ids = {s.get('id') for s in incoming_students}
-        deleted_ids = current_ids - new_ids
+            # Check for deleted students
+            current_ids = {s.get('id') for s in all_students_in_file}
+            new_ids = {s.get('id') for s in incoming_students}
+            deleted_ids = current_ids - new_ids
         
-        # Mark deleted students as inactive in enrollments
-        if deleted_ids:
-            enrollment_file = self.get_enrollment_file(class_id)
-            enrollments = self.read_json(enrollment_file) or []
+            # Mark deleted students as inactive in enrollments
+            deactivated = 0
+            if deleted_ids:
+                enrollment_file = self.get_enrollment_file(class_id)
+                enrollments = self.read_json(enrollment_file) or []
             
-            for enrollment in enrollments:
-                if enrollment.get('student_record_id') in deleted_ids and enrollment.get('status') == 'active':
-                    enrollment['status'] = 'inactive'
-                    enrollment['removed_by_teacher_at'] = datetime.utcnow().isoformat()
+                for enrollment in enrollments:
+                    if enrollment.get('student_record_id') in deleted_ids and enrollment.get('status') == 'active':
+                        deactivated += 1
+                        enrollment['status'] = 'inactive'
+                        enrollment['removed_by_teacher_at'] = datetime.utcnow().isoformat()
                     
-                    # Update student's enrolled_classes
-                    student_id = enrollment.get('student_id')
-                    if student_id:
-                        try:
-                            student_data = self.get_student(student_id)
-                            if student_data:
-                                enrolled_classes = student_data.get('enrolled_classes', [])
-                                enrolled_classes = [ec for ec in enrolled_classes if ec.get('class_id') != class_id]
-                                self.update_student(student_id, {"enrolled_classes": enrolled_classes})
-                        except Exception as e:
-                            print(f"Error updating student {student_id}: {e}")
+                        # Update student's enrolled_classes
+                        student_id = enrollment.get('student_id')
+                        if student_id:
+                            try:
+                                self._drop_enrolled_class(student_id, class_id)
+                            except Exception as e:
+                                print(f"Error updating student {student_id}: {e}")
             
-            self.write_json(enrollment_file, enrollments)
-        
-        # Build final student list (active + inactive preserved)
-        updated_students_map = {s.get('id'): s for s in incoming_students}
-        final_students = []
-        
-        for student in all_students_in_file:
-            student_id = student.get('id')
-            if student_id in updated_students_map:
-                # Active student - use updated data
-                final_students.append(updated_students_map[student_id])
-            else:
-                # Inactive student - preserve from file
-                final_students.append(student)
-        
-        # Update and save
-        class_data['students'] = final_students
-        class_data["updated_at"] = datetime.utcnow().isoformat()
-        class_data["statistics"] = self.calculate_class_statistics(class_data, class_id)
-        
-        self.write_json(class_file, class_data)
-        self.update_user_overview(user_id)
+                self.write_json(enrollment_file, enrollments)
+        
+            # Build final student list (active + inactive preserved)
+            updated_students_map = {s.get('id'): s for s in incoming_students}
+            final_students = []
+        
+            for student in all_students_in_file:
+                student_id = student.get('id')
+                if student_id in updated_students_map:
+                    # Active student - use updated data
+                    final_students.append(updated_students_map[student_id])
+                else:
+                    # Inactive student - preserve from file
+                    final_students.append(student)
+        
+            # Carry the running counters forward by the attendance cells that
+            # actually changed (client counts are ignored)
+            current_by_id = {s.get('id'): s for s in all_students_in_file}
+            totals = dict(class_counts(current_class))
+            for student in final_students:
+                previous = current_by_id.get(student.get('id'), {})
+                old_attendance = previous.get('attendance', {})
+                new_attendance = student.get('attendance', {})
+                counts = dict(record_counts(previous))
+                for date, status in new_attendance.items():
+                    if old_attendance.get(date) != status:
+                        shift_counts(counts, old_attendance.get(date), status)
+                        shift_counts(totals, old_attendance.get(date), status)
+                for date in old_attendance.keys() - new_attendance.keys():
+                    shift_counts(counts, old_attendance[date], None)
+                    shift_counts(totals, old_attendance[date], None)
+                student['counts'] = counts
+        
+            # Update and save
+            class_data['students'] = final_students
+            class_data['attendance_counts'] = totals
+            class_data["updated_at"] = datetime.utcnow().isoformat()
+            class_data["statistics"] = self.calculate_class_statistics(class_data, class_id)
+        
+            # The snapshot already holds every journaled mark (it was read with the
+            # journal replayed), so the journal is dropped rather than appended to
+            self.write_json(class_file, class_data)
+            self._remove_attendance_journal(class_id)
+        if deactivated:
+            self._adjust_user_overview(user_id, students=-deactivated)
+            self._bump_database_stats(class_students=-deactivated)
         
         return class_data
     
     def delete_class(self, user_id: str, class_id: str) -> bool:
         """Delete a class and clean up enrollments"""
-        class_file = self.get_class_file(user_id, class_id)
-        if not os.path.exists(class_file):
-            return False
+        with self._locked(*self._class_lock_paths(class_id, self.get_class_file(user_id, class_id),
+                                                  self.get_user_file(user_id))):
+            class_file = self.get_class_file(user_id, class_id)
+            if not os.path.exists(class_file):
+                return False
         
-        os.remove(class_file)
+            os.remove(class_file)
+            self._remove_attendance_journal(class_id)
+            self._set_class_route(class_id, None)
         
-        enrollment_file = self.get_enrollment_file(class_id)
-        if os.path.exists(enrollment_file):
-            enrollments = self.read_json(enrollment_file) or []
-            for enrollment in enrollments:
-                student_id = enrollment.get("student_id")
-                if student_id:
-                    try:
-                        student_data = self.get_student(student_id)
-                        if student_data:
-                            enrolled_classes = student_data.get("enrolled_classes", [])
-                            enrolled_classes = [ec for ec in enrolled_classes if ec.get("class_id") != class_id]
-                            self.update_student(student_id, {"enrolled_classes": enrolled_classes})
-                    except Exception as e:
-                        print(f"Error updating student {student_id} after class deletion: {e}")
-            os.remove(enrollment_file)
+            active_count = 0
+            enrollment_file = self.get_enrollment_file(class_id)
+            if os.path.exists(enrollment_file):
+                enrollments = self.read_json(enrollment_file) or []
+                active_count = sum(1 for e in enrollments if e.get("status") == "active")
+                for enrollment in enrollments:
+                    student_id = enrollment.get("student_id")
+                    if student_id:
+                        try:
+                            self._drop_enrolled_class(student_id, class_id)
+                        except Exception as e:
+                            print(f"Error updating student {student_id} after class deletion: {e}")
+                os.remove(enrollment_file)
         
-        self.update_user_overview(user_id)
+        self._adjust_user_overview(user_id, classes=-1, students=-active_count)
+        self._bump_database_stats(classes=-1, class_students=-active_count)
         return True
     
-    def calculate_class_statistics(self, class_data: Dict[str, Any], class_id: str = None) -> Dict[str, Any]:
-        """Calculate statistics for a class - counts only ACTIVE students"""
-        students = class_data.get("students", [])
-        active_student_count = 0
-        
-        if class_id:
-            enrollments = self.get_class_enrollments(str(class_id))
-            active_record_ids = {e.get("student_record_id") for e in enrollments}
-            active_students = [s for s in students if s.get("id") in active_record_ids]
-        else:
-            active_students = students
-        
-        if not active_students:
-            return {
-                "total_students": 0,
-                "avg_attendance": 0.000,
-                "at_risk_count": 0,
-                "excellent_count": 0
-            }
-        
-        thresholds = class_data.get("thresholds")
-        if thresholds is None:
-            thresholds = {
-                "excellent": 95.000,
-                "good": 90.000,
-                "moderate": 85.000,
-                "atRisk": 85.000
-            }
-        
-        at_risk = 0
-        excellent = 0
-        total_attendance = 0.0
-        
-        for student in active_students:
-            attendance = student.get("attendance", {})
-            if attendance:
-                present = sum(1 for v in attendance.values() if v in ["P", "L"])
-                total = len(attendance)
-                percentage = (present / total * 100.0) if total > 0 else 0.0
-                total_attendance += percentage
-                
-                if percentage >= thresholds.get("excellent", 95.000):
-                    excellent += 1
-                elif percentage < thresholds.get("moderate", 85.000):
-                    at_risk += 1
-        
-        avg_attendance = (total_attendance / len(active_students)) if active_students else 0.0
-        
-        return {
-            "total_students": len(active_students),
-            "avg_attendance": round(avg_attendance, 3),
-            "at_risk_count": at_risk,
-            "excellent_count": excellent,
-            "last_calculated": datetime.utcnow().isoformat()
-        }
-
     # ==================== ENROLLMENT OPERATIONS ====================
     
-    def _generate_student_record_id(self) -> int:
-        """Generate unique student record ID for a class"""
-        return int(datetime.utcnow().timestamp() * 1000)
-    
-    def get_teacher_name(self, teacher_id: str) -> str:
-        """Get teacher name by ID"""
-        teacher = self.get_user(teacher_id)
-        return teacher.get('name', 'Unknown') if teacher else 'Unknown'
-    
     def enroll_student(self, student_id: str, class_id: str, student_info: dict) -> dict:
         """
         Enroll a student in a class.
@@ -670,157 +1399,164 @@ class DatabaseManager:
         print(f"  Class ID: {class_id}")
         print(f"{'='*60}")
         
-        # Verify class exists
-        class_data = self.get_class_by_id(class_id)
-        if not class_data:
-            raise ValueError("Class not found")
+        with self._locked(*self._class_lock_paths(class_id)):
+            # Verify class exists
+            class_data = self.get_class_by_id(class_id)
+            if not class_data:
+                raise ValueError("Class not found")
         
-        teacher_id = class_data.get('teacher_id')
-        if not teacher_id:
-            raise ValueError("Invalid class data")
+            teacher_id = class_data.get('teacher_id')
+            if not teacher_id:
+                raise ValueError("Invalid class data")
         
-        # Get enrollment file
-        enrollment_file = self.get_enrollment_file(class_id)
-        enrollments = self.read_json(enrollment_file) or []
-        
-        print(f"[ENROLL] Found {len(enrollments)} total enrollments")
-        
-        # Check if ACTIVELY enrolled
-        for enrollment in enrollments:
-            if enrollment.get('student_id') == student_id and enrollment.get('status') == 'active':
-                raise ValueError("You are already enrolled in this class")
-        
-        # Check if was EVER enrolled before
-        previous_enrollment = None
-        for enrollment in enrollments:
-            if enrollment.get('student_id') == student_id:
-                previous_enrollment = enrollment
-                print(f"[ENROLL] Found previous enrollment (status: {enrollment.get('status')})")
-                break
-        
-        class_file = self.get_class_file(teacher_id, class_id)
-        students = class_data.get('students', [])
-        
-        if previous_enrollment:
-            # RE-ENROLLMENT
-            print(f"[RE-ENROLLMENT] Reactivating enrollment")
-            student_record_id = previous_enrollment['student_record_id']
+            # Get enrollment file
+            enrollment_file = self.get_enrollment_file(class_id)
+            enrollments = self.read_json(enrollment_file) or []
+        
+            print(f"[ENROLL] Found {len(enrollments)} total enrollments")
+        
+            # Check if ACTIVELY enrolled
+            for enrollment in enrollments:
+                if enrollment.get('student_id') == student_id and enrollment.get('status') == 'active':
+                    raise ValueError("You are already enrolled in this class")
+        
+            # Check if was EVER enrolled before
+            previous_enrollment = None
+            for enrollment in enrollments:
+                if enrollment.get('student_id') == student_id:
+                    previous_enrollment = enrollment
+                    print(f"[ENROLL] Found previous enrollment (status: {enrollment.get('status')})")
+                    break
+        
+            class_file = self.get_class_file(teacher_id, class_id)
+            students = class_data.get('students', [])
+        
+            if previous_enrollment:
+                # RE-ENROLLMENT
+                print(f"[RE-ENROLLMENT] Reactivating enrollment")
+                student_record_id = previous_enrollment['student_record_id']
             
-            # Reactivate enrollment
-            previous_enrollment['status'] = 'active'
-            previous_enrollment['re_enrolled_at'] = datetime.utcnow().isoformat()
-            previous_enrollment['roll_no'] = student_info['rollNo']
-            self.write_json(enrollment_file, enrollments)
+                # Reactivate enrollment
+                previous_enrollment['status'] = 'active'
+                previous_enrollment['re_enrolled_at'] = datetime.utcnow().isoformat()
+                previous_enrollment['roll_no'] = student_info['rollNo']
+                self.write_json(enrollment_file, enrollments)
             
-            # Find student record
-            student_record = None
-            for s in students:
-                if s.get('id') == student_record_id:
-                    student_record = s
-                    break
+                # Find student record
+                student_record = None
+                for s in students:
+                    if s.get('id') == student_record_id:
+                        student_record = s
+                        break
+            
+                if student_record:
+                    attendance_count = len(student_record.get('attendance', {}))
+                    print(f"[RE-ENROLLMENT] Found record with {attendance_count} attendance entries")
+                    student_record['rollNo'] = student_info['rollNo']
+                    student_record['name'] = student_info['name']
+                else:
+                    print(f"[RE-ENROLLMENT] WARNING: Record not found, creating new")
+                    student_record = {
+                        "id": student_record_id,
+                        "rollNo": student_info['rollNo'],
+                        "name": student_info['name'],
+                        "email": student_info['email'],
+                        "attendance": {},
+                        "counts": new_counts()
+                    }
+                    students.append(student_record)
+            
+                class_data['students'] = students
+                self.write_json(class_file, class_data)
+            
+                # Update student's enrolled_classes
+                with self._locked(self.get_student_file(student_id)):
+                    student_data = self.get_student(student_id)
+                    if student_data:
+                        enrolled_classes = student_data.get('enrolled_classes', [])
+                        class_info = {
+                            "class_id": class_id,
+                            "class_name": class_data.get('name'),
+                            "teacher_name": self.get_teacher_name(teacher_id),
+                            "enrolled_at": previous_enrollment.get('enrolled_at'),
+                            "re_enrolled_at": previous_enrollment['re_enrolled_at']
+                        }
+                        if not any(ec.get('class_id') == class_id for ec in enrolled_classes):
+                            enrolled_classes.append(class_info)
+                            self.update_student(student_id, {"enrolled_classes": enrolled_classes})
+            
+                self._adjust_user_overview(teacher_id, students=1)
+                self._bump_database_stats(class_students=1)
             
-            if student_record:
                 attendance_count = len(student_record.get('attendance', {}))
-                print(f"[RE-ENROLLMENT] Found record with {attendance_count} attendance entries")
-                student_record['rollNo'] = student_info['rollNo']
-                student_record['name'] = student_info['name']
+                print(f"[RE-ENROLLMENT] ✅ SUCCESS: {attendance_count} records restored")
+                print(f"{'='*60}\n")
+            
+                return {
+                    "class_id": class_id,
+                    "student_id": student_id,
+                    "student_record_id": student_record_id,
+                    "status": "re-enrolled",
+                    "message": f"Welcome back! Your {attendance_count} attendance records have been restored."
+                }
             else:
-                print(f"[RE-ENROLLMENT] WARNING: Record not found, creating new")
-                student_record = {
-                    "id": student_record_id,
-                    "rollNo": student_info['rollNo'],
+                # NEW ENROLLMENT
+                print(f"[NEW ENROLLMENT] Creating new enrollment")
+                student_record_id = self._generate_student_record_id()
+            
+                new_enrollment = {
+                    "student_id": student_id,
+                    "student_record_id": student_record_id,
+                    "class_id": class_id,
                     "name": student_info['name'],
+                    "roll_no": student_info['rollNo'],
                     "email": student_info['email'],
-                    "attendance": {}
+                    "enrolled_at": datetime.utcnow().isoformat(),
+                    "status": "active"
                 }
-                students.append(student_record)
             
-            class_data['students'] = students
-            self.write_json(class_file, class_data)
+                enrollments.append(new_enrollment)
+                self.write_json(enrollment_file, enrollments)
             
-            # Update student's enrolled_classes
-            student_data = self.get_student(student_id)
-            if student_data:
-                enrolled_classes = student_data.get('enrolled_classes', [])
-                class_info = {
-                    "class_id": class_id,
-                    "class_name": class_data.get('name'),
-                    "teacher_name": self.get_teacher_name(teacher_id),
-                    "enrolled_at": previous_enrollment.get('enrolled_at'),
-                    "re_enrolled_at": previous_enrollment['re_enrolled_at']
+                new_student = {
+                    "id": student_record_id,
+                    "rollNo": student_info['rollNo'],
+                    "name": student_info['name'],
+                    "email": student_info['email'],
+                    "attendance": {},
+                    "counts": new_counts()
                 }
-                if not any(ec.get('class_id') == class_id for ec in enrolled_classes):
-                    enrolled_classes.append(class_info)
-                    self.update_student(student_id, {"enrolled_classes": enrolled_classes})
+                students.append(new_student)
+                class_data['students'] = students
+                self.write_json(class_file, class_data)
             
-            self.update_user_overview(teacher_id)
+                # Update student's enrolled_classes
+                with self._locked(self.get_student_file(student_id)):
+                    student_data = self.get_student(student_id)
+                    if student_data:
+                        enrolled_classes = student_data.get('enrolled_classes', [])
+                        class_info = {
+                            "class_id": class_id,
+                            "class_name": class_data.get('name'),
+                            "teacher_name": self.get_teacher_name(teacher_id),
+                            "enrolled_at": new_enrollment['enrolled_at']
+                        }
+                        enrolled_classes.append(class_info)
+                        self.update_student(student_id, {"enrolled_classes": enrolled_classes})
             
-            attendance_count = len(student_record.get('attendance', {}))
-            print(f"[RE-ENROLLMENT] ✅ SUCCESS: {attendance_count} records restored")
-            print(f"{'='*60}\n")
+                self._adjust_user_overview(teacher_id, students=1)
+                self._bump_database_stats(class_students=1)
             
-            return {
-                "class_id": class_id,
-                "student_id": student_id,
-                "student_record_id": student_record_id,
-                "status": "re-enrolled",
-                "message": f"Welcome back! Your {attendance_count} attendance records have been restored."
-            }
-        else:
-            # NEW ENROLLMENT
-            print(f"[NEW ENROLLMENT] Creating new enrollment")
-            student_record_id = self._generate_student_record_id()
-            
-            new_enrollment = {
-                "student_id": student_id,
-                "student_record_id": student_record_id,
-                "class_id": class_id,
-                "name": student_info['name'],
-                "roll_no": student_info['rollNo'],
-                "email": student_info['email'],
-                "enrolled_at": datetime.utcnow().isoformat(),
-                "status": "active"
-            }
+                print(f"[NEW ENROLLMENT] ✅ SUCCESS")
+                print(f"{'='*60}\n")
             
-            enrollments.append(new_enrollment)
-            self.write_json(enrollment_file, enrollments)
-            
-            new_student = {
-                "id": student_record_id,
-                "rollNo": student_info['rollNo'],
-                "name": student_info['name'],
-                "email": student_info['email'],
-                "attendance": {}
-            }
-            students.append(new_student)
-            class_data['students'] = students
-            self.write_json(class_file, class_data)
-            
-            # Update student's enrolled_classes
-            student_data = self.get_student(student_id)
-            if student_data:
-                enrolled_classes = student_data.get('enrolled_classes', [])
-                class_info = {
+                return {
                     "class_id": class_id,
-                    "class_name": class_data.get('name'),
-                    "teacher_name": self.get_teacher_name(teacher_id),
-                    "enrolled_at": new_enrollment['enrolled_at']
+                    "student_id": student_id,
+                    "student_record_id": student_record_id,
+                    "status": "enrolled",
+                    "message": "Successfully enrolled in class!"
                 }
-                enrolled_classes.append(class_info)
-                self.update_student(student_id, {"enrolled_classes": enrolled_classes})
-            
-            self.update_user_overview(teacher_id)
-            
-            print(f"[NEW ENROLLMENT] ✅ SUCCESS")
-            print(f"{'='*60}\n")
-            
-            return {
-                "class_id": class_id,
-                "student_id": student_id,
-                "student_record_id": student_record_id,
-                "status": "enrolled",
-                "message": "Successfully enrolled in class!"
-            }
     
     def unenroll_student(self, student_id: str, class_id: str) -> bool:
         """
@@ -836,57 +1572,53 @@ class DatabaseManager:
         print(f"{'='*60}")
         
         try:
-            # Get ALL enrollments (not just active)
-            enrollment_file = self.get_enrollment_file(class_id)
-            all_enrollments = self.read_json(enrollment_file) or []
+            with self._locked(*self._class_lock_paths(class_id)):
+                # Get ALL enrollments (not just active)
+                enrollment_file = self.get_enrollment_file(class_id)
+                all_enrollments = self.read_json(enrollment_file) or []
             
-            print(f"[UNENROLL] Found {len(all_enrollments)} total enrollments")
+                print(f"[UNENROLL] Found {len(all_enrollments)} total enrollments")
             
-            # Find active enrollment
-            found = False
-            for enrollment in all_enrollments:
-                if enrollment.get("student_id") == student_id and enrollment.get("status") == "active":
-                    found = True
-                    student_record_id = enrollment.get('student_record_id')
-                    print(f"[UNENROLL] Found active enrollment (record ID: {student_record_id})")
+                # Find active enrollment
+                found = False
+                for enrollment in all_enrollments:
+                    if enrollment.get("student_id") == student_id and enrollment.get("status") == "active":
+                        found = True
+                        student_record_id = enrollment.get('student_record_id')
+                        print(f"[UNENROLL] Found active enrollment (record ID: {student_record_id})")
                     
-                    # Check attendance data
-                    class_data = self.get_class_by_id(class_id)
-                    if class_data:
-                        for s in class_data.get('students', []):
-                            if s.get('id') == student_record_id:
-                                attendance_count = len(s.get('attendance', {}))
-                                print(f"[UNENROLL] Student has {attendance_count} attendance records (WILL BE PRESERVED)")
-                                break
+                        # Check attendance data
+                        class_data = self.get_class_by_id(class_id)
+                        if class_data:
+                            for s in class_data.get('students', []):
+                                if s.get('id') == student_record_id:
+                                    attendance_count = len(s.get('attendance', {}))
+                                    print(f"[UNENROLL] Student has {attendance_count} attendance records (WILL BE PRESERVED)")
+                                    break
                     
-                    # Mark as INACTIVE (don't delete!)
-                    enrollment['status'] = 'inactive'
-                    enrollment['unenrolled_at'] = datetime.utcnow().isoformat()
-                    print(f"[UNENROLL] ✅ Marked as INACTIVE")
-                    break
+                        # Mark as INACTIVE (don't delete!)
+                        enrollment['status'] = 'inactive'
+                        enrollment['unenrolled_at'] = datetime.utcnow().isoformat()
+                        print(f"[UNENROLL] ✅ Marked as INACTIVE")
+                        break
             
-            if not found:
-                print(f"[UNENROLL] ❌ Student not actively enrolled")
-                return False
+                if not found:
+                    print(f"[UNENROLL] ❌ Student not actively enrolled")
+                    return False
             
-            # Write back ALL enrollments (including inactive)
-            self.write_json(enrollment_file, all_enrollments)
-            print(f"[UNENROLL] Saved {len(all_enrollments)} enrollments (including inactive)")
+                # Write back ALL enrollments (including inactive)
+                self.write_json(enrollment_file, all_enrollments)
+                print(f"[UNENROLL] Saved {len(all_enrollments)} enrollments (including inactive)")
             
-            # Remove from student's enrolled_classes list
-            student_data = self.get_student(student_id)
-            if student_data:
-                enrolled_classes = student_data.get("enrolled_classes", [])
-                enrolled_classes = [ec for ec in enrolled_classes if ec.get("class_id") != class_id]
-                self.update_student(student_id, {"enrolled_classes": enrolled_classes})
+                # Remove from student's enrolled_classes list
+                self._drop_enrolled_class(student_id, class_id)
                 print(f"[UNENROLL] Updated student's enrolled_classes")
             
             # Update teacher overview
-            class_data = self.get_class_by_id(class_id)
-            if class_data:
-                teacher_id = class_data.get("teacher_id")
-                if teacher_id:
-                    self.update_user_overview(teacher_id)
+            teacher_id = self.resolve_class_teacher(class_id)
+            if teacher_id:
+                self._adjust_user_overview(teacher_id, students=-1)
+            self._bump_database_stats(class_students=-1)
             
             print(f"[UNENROLL] ✅ SUCCESS: Data preserved, student hidden from teacher")
             print(f"{'='*60}\n")
@@ -908,140 +1640,182 @@ class DatabaseManager:
         
         return active_enrollments
     
-    def get_student_enrollments(self, student_id: str) -> List[Dict[str, Any]]:
-        """Get all classes a student is enrolled in"""
-        student_data = self.get_student(student_id)
-        if not student_data:
-            return []
-        return student_data.get("enrolled_classes", [])
-    
-    def get_student_class_details(self, student_id: str, class_id: str) -> Optional[Dict[str, Any]]:
-        """Get detailed information about a student's enrollment in a class"""
-        print(f"[GET_DETAILS] Getting details for student {student_id} in class {class_id}")
-        
-        class_data = self.get_class_by_id(class_id)
-        if not class_data:
-            print(f"[GET_DETAILS] Class not found")
-            return None
-        
-        enrollments = self.get_class_enrollments(class_id)
-        student_enrollment = None
-        for e in enrollments:
-            if e.get("student_id") == student_id:
-                student_enrollment = e
-                break
-        
-        if not student_enrollment:
-            print(f"[GET_DETAILS] Student not enrolled (no active enrollment)")
-            return None
-        
-        print(f"[GET_DETAILS] Student has active enrollment")
-        
-        student_record_id = student_enrollment.get("student_record_id")
-        student_record = None
-        for student in class_data.get("students", []):
-            if student.get("id") == student_record_id:
-                student_record = student
-                print(f"[GET_DETAILS] Found student record by record_id: {student_record_id}")
-                break
-        
-        if not student_record:
-            print(f"[GET_DETAILS] Student record not found in class")
-            return None
-        
-        print(f"[GET_DETAILS] Returning class details with {len(student_record.get('attendance', {}))} attendance records")
-        
-        return {
-            "class_id": class_id,
-            "class_name": class_data.get("name", ""),
-            "teacher_id": class_data.get("teacher_id", ""),
-            "student_record": student_record,
-            "thresholds": class_data.get("thresholds"),
-            "statistics": self.calculate_student_statistics(student_record, class_data.get("thresholds"))
-        }
-    
-    def calculate_student_statistics(self, student_record: Dict[str, Any], thresholds: Optional[Dict[str, Any]]) -> Dict[str, Any]:
-        """Calculate attendance statistics for a student"""
-        if not thresholds:
-            thresholds = {
-                "excellent": 95.000,
-                "good": 90.000,
-                "moderate": 85.000,
-                "atRisk": 85.000
-            }
-        
-        attendance = student_record.get("attendance", {})
-        if not attendance:
-            return {
-                "total_classes": 0,
-                "present": 0,
-                "absent": 0,
-                "late": 0,
-                "percentage": 0.0,
-                "status": "no data"
-            }
-        
-        present = sum(1 for v in attendance.values() if v == "P")
-        absent = sum(1 for v in attendance.values() if v == "A")
-        late = sum(1 for v in attendance.values() if v == "L")
-        total = len(attendance)
-        percentage = ((present + late) / total * 100) if total > 0 else 0.0
-        
-        if percentage >= thresholds.get("excellent", 95.0):
-            status = "excellent"
-        elif percentage >= thresholds.get("good", 90.0):
-            status = "good"
-        elif percentage >= thresholds.get("moderate", 85.0):
-            status = "moderate"
-        else:
-            status = "at risk"
-        
-        return {
-            "total_classes": total,
-            "present": present,
-            "absent": absent,
-            "late": late,
-            "percentage": round(percentage, 3),
-            "status": status
-        }
-
     # ==================== CONTACT OPERATIONS ====================
     
+    def _contact_log_locked(self):
+        """One lock for the whole contact log: segment appends and their index entries"""
+        return self._locked(os.path.join(self.contact_dir, "messages"))
+
+    def _contact_segments(self) -> List[int]:
+        """Segment numbers present in the contact directory, oldest first"""
+        segments = []
+        for filename in os.listdir(self.contact_dir):
+            if filename.startswith("messages-") and filename.endswith(".jsonl"):
+                try:
+                    segments.append(int(filename[len("messages-"):-len(".jsonl")]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def _append_contact_line(self, line: bytes) -> Tuple[int, int]:
+        """Append one encoded message to the newest segment (rotating by size); returns (segment, offset)"""
+        segments = self._contact_segments()
+        segment = segments[-1] if segments else 1
+        segment_file = self.get_contact_segment_file(segment)
+        size = os.path.getsize(segment_file) if os.path.exists(segment_file) else 0
+        if size and size + len(line) > CONTACT_SEGMENT_BYTES:
+            segment += 1
+            segment_file = self.get_contact_segment_file(segment)
+
+        with open(segment_file, 'ab+') as f:
+            offset = f.seek(0, os.SEEK_END)
+            if offset:
+                # Terminate a torn line left by a crashed append before adding ours
+                f.seek(offset - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+                    offset += 1
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        return segment, offset
+
+    def _append_contact_index(self, email: Optional[str], segment: int, offset: int):
+        with open(self.get_contact_index_log(), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"email": email, "segment": segment, "offset": offset}) + "\n")
+
+    def _load_contact_index(self) -> Dict[str, List[Tuple[int, int]]]:
+        """Bring the in-memory email index up to date by reading only the new tail of the log"""
+        index_log = self.get_contact_index_log()
+        with self._index_lock:
+            try:
+                stat = os.stat(index_log)
+            except FileNotFoundError:
+                if not self._contact_segments():
+                    return {}
+                self.rebuild_contact_index()
+                stat = os.stat(index_log)
+
+            inode, position = self._contact_index_position
+            if inode != stat.st_ino or stat.st_size < position:
+                # Log was rebuilt (replaced) - start over
+                self._contact_index = {}
+                position = 0
+            if stat.st_size > position:
+                with open(index_log, 'rb') as f:
+                    f.seek(position)
+                    tail = f.read()
+                # Only consume complete lines; a partial one is picked up next time
+                complete = tail[:tail.rfind(b"\n") + 1]
+                for line in complete.splitlines():
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._contact_index.setdefault(entry.get("email"), []).append(
+                        (entry.get("segment"), entry.get("offset"))
+                    )
+                position += len(complete)
+            self._contact_index_position = (stat.st_ino, position)
+            return self._contact_index
+
+    def rebuild_contact_index(self) -> int:
+        """Rebuild the contact email index log by scanning every segment"""
+        index_log = self.get_contact_index_log()
+        with self._contact_log_locked():
+            lines = []
+            for segment in self._contact_segments():
+                offset = 0
+                with open(self.get_contact_segment_file(segment), 'rb') as f:
+                    for line in f:
+                        try:
+                            email = json.loads(line).get("email")
+                        except ValueError:
+                            email = None
+                        else:
+                            lines.append(json.dumps({"email": email, "segment": segment, "offset": offset}) + "\n")
+                        offset += len(line)
+
+            tmp_file = f"{index_log}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+            os.replace(tmp_file, index_log)
+
+        print(f"[INDEX] Rebuilt contact index: {len(lines)} messages")
+        return len(lines)
+
+    def _migrate_legacy_contacts(self):
+        """Move messages from the old single contact.json into the segment log (once)"""
+        legacy_file = os.path.join(self.contact_dir, "contact.json")
+        if not os.path.exists(legacy_file):
+            return
+        with self._contact_log_locked():
+            if not os.path.exists(legacy_file):
+                return
+            messages = self.read_json(legacy_file) or []
+            for message in messages:
+                line = (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+                segment, offset = self._append_contact_line(line)
+                self._append_contact_index(message.get("email"), segment, offset)
+            os.replace(legacy_file, f"{legacy_file}.migrated")
+        print(f"[CONTACT] Migrated {len(messages)} messages from contact.json")
+
     def save_contact_message(self, email: str, message_data: Dict[str, Any]) -> bool:
         """Save a contact form message"""
         try:
-            contact_file = os.path.join(self.contact_dir, "contact.json")
-            messages = []
-            
-            if os.path.exists(contact_file):
-                messages = self.read_json(contact_file) or []
-            
             message_entry = {
                 "email": email,
                 "timestamp": datetime.utcnow().isoformat(),
                 **message_data
             }
+            line = (json.dumps(message_entry, ensure_ascii=False) + "\n").encode("utf-8")
             
-            messages.append(message_entry)
-            self.write_json(contact_file, messages)
+            with self._contact_log_locked():
+                self._migrate_legacy_contacts()
+                segment, offset = self._append_contact_line(line)
+                self._append_contact_index(message_entry.get("email"), segment, offset)
             
             return True
         except Exception as e:
             print(f"Error saving contact message: {e}")
             return False
     
-    def get_contact_messages(self, email: Optional[str] = None) -> List[Dict[str, Any]]:
-        """Get contact messages, optionally filtered by email"""
-        contact_file = os.path.join(self.contact_dir, "contact.json")
-        if not os.path.exists(contact_file):
-            return []
-        
-        messages = self.read_json(contact_file) or []
-        
-        if email:
-            messages = [m for m in messages if m.get("email") == email]
+    def iter_contact_messages(self, email: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Stream contact messages in arrival order, optionally filtered by email via the index"""
+        self._migrate_legacy_contacts()
+        
+        if not email:
+            for segment in self._contact_segments():
+                with open(self.get_contact_segment_file(segment), 'rb') as f:
+                    for line in f:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            continue
+            return
         
-        return messages
+        locations = list(self._load_contact_index().get(email, []))
+        handles = {}
+        try:
+            for segment, offset in locations:
+                if segment not in handles:
+                    handles[segment] = open(self.get_contact_segment_file(segment), 'rb')
+                f = handles[segment]
+                f.seek(offset)
+                try:
+                    message = json.loads(f.readline())
+                except ValueError:
+                    continue
+                if message.get("email") == email:
+                    yield message
+        finally:
+            for f in handles.values():
+                f.close()
+    
+    def get_contact_messages(self, email: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get contact messages, optionally filtered by email, one page at a time"""
+        stop = None if limit is None else offset + limit
+        return list(islice(self.iter_contact_messages(email), offset, stop))
 
     # ==================== QR CODE SYSTEM ====================
 
@@ -1055,9 +1829,25 @@ class DatabaseManager:
         self.ensure_qr_sessions_dir()
         return os.path.join(self.base_dir, "qr_sessions", f"class_{class_id}.json")
 
-    def _generate_qr_code(self) -> str:
-        import random, string
-        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    def get_qr_scan_journal_file(self, class_id: str) -> str:
+        """Append-only scans of the class's active session (guarded by the session file lock)"""
+        self.ensure_qr_sessions_dir()
+        return os.path.join(self.base_dir, "qr_sessions", f"class_{class_id}.scans.jsonl")
+
+    def _merge_qr_scans(self, class_id: str, session_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Add the journaled scans to a session read from its file"""
+        scanned = list(session_data.get("scanned_students", []))
+        for entry in self._read_journal_entries(self.get_qr_scan_journal_file(class_id)):
+            if entry.get("record_id") not in scanned:
+                scanned.append(entry.get("record_id"))
+            session_data["last_scan_at"] = entry.get("ts")
+        session_data["scanned_students"] = scanned
+        return session_data
+
+    def _remove_qr_scan_journal(self, class_id: str):
+        journal_file = self.get_qr_scan_journal_file(class_id)
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
 
     def start_qr_session(self, class_id: str, teacher_id: str, rotation_interval: int = 5) -> dict:
         print(f"\n{'='*60}")
@@ -1082,7 +1872,9 @@ class DatabaseManager:
             "status": "active"
         }
         
-        self.write_json(session_file, session_data)
+        with self._locked(session_file):
+            self.write_json(session_file, session_data)
+            self._remove_qr_scan_journal(class_id)
         print(f"[QR_SESSION] ✅ Session started: {session_data['current_code']}")
         print(f"{'='*60}\n")
         return session_data
@@ -1100,46 +1892,344 @@ class DatabaseManager:
         elapsed = (datetime.now() - code_time).total_seconds()
         
         if elapsed >= session_data["rotation_interval"]:
-            session_data["current_code"] = self._generate_qr_code()
-            session_data["code_generated_at"] = datetime.now().isoformat()
-            self.write_json(session_file, session_data)
+            with self._locked(session_file):
+                # Re-read under the lock so concurrent pollers rotate only once,
+                # and rotate that copy: it has the scans and any stop since our read
+                latest = self.read_json(session_file)
+                if not latest or latest.get("status") != "active":
+                    return None
+                if latest.get("code_generated_at") != session_data["code_generated_at"]:
+                    return self._merge_qr_scans(class_id, latest)
+                latest["current_code"] = self._generate_qr_code()
+                latest["code_generated_at"] = datetime.now().isoformat()
+                self.write_json(session_file, latest)
             print(f"[QR] Auto-rotated code for {class_id}")
+            return self._merge_qr_scans(class_id, latest)
         
-        return session_data
+        return self._merge_qr_scans(class_id, session_data)
 
     # ==================== BACKUP & MAINTENANCE ====================
     
     def backup_user_data(self, user_id: str, backup_dir: str = "backups"):
-        """Create a backup of user data"""
+        """
+        Create an incremental backup of user data.
+
+        Every file is stored once in backup_dir/objects by SHA-256; the snapshot
+        directory hardlinks those objects and lists them in manifest.json. Files
+        whose (inode, mtime, size) match the previous snapshot are not even re-read.
+        """
         user_dir = self.get_user_dir(user_id)
         if not os.path.exists(user_dir):
             raise ValueError(f"User {user_id} not found")
         
-        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        backup_path = os.path.join(backup_dir, f"user_{user_id}_{timestamp}")
-        shutil.copytree(user_dir, backup_path)
+        # Fold pending attendance marks into the class files being captured
+        classes_dir = self.get_user_classes_dir(user_id)
+        if os.path.exists(classes_dir):
+            for filename in os.listdir(classes_dir):
+                if filename.startswith("class_") and filename.endswith(".json"):
+                    self.compact_attendance_journal(filename[len("class_"):-len(".json")])
+        
+        previous = self.list_backups(user_id, backup_dir)
+        previous_files = previous[-1].get("files", {}) if previous else {}
         
+        backup_path = self._new_backup_path(user_id, backup_dir)
+        
+        files = {}
+        stored = linked = 0
+        for root, _, filenames in os.walk(user_dir):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                source = os.path.join(root, filename)
+                relative = os.path.relpath(source, user_dir)
+                with open(source, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    signature = [st.st_ino, st.st_mtime_ns, st.st_size]
+                    known = previous_files.get(relative)
+                    if known and known.get("signature") == signature:
+                        digest, content = known["sha256"], None
+                    else:
+                        content = f.read()
+                        digest = hashlib.sha256(content).hexdigest()
+                
+                if content is not None and not os.path.exists(self._backup_object_path(backup_dir, digest)):
+                    self._store_backup_object(backup_dir, digest, content)
+                    stored += 1
+                else:
+                    linked += 1
+                self._link_backup_object(backup_dir, digest, content, os.path.join(backup_path, relative))
+                files[relative] = {"sha256": digest, "size": st.st_size, "signature": signature}
+        
+        self._write_backup_manifest(backup_path, {
+            "user_id": user_id,
+            "created_at": datetime.utcnow().isoformat(),
+            "files": files,
+        })
+        print(f"[BACKUP] {user_id}: {stored} new objects, {linked} unchanged files linked -> {backup_path}")
         return backup_path
-    
-    def get_database_stats(self) -> Dict[str, Any]:
-        """Get overall database statistics"""
-        total_users = len(os.listdir(self.users_dir)) if os.path.exists(self.users_dir) else 0
-        total_students = len(os.listdir(self.students_dir)) if os.path.exists(self.students_dir) else 0
+
+    def restore_user_backup(self, user_id: str, backup_path: Optional[str] = None, backup_dir: str = "backups") -> str:
+        """
+        Restore a teacher's directory from a snapshot (the latest one by default),
+        bringing the class routes, email index and stats counters along
+        """
+        backup_path, manifest = self._load_backup_manifest(user_id, backup_path, backup_dir)
         
-        total_classes = 0
-        total_class_students = 0
+        user_dir = self.get_user_dir(user_id)
+        classes_dir = self.get_user_classes_dir(user_id)
+        restored_classes = {
+            os.path.basename(relative)[len("class_"):-len(".json")]
+            for relative in manifest["files"] if relative.startswith(f"classes{os.sep}class_")
+        }
+        current_classes = set()
+        if os.path.exists(classes_dir):
+            current_classes = {
+                f[len("class_"):-len(".json")] for f in os.listdir(classes_dir)
+                if f.startswith("class_") and f.endswith(".json")
+            }
         
-        if os.path.exists(self.users_dir):
-            for user_id in os.listdir(self.users_dir):
+        lock_paths = [self.get_user_file(user_id)]
+        for class_id in restored_classes | current_classes:
+            lock_paths += [self.get_class_file(user_id, class_id), self.get_enrollment_file(class_id)]
+        
+        with self._locked(*lock_paths):
+            before = self._user_footprint(user_id)
+            old_user = self._read_user(user_id) or {}
+            for relative, entry in manifest["files"].items():
+                content = self._read_backup_file(backup_path, relative, entry)
+                target = os.path.join(user_dir, relative)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, target)
+            
+            for class_id in current_classes - restored_classes:
+                os.remove(self.get_class_file(user_id, class_id))
+                self._remove_attendance_journal(class_id)
+                self._set_class_route(class_id, None)
+            for class_id in restored_classes:
+                # Marks journaled after the snapshot must not be replayed over it
+                self._remove_attendance_journal(class_id)
+                self._set_class_route(class_id, user_id)
+            after = self._user_footprint(user_id)
+        
+        user_data = self._read_user(user_id)
+        if user_data and user_data.get("email"):
+            self._index_email(USER_EMAIL_INDEX, user_data["email"], user_id, old_email=old_user.get("email"))
+        deltas = {key: after[key] - before[key] for key in after if after[key] != before[key]}
+        if deltas:
+            self._bump_database_stats(**deltas)
+        self.invalidate_user_overview(user_id)
+        print(f"[BACKUP] Restored {user_id} from {backup_path} ({len(manifest['files'])} files)")
+        return backup_path
+
+    def migrate_to_sharded_layout(self) -> Dict[str, int]:
+        """
+        Move flat users/<id> and students/<id> trees to users/ab/cd/<id> while the app is running.
+        Each move is one rename done under the entity's file locks (and its class locks for teachers);
+        create_class/delete_class take the user file lock too, so no class appears mid-move.
+        """
+        moved = {"users": 0, "students": 0}
+        if not self.sharded_layout:
+            return moved
+        
+        for kind, root, marker in (("users", self.users_dir, "user.json"), ("students", self.students_dir, "student.json")):
+            for entity_id in list(self._iter_entity_ids(root, marker)):
+                flat = os.path.join(root, entity_id)
+                if not os.path.exists(os.path.join(flat, marker)):
+                    continue  # already sharded
+                
+                sharded = os.path.join(root, *self._shard_parts(entity_id), entity_id)
+                while True:
+                    lock_paths = self._flat_lock_paths(flat, marker)
+                    with self._locked(*lock_paths):
+                        if not os.path.exists(flat):
+                            break
+                        if self._flat_lock_paths(flat, marker) != lock_paths:
+                            continue  # a class was added before we got the locks - lock it too
+                        os.makedirs(os.path.dirname(sharded), exist_ok=True)
+                        os.rename(flat, sharded)
+                        moved[kind] += 1
+                        # A writer holding a path built before the rename may have recreated
+                        # the flat tree - fold anything it wrote into the moved one
+                        self._merge_flat_leftovers(flat, sharded)
+                    break
+        
+        print(f"[LAYOUT] Moved {moved['users']} users and {moved['students']} students to the sharded layout")
+        return moved
+
+    def _flat_lock_paths(self, flat: str, marker: str) -> List[str]:
+        """Files to lock while moving a flat entity tree: its marker file and every class file"""
+        lock_paths = [os.path.join(flat, marker)]
+        classes_dir = os.path.join(flat, "classes")
+        if os.path.isdir(classes_dir):
+            lock_paths += sorted(os.path.join(classes_dir, f) for f in os.listdir(classes_dir) if f.endswith(".json"))
+        return lock_paths
+
+    def _merge_flat_leftovers(self, flat: str, sharded: str):
+        """Move files that reappeared under a flat tree into its sharded copy (the later write wins)"""
+        if not os.path.isdir(flat):
+            return
+        for dirpath, _dirs, filenames in os.walk(flat):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                source = os.path.join(dirpath, filename)
+                target = os.path.join(sharded, os.path.relpath(source, flat))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(source, target)
+                print(f"[LAYOUT] Moved late write {source} -> {target}")
+        shutil.rmtree(flat, ignore_errors=True)
+
+    def verify_attendance_counters(self, class_id: Optional[str] = None, repair: bool = True) -> Dict[str, Any]:
+        """
+        Recount attendance counters from the marks themselves and report any drift.
+        Checks one class, or every class in the routing table; fixes drift unless repair=False.
+        """
+        class_ids = [str(class_id)] if class_id is not None else list(self._load_class_routes())
+        drifted = []
+        for cid in class_ids:
+            with self._locked(*self._class_lock_paths(cid)):
+                teacher_id = self.resolve_class_teacher(cid)
+                if not teacher_id:
+                    continue
+                # Fold pending marks in first so the snapshot holds every cell
+                self.compact_attendance_journal(cid)
+                class_file = self.get_class_file(teacher_id, cid)
+                class_data = self.read_json(class_file)
+                if class_data is None:
+                    continue
+
+                drifted_records = []
+                for student in class_data.get("students", []):
+                    counts = new_counts(student.get("attendance"))
+                    if student.get("counts") != counts:
+                        drifted_records.append(student.get("id"))
+                        student["counts"] = counts
+                totals = sum_counts(class_data.get("students", []))
+                totals_drifted = class_data.get("attendance_counts") != totals
+
+                if drifted_records or totals_drifted:
+                    drifted.append({"class_id": cid, "record_ids": drifted_records, "class_totals": totals_drifted})
+                    if repair:
+                        class_data["attendance_counts"] = totals
+                        self.write_json(class_file, class_data)
+
+        print(f"[COUNTERS] Checked {len(class_ids)} classes, {len(drifted)} with drift")
+        return {"classes_checked": len(class_ids), "drifted": drifted, "repaired": repair and bool(drifted)}
+    
+    def _bump_database_stats(self, **deltas: int):
+        """Apply deltas to the persisted stats counters (no-op until they are first built)"""
+        stats_file = self.get_index_file(DATABASE_STATS_INDEX)
+        with self._locked(stats_file):
+            stats = self.read_json(stats_file)
+            if stats is None:
+                return
+            for key, delta in deltas.items():
+                stats[key] = stats.get(key, 0) + delta
+            stats["updated_at"] = datetime.utcnow().isoformat()
+            self.write_json(stats_file, stats)
+
+    def reconcile_database_stats(self) -> Dict[str, Any]:
+        """Recount the stats counters from disk, persist them and report any drift"""
+        stats_file = self.get_index_file(DATABASE_STATS_INDEX)
+        with self._locked(stats_file):
+            user_ids = list(self._iter_user_ids())
+            total_users = len(user_ids)
+            total_students = sum(1 for _ in self._iter_student_ids())
+            
+            total_classes = 0
+            total_class_students = 0
+            
+            for user_id in user_ids:
                 classes = self.get_all_classes(user_id)
                 total_classes += len(classes)
                 for cls in classes:
                     total_class_students += len(cls.get("students", []))
+            
+            counted = {
+                "users": total_users,
+                "students": total_students,
+                "classes": total_classes,
+                "class_students": total_class_students,
+            }
+            previous = self.read_json(stats_file) or {}
+            drift = {k: v - previous[k] for k, v in counted.items() if k in previous and previous[k] != v}
+            self.write_json(stats_file, {**counted, "updated_at": datetime.utcnow().isoformat()})
+        
+        if drift:
+            print(f"[STATS] Reconciled counters, drift: {drift}")
+        return {**counted, "drift": drift}
+
+    def get_database_stats(self) -> Dict[str, Any]:
+        """Get overall database statistics from the maintained counters"""
+        stats = self.read_json(self.get_index_file(DATABASE_STATS_INDEX))
+        if stats is None:
+            stats = self.reconcile_database_stats()
         
         return {
-            "total_users": total_users,
-            "total_students": total_students,
-            "total_classes": total_classes,
-            "total_class_students": total_class_students,
+            "total_users": stats.get("users", 0),
+            "total_students": stats.get("students", 0),
+            "total_classes": stats.get("classes", 0),
+            "total_class_students": stats.get("class_students", 0),
             "timestamp": datetime.utcnow().isoformat()
-        }
\ No newline at end of file
+        }
+
+
+def create_database_manager(engine: Optional[str] = None, base_dir: Optional[str] = None, **kwargs) -> StorageEngine:
+    """
+    Build the storage engine selected by configuration.
+
+    DB_ENGINE picks "json" (file per entity, the default) or "sqlite";
+    DB_DATA_DIR sets the data directory and DB_CODEC the JSON engine's file format.
+    """
+    engine = engine or os.getenv("DB_ENGINE", "json")
+    base_dir = base_dir or os.getenv("DB_DATA_DIR", "data")
+
+    if engine == "json":
+        kwargs.setdefault("codec", os.getenv("DB_CODEC", "json"))
+        return DatabaseManager(base_dir, **kwargs)
+    if engine == "sqlite":
+        from sqlite_db_manager import SQLiteDatabaseManager
+        return SQLiteDatabaseManager(base_dir, **kwargs)
+    raise ValueError(f"Unknown DB_ENGINE '{engine}' (expected 'json' or 'sqlite')")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="File database maintenance commands")
+    parser.add_argument("--data-dir", default="data", help="Database base directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild-indexes", help="Rebuild the email, class routing and contact indexes from disk")
+    backup_parser = subparsers.add_parser("backup", help="Incremental backup of every teacher")
+    backup_parser.add_argument("--backup-dir", default="backups")
+    backup_parser.add_argument("--workers", type=int, default=BACKUP_WORKERS)
+    backup_parser.add_argument("--keep", type=int, default=BACKUP_KEEP, help="Snapshots to keep per teacher")
+    subparsers.add_parser("shard-layout", help="Move flat user/student directories to the sharded layout")
+    subparsers.add_parser("reconcile-stats", help="Recount the get_database_stats counters from disk")
+    verify_parser = subparsers.add_parser("verify-counters", help="Recount attendance counters and fix drift")
+    verify_parser.add_argument("--dry-run", action="store_true", help="Only report drift")
+    convert_parser = subparsers.add_parser("convert", help="Rewrite every data file in another format")
+    convert_parser.add_argument("--codec", required=True, help="json, compact-json or msgpack")
+    args = parser.parse_args()
+
+    db = DatabaseManager(args.data_dir, codec=getattr(args, "codec", "json"))
+    if args.command == "convert":
+        print({"converted": db.convert_storage()})
+    elif args.command == "rebuild-indexes":
+        print(db.rebuild_email_indexes())
+        print({"classes": db.rebuild_class_routes()})
+        print({"contact_messages": db.rebuild_contact_index()})
+    elif args.command == "backup":
+        print(db.backup_all_users(args.backup_dir, max_workers=args.workers))
+        print(db.prune_backups(keep=args.keep, backup_dir=args.backup_dir))
+    elif args.command == "shard-layout":
+        print(db.migrate_to_sharded_layout())
+    elif args.command == "reconcile-stats":
+        print(db.reconcile_database_stats())
+    elif args.command == "verify-counters":
+        print(db.verify_attendance_counters(repair=not args.dry_run))
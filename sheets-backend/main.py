@@ -1,28 +1,53 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Tuple
 import json
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import calendar
 import jwt
 import hashlib
+import hmac
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import random
 import string
+import time
 from dotenv import load_dotenv
 import ssl
 from supabase_client import supabase
+from db_executor import db_call, db_executor, fetch_one
+from ttl_cache import MISSING, TTLCache
+from qr_sessions import qr_broker, qr_registry
+import asyncio
 import traceback
+from contextlib import asynccontextmanager
 
 
 load_dotenv()
 
 
-app = FastAPI(title="Lernova Attendsheets API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """QR registry and broker background work, then the Supabase pool drained on shutdown"""
+    try:
+        await qr_registry.load_active()
+    except Exception as e:
+        print(f"[QR_REGISTRY] Could not load active sessions: {e}")
+    qr_registry.start_background()
+    try:
+        yield
+    finally:
+        await qr_broker.close()
+        await qr_registry.close()
+        db_executor.shutdown()
+
+
+app = FastAPI(title="Lernova Attendsheets API", lifespan=lifespan)
 
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
@@ -35,6 +60,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -46,6 +72,30 @@ security = HTTPBearer()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+DB_INSERT_CHUNK_SIZE = int(os.getenv("DB_INSERT_CHUNK_SIZE", "500"))  # rows per bulk insert/upsert
+# Rows per paged select; must not exceed PostgREST's max-rows (1000 by default)
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", "1000"))
+
+# GET /classes paging and projection
+CLASS_LIST_MAX_LIMIT = 200
+CLASS_LIST_FIELDS = {
+    "id", "teacher_id", "name", "custom_columns", "thresholds",
+    "statistics", "created_at", "updated_at",
+}
+CLASS_SUMMARY_FIELDS = ["id", "name", "updated_at"]
+
+# Identity cache for get_teacher_by_email / get_student_by_email
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "60"))
+IDENTITY_NEGATIVE_TTL = float(os.getenv("IDENTITY_NEGATIVE_TTL", "5"))  # "no such user"
+# How long a user's current token version is trusted before it is re-read
+TOKEN_VERSION_CACHE_TTL = float(os.getenv("TOKEN_VERSION_CACHE_TTL", "60"))
+
+# QR scan hot path (session timings live in qr_sessions.py)
+QR_ROSTER_CACHE_TTL = float(os.getenv("QR_ROSTER_CACHE_TTL", "30"))
+# Lifetime of the ticket that opens a QR session event stream
+QR_STREAM_TICKET_TTL = int(os.getenv("QR_STREAM_TICKET_TTL", "60"))
+QR_STREAM_SCOPE = "qr_stream"
 
 
 # Email Configuration
@@ -167,42 +217,127 @@ def student_from_row(row: dict) -> Optional[Dict[str, Any]]:
     }
 
 
-def get_teacher_by_email(email: str) -> Optional[Dict[str, Any]]:
+# (table, email) -> teacher/student dict, or None when no such user exists
+identity_cache = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL, name="identities")
+
+
+async def _get_identity(table: str, email: str, from_row, fresh: bool) -> Optional[Dict[str, Any]]:
+    key = (table, email)
+    if not fresh:
+        cached = identity_cache.get(key)
+        if cached is not MISSING:
+            return dict(cached) if cached else None
+    row = await fetch_one(
+        supabase
+        .table(table)
+        .select("*")
+        .eq("email", email)
+    )
+    user = from_row(row) if row else None
+    # Misses are kept only briefly, enough to absorb repeated bad-token requests
+    identity_cache.set(key, user, ttl=None if user else IDENTITY_NEGATIVE_TTL)
+    return dict(user) if user else None
+
+
+def invalidate_identity(email: str):
+    """Drop cached teacher/student entries after a change to that account"""
+    identity_cache.invalidate(("teachers", email))
+    identity_cache.invalidate(("students", email))
+
+
+async def get_teacher_by_email(email: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
     try:
-        res = (
-            supabase
-            .table("teachers")
-            .select("*")
-            .eq("email", email)
-            .maybe_single()
-            .execute()
-        )
-        if res is None:
-            print(f"ERROR: Supabase execute() returned None for email {email}")
-            return None
-        return teacher_from_row(res.data) if res.data else None
+        return await _get_identity("teachers", email, teacher_from_row, fresh)
     except Exception as e:
         print(f"ERROR in get_teacher_by_email: {e}")
         return None
 
-def get_student_by_email(email: str) -> Optional[Dict[str, Any]]:
+async def get_student_by_email(email: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
     try:
-        res = (
-            supabase
-            .table("students")
-            .select("*")
-            .eq("email", email)
-            .maybe_single()
-            .execute()
-        )
-        if res is None:
-            print(f"ERROR: Supabase execute() returned None for email {email}")
-            return None
-        return student_from_row(res.data) if res.data else None
+        return await _get_identity("students", email, student_from_row, fresh)
     except Exception as e:
         print(f"ERROR in get_student_by_email: {e}")
         return None
 
+
+def resolve_date_range(
+    date_from: Optional[str], date_to: Optional[str], month: Optional[str]
+) -> Tuple[Optional[str], Optional[str]]:
+    """Validated (from, to) ISO dates from from/to or month=YYYY-MM; (None, None) = full history"""
+    try:
+        if month:
+            if date_from or date_to:
+                raise ValueError("use either month or from/to, not both")
+            year, month_num = (int(part) for part in month.split("-"))
+            last_day = calendar.monthrange(year, month_num)[1]
+            return date(year, month_num, 1).isoformat(), date(year, month_num, last_day).isoformat()
+
+        start = date.fromisoformat(date_from).isoformat() if date_from else None
+        end = date.fromisoformat(date_to).isoformat() if date_to else None
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid date range ({e}); expected from/to=YYYY-MM-DD or month=YYYY-MM",
+        )
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="from must not be after to")
+    return start, end
+
+
+def chunk_rows(rows: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Split rows into DB_INSERT_CHUNK_SIZE batches"""
+    chunk_size = max(1, DB_INSERT_CHUNK_SIZE)
+    return [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+
+async def bulk_insert(table: str, rows: List[Dict[str, Any]]) -> int:
+    """Insert rows as DB_INSERT_CHUNK_SIZE multi-row inserts run concurrently; returns the round trips"""
+    chunks = chunk_rows(rows)
+    await asyncio.gather(*(db_call(supabase.table(table).insert(chunk)) for chunk in chunks))
+    return len(chunks)
+
+
+async def bulk_upsert(
+    table: str, rows: List[Dict[str, Any]], on_conflict: str, ignore_duplicates: bool = False
+) -> int:
+    """
+    Upsert rows on the on_conflict key in concurrent batches; returns the round trips.
+    PostgREST needs a unique constraint on exactly those columns (see
+    migrations/001_upsert_conflict_keys.sql)
+    """
+    chunks = chunk_rows(rows)
+    await asyncio.gather(
+        *(
+            db_call(
+                supabase.table(table).upsert(
+                    chunk, on_conflict=on_conflict, ignore_duplicates=ignore_duplicates
+                )
+            )
+            for chunk in chunks
+        )
+    )
+    return len(chunks)
+
+
+async def fetch_all(build_query: Callable[[], Any], *order_by: str) -> List[Dict[str, Any]]:
+    """
+    Every row of a select, read in DB_PAGE_SIZE pages - a single response is
+    cut off at PostgREST's max-rows. build_query makes a fresh query per page;
+    order_by must identify rows uniquely so pages neither overlap nor skip
+    """
+    page_size = max(1, DB_PAGE_SIZE)
+    rows: List[Dict[str, Any]] = []
+    while True:
+        query = build_query()
+        for column in order_by:
+            query = query.order(column)
+        res = await db_call(query.range(len(rows), len(rows) + page_size - 1))
+        page = res.data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+
+
 def get_password_hash(password: str) -> str:
     """Hash a password using SHA-256"""
     return hashlib.sha256(password.encode()).hexdigest()
@@ -225,6 +360,62 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+def token_version(user: Dict[str, Any]) -> str:
+    """
+    Version claim of a user's tokens. It is derived from the stored password
+    hash, so changing or resetting the password revokes every older token
+    """
+    message = f"{user['id']}:{user['password']}".encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()[:16]
+
+
+def create_user_token(user: Dict[str, Any], role: str) -> str:
+    """Access token carrying the user id, role and token version"""
+    return create_access_token(
+        data={
+            "sub": user["email"],
+            "uid": user["id"],
+            "role": role,
+            "ver": token_version(user),
+            "iat": int(time.time()),
+        },
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    )
+
+
+def create_stream_ticket(user_id: str, class_id: int) -> str:
+    """
+    Short-lived token that only opens one class's QR event stream. EventSource
+    can't send headers, so this goes in the URL instead of the access token
+    """
+    now = datetime.utcnow()
+    return jwt.encode(
+        {
+            "sub": user_id,
+            "scope": QR_STREAM_SCOPE,
+            "cid": class_id,
+            "iat": now,
+            "exp": now + timedelta(seconds=QR_STREAM_TICKET_TTL),
+        },
+        SECRET_KEY,
+        algorithm=ALGORITHM,
+    )
+
+
+def decode_stream_ticket(ticket: str, class_id: int) -> str:
+    """User id of a valid stream ticket for class_id, 401 otherwise"""
+    try:
+        payload = jwt.decode(ticket, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        payload = {}
+    if payload.get("scope") != QR_STREAM_SCOPE or payload.get("cid") != class_id or not payload.get("sub"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired stream ticket",
+        )
+    return str(payload["sub"])
+
+
 def generate_verification_code() -> str:
     """Generate a 6-digit verification code"""
     return ''.join(random.choices(string.digits, k=6))
@@ -461,18 +652,17 @@ def send_password_reset_email(to_email: str, code: str, name: str):
         return False
 
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Verify JWT token and return user email"""
+def decode_access_payload(token: str) -> Dict[str, Any]:
+    """Verify an access JWT and return its claims (scoped tickets are not access tokens)"""
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = str(payload.get("sub"))
-        if email is None:
+        if payload.get("sub") is None or payload.get("scope"):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid authentication credentials",
             )
-        return email
+        payload["sub"] = str(payload["sub"])
+        return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -485,6 +675,110 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
         )
 
 
+# user id -> (current token version or None once the account is deleted, unix time it was read)
+token_version_cache = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=TOKEN_VERSION_CACHE_TTL, name="token_versions")
+
+
+def bump_token_version(user: Dict[str, Any], new_password_hash: Optional[str]):
+    """Record a password change (or, with None, a deleted account) so older tokens stop working here at once"""
+    if new_password_hash is None:
+        token_version_cache.set(user["id"], (None, time.time()))
+    else:
+        token_version_cache.set(
+            user["id"], (token_version({**user, "password": new_password_hash}), time.time())
+        )
+
+
+async def resolve_principal(token: str) -> Dict[str, Any]:
+    """
+    {"id", "email", "role"} of a token's user, taken from its verified claims.
+    The database is only read when no token version is cached, or when the
+    token was issued after the cached version was read (a password change on
+    another worker); a token older than a differing cached version is
+    rejected straight away. Tokens issued before uid/ver claims existed can't
+    be revoked, so they are refused and the user has to sign in again
+    """
+    payload = decode_access_payload(token)
+    email = payload["sub"]
+    role = payload.get("role") or "teacher"
+    lookup = get_student_by_email if role == "student" else get_teacher_by_email
+
+    uid, ver = payload.get("uid"), payload.get("ver")
+    if not uid or not ver:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Session expired, please sign in again",
+        )
+
+    cached = token_version_cache.get(uid)
+    issued_at = payload.get("iat") or 0
+    if cached is MISSING or (cached[0] != ver and issued_at >= int(cached[1])):
+        user = await lookup(email, fresh=True)
+        current = token_version(user) if user and user["id"] == uid else None
+        token_version_cache.set(uid, (current, time.time()))
+    else:
+        current = cached[0]
+    if current != ver:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token has been revoked",
+        )
+    return {"id": uid, "email": email, "role": role}
+
+
+async def get_principal(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
+    """Dependency: the authenticated user's id, email and role"""
+    return await resolve_principal(credentials.credentials)
+
+
+async def verify_token(principal: Dict[str, Any] = Depends(get_principal)) -> str:
+    """Dependency: the authenticated user's email (checked like get_principal)"""
+    return principal["email"]
+
+
+def require_role(principal: Dict[str, Any], role: str) -> Dict[str, Any]:
+    """The principal when it has role, otherwise the 404 the email lookups used to give"""
+    if principal["role"] != role:
+        raise HTTPException(status_code=404, detail="User not found")
+    return principal
+
+
+def principal_table(principal: Dict[str, Any]) -> str:
+    return "students" if principal["role"] == "student" else "teachers"
+
+
+async def get_principal_user(principal: Dict[str, Any], fresh: bool = False) -> Dict[str, Any]:
+    """Full teacher/student record of the principal, 404 when it no longer exists"""
+    lookup = get_student_by_email if principal["role"] == "student" else get_teacher_by_email
+    user = await lookup(principal["email"], fresh=fresh)
+    if not user or user["id"] != principal["id"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return user
+
+
+# ==================== QR ROSTER CACHE ====================
+
+# class_id -> {student_id: student_record_id} of the active enrollments
+qr_roster_cache = TTLCache(maxsize=1024, ttl=QR_ROSTER_CACHE_TTL, name="qr_rosters")
+
+
+async def get_class_roster(class_id: int, fresh: bool = False) -> Dict[str, int]:
+    """student_id -> student_record_id of a class's active enrollments, cached"""
+    if not fresh:
+        cached = qr_roster_cache.get(class_id)
+        if cached is not MISSING:
+            return cached
+    res = await db_call(
+        supabase.table("class_enrollments")
+        .select("student_id, student_record_id")
+        .eq("class_id", class_id)
+        .eq("status", "active")
+    )
+    roster = {e["student_id"]: e["student_record_id"] for e in (res.data or []) if e.get("student_id")}
+    qr_roster_cache.set(class_id, roster)
+    return roster
+
+
 # ==================== API ENDPOINTS ====================
 
 
@@ -502,9 +796,11 @@ def read_root():
 async def get_stats():
     """Get database statistics from Supabase"""
     try:
-        teachers_res = supabase.table("teachers").select("id", count="exact").execute()
-        students_res = supabase.table("students").select("id", count="exact").execute()
-        classes_res = supabase.table("classes").select("id", count="exact").execute()
+        teachers_res, students_res, classes_res = await asyncio.gather(
+            db_call(supabase.table("teachers").select("id", count="exact")),
+            db_call(supabase.table("students").select("id", count="exact")),
+            db_call(supabase.table("classes").select("id", count="exact")),
+        )
         
         return {
             "total_teachers": teachers_res.count or 0,
@@ -519,13 +815,26 @@ async def get_stats():
             detail="Failed to fetch statistics"
         )
 
+
+@app.get("/stats/db-pool")
+async def get_db_pool_stats():
+    """Occupancy of the thread pool that runs Supabase calls"""
+    return db_executor.stats()
+
+
+@app.get("/stats/caches")
+async def get_cache_stats():
+    """Hit rates of the in-process caches"""
+    return [identity_cache.stats(), qr_registry.stats(), qr_broker.stats(), qr_roster_cache.stats()]
+
+
 # ==================== AUTH ENDPOINTS (TEACHER + SHARED) ====================
 
 @app.post("/auth/signup")
 async def signup(request: SignupRequest):
     """Sign up a new teacher"""
     try:
-        existing_user = get_teacher_by_email(request.email)
+        existing_user = await get_teacher_by_email(request.email)
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -607,7 +916,7 @@ async def verify_email(request: VerifyEmailRequest):
                 "role": "student",
                 "created_at": datetime.utcnow().isoformat(),
             }
-            supabase.table("students").insert(row).execute()
+            await db_call(supabase.table("students").insert(row))
         else:
             user_id = f"user_{int(datetime.utcnow().timestamp())}"
             row = {
@@ -624,14 +933,12 @@ async def verify_email(request: VerifyEmailRequest):
                 },
                 "created_at": datetime.utcnow().isoformat(),
             }
-            supabase.table("teachers").insert(row).execute()
+            await db_call(supabase.table("teachers").insert(row))
 
         del verification_codes[request.email]
+        invalidate_identity(request.email)
 
-        access_token = create_access_token(
-            data={"sub": request.email, "role": role},
-            expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
-        )
+        access_token = create_user_token(row, role)
 
         return TokenResponse(
             access_token=access_token,
@@ -653,7 +960,8 @@ async def verify_email(request: VerifyEmailRequest):
 @app.post("/auth/login", response_model=TokenResponse)
 async def login(request: LoginRequest):
     """Login teacher"""
-    user = get_teacher_by_email(request.email)
+    # Checked against the database so a password changed on another worker applies at once
+    user = await get_teacher_by_email(request.email, fresh=True)
 
     if not user or not verify_password(request.password, user["password"]):
         raise HTTPException(
@@ -661,10 +969,7 @@ async def login(request: LoginRequest):
             detail="Invalid email or password",
         )
 
-    access_token = create_access_token(
-        data={"sub": request.email, "role": "teacher"},
-        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
-    )
+    access_token = create_user_token(user, "teacher")
 
     return TokenResponse(
         access_token=access_token,
@@ -677,8 +982,8 @@ async def resend_verification(request: ResendVerificationRequest):
     """Resend verification code"""
     try:
         if request.email not in verification_codes:
-            existing_teacher = get_teacher_by_email(request.email)
-            existing_student = get_student_by_email(request.email)
+            existing_teacher = await get_teacher_by_email(request.email)
+            existing_student = await get_student_by_email(request.email)
             if existing_teacher or existing_student:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
@@ -723,7 +1028,7 @@ async def resend_verification(request: ResendVerificationRequest):
 @app.post("/auth/request-password-reset")
 async def request_password_reset(request: PasswordResetRequest):
     """Request password reset code (teacher or student)"""
-    user = get_teacher_by_email(request.email) or get_student_by_email(request.email)
+    user = await get_teacher_by_email(request.email) or await get_student_by_email(request.email)
 
     # Do not reveal whether email exists
     code = generate_verification_code()
@@ -768,33 +1073,38 @@ async def reset_password(request: VerifyResetCodeRequest):
             detail="Password must be at least 8 characters",
         )
 
-    user = get_teacher_by_email(request.email)
+    password_hash = get_password_hash(request.new_password)
+    user = await get_teacher_by_email(request.email)
     if user:
-        supabase.table("teachers").update(
+        await db_call(supabase.table("teachers").update(
             {
-                "password": get_password_hash(request.new_password),
+                "password": password_hash,
                 "updated_at": datetime.utcnow().isoformat(),
             }
-        ).eq("id", user["id"]).execute()
+        ).eq("id", user["id"]))
+        bump_token_version(user, password_hash)
     else:
-        student = get_student_by_email(request.email)
+        student = await get_student_by_email(request.email)
         if student:
-            supabase.table("students").update(
+            await db_call(supabase.table("students").update(
                 {
-                    "password": get_password_hash(request.new_password),
+                    "password": password_hash,
                     "updated_at": datetime.utcnow().isoformat(),
                 }
-            ).eq("id", student["id"]).execute()
+            ).eq("id", student["id"]))
+            bump_token_version(student, password_hash)
 
+    invalidate_identity(request.email)
     del password_reset_codes[request.email]
     return {"success": True, "message": "Password reset successfully"}
 
 
 @app.post("/auth/change-password")
 async def change_password(
-    request: ChangePasswordRequest, email: str = Depends(verify_token)
+    request: ChangePasswordRequest, principal: Dict[str, Any] = Depends(get_principal)
 ):
     """Change password for logged-in user - supports both teachers and students"""
+    email = principal["email"]
     if email not in password_reset_codes:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -823,37 +1133,30 @@ async def change_password(
             detail="Password must be at least 8 characters",
         )
 
-    user = get_teacher_by_email(email)
-    if user:
-        supabase.table("teachers").update(
-            {
-                "password": get_password_hash(request.new_password),
-                "updated_at": datetime.utcnow().isoformat(),
-            }
-        ).eq("id", user["id"]).execute()
-        del password_reset_codes[email]
-        return {"success": True, "message": "Password changed successfully"}
-
-    student = get_student_by_email(email)
-    if student:
-        supabase.table("students").update(
-            {
-                "password": get_password_hash(request.new_password),
-                "updated_at": datetime.utcnow().isoformat(),
-            }
-        ).eq("id", student["id"]).execute()
-        del password_reset_codes[email]
-        return {"success": True, "message": "Password changed successfully"}
-
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    user = await get_principal_user(principal)
+    password_hash = get_password_hash(request.new_password)
+    await db_call(supabase.table(principal_table(principal)).update(
+        {
+            "password": password_hash,
+            "updated_at": datetime.utcnow().isoformat(),
+        }
+    ).eq("id", principal["id"]))
+    invalidate_identity(email)
+    bump_token_version(user, password_hash)
+    del password_reset_codes[email]
+    # The caller's own token was just revoked - hand back a replacement
+    return {
+        "success": True,
+        "message": "Password changed successfully",
+        "access_token": create_user_token({**user, "password": password_hash}, principal["role"]),
+    }
 
 
 @app.post("/auth/request-change-password")
-async def request_change_password(email: str = Depends(verify_token)):
+async def request_change_password(principal: Dict[str, Any] = Depends(get_principal)):
     """Request verification code for password change - supports both teachers and students"""
-    user = get_teacher_by_email(email) or get_student_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    user = await get_principal_user(principal)
+    email = principal["email"]
 
     code = generate_verification_code()
     print(f"Password change code for {email}: {code}")
@@ -869,67 +1172,42 @@ async def request_change_password(email: str = Depends(verify_token)):
 
 @app.put("/auth/update-profile")
 async def update_profile(
-    request: UpdateProfileRequest, email: str = Depends(verify_token)
+    request: UpdateProfileRequest, principal: Dict[str, Any] = Depends(get_principal)
 ):
     """Update user profile - supports both teachers and students"""
-    user = get_teacher_by_email(email)
-    if user:
-        supabase.table("teachers").update(
-            {"name": request.name, "updated_at": datetime.utcnow().isoformat()}
-        ).eq("id", user["id"]).execute()
-        updated = get_teacher_by_email(email)
-        return UserResponse(
-            id=updated["id"], email=updated["email"], name=updated["name"]
-        )
-
-    student = get_student_by_email(email)
-    if student:
-        supabase.table("students").update(
-            {"name": request.name, "updated_at": datetime.utcnow().isoformat()}
-        ).eq("id", student["id"]).execute()
-        updated = get_student_by_email(email)
-        return UserResponse(
-            id=updated["id"], email=updated["email"], name=updated["name"]
-        )
-
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    await get_principal_user(principal)
+    await db_call(supabase.table(principal_table(principal)).update(
+        {"name": request.name, "updated_at": datetime.utcnow().isoformat()}
+    ).eq("id", principal["id"]))
+    invalidate_identity(principal["email"])
+    updated = await get_principal_user(principal, fresh=True)
+    return UserResponse(
+        id=updated["id"], email=updated["email"], name=updated["name"]
+    )
 
 
 @app.post("/auth/logout")
-async def logout(email: str = Depends(verify_token)):
+async def logout(principal: Dict[str, Any] = Depends(get_principal)):
     """Logout user (stateless JWT)"""
     return {"success": True, "message": "Logged out successfully"}
 
 
 @app.get("/auth/me", response_model=UserResponse)
-async def get_current_user(email: str = Depends(verify_token)):
+async def get_current_user(principal: Dict[str, Any] = Depends(get_principal)):
     """Get current user info (teacher or student)"""
-    user = get_teacher_by_email(email) or get_student_by_email(email)
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
-        )
-        
+    user = await get_principal_user(principal)
     return UserResponse(id=user["id"], email=user["email"], name=user["name"])
 
 
 @app.delete("/auth/delete-account")
-async def delete_account(email: str = Depends(verify_token)):
+async def delete_account(principal: Dict[str, Any] = Depends(get_principal)):
     """Delete user account (teacher or student) and related data"""
     try:
-        user = get_teacher_by_email(email)
-        if user:
-            supabase.table("teachers").delete().eq("id", user["id"]).execute()
-            return {"success": True, "message": "Account deleted successfully"}
-
-        student = get_student_by_email(email)
-        if student:
-            supabase.table("students").delete().eq("id", student["id"]).execute()
-            return {"success": True, "message": "Account deleted successfully"}
-
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
-        )
+        user = await get_principal_user(principal)
+        await db_call(supabase.table(principal_table(principal)).delete().eq("id", principal["id"]))
+        invalidate_identity(principal["email"])
+        bump_token_version(user, None)
+        return {"success": True, "message": "Account deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
@@ -943,20 +1221,68 @@ async def delete_account(email: str = Depends(verify_token)):
 # ==================== CLASS ENDPOINTS ====================
 
 @app.get("/classes")
-async def get_classes(email: str = Depends(verify_token)):
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def get_classes(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[int] = None,
+    fields: Optional[str] = None,
+    summary: bool = False,
+    principal: Dict[str, Any] = Depends(get_principal),
+):
+    """
+    Classes of the teacher, ordered by id.
+
+    limit pages the list (keyset on id): pass the X-Next-Cursor response header
+    back as cursor for the next page; no header means the last page.
+    fields is a comma-separated projection from CLASS_LIST_FIELDS, summary
+    returns only id, name and updated_at. Without parameters every class
+    is returned in full, as before.
+    """
+    user = require_role(principal, "teacher")
+
+    if summary:
+        columns = list(CLASS_SUMMARY_FIELDS)
+    elif fields:
+        columns = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in columns if f not in CLASS_LIST_FIELDS]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown field(s): {', '.join(unknown)} (allowed: {', '.join(sorted(CLASS_LIST_FIELDS))})",
+            )
+        if "id" not in columns:
+            columns.insert(0, "id")  # needed for the cursor
+    else:
+        columns = ["*"]
+
+    if limit is not None and not 1 <= limit <= CLASS_LIST_MAX_LIMIT:
+        raise HTTPException(
+            status_code=400, detail=f"limit must be between 1 and {CLASS_LIST_MAX_LIMIT}"
+        )
+
+    query = (
+        supabase.table("classes")
+        .select(",".join(columns))
+        .eq("teacher_id", user["id"])
+        .order("id")
+    )
+    if cursor is not None:
+        query = query.gt("id", cursor)
+    if limit is not None:
+        # One extra row tells whether another page follows
+        query = query.limit(limit + 1)
 
-    res = supabase.table("classes").select("*").eq("teacher_id", user["id"]).execute()
-    return res.data or []
+    res = await db_call(query)
+    rows = res.data or []
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1]["id"])
+    return rows
 
 
 @app.post("/classes")
-async def create_class(class_data: ClassRequest, email: str = Depends(verify_token)):
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def create_class(class_data: ClassRequest, principal: Dict[str, Any] = Depends(get_principal)):
+    user = require_role(principal, "teacher")
 
     class_id = class_data.id
     thresholds = class_data.thresholds or {}
@@ -972,71 +1298,102 @@ async def create_class(class_data: ClassRequest, email: str = Depends(verify_tok
         "statistics": None,
     }
 
-    supabase.table("classes").insert(class_row).execute()
+    await db_call(supabase.table("classes").insert(class_row))
 
+    enroll_rows = []
+    attendance_rows = []
     for s in class_data.students:
         student_record_id = int(s["id"])
-        enroll_row = {
-            "class_id": class_id,
-            "student_id": s.get("studentId") or "",
-            "student_record_id": student_record_id,
-            "name": s["name"],
-            "roll_no": s.get("rollNo"),
-            "email": s.get("email"),
-            "status": "active",
-        }
-        supabase.table("class_enrollments").insert(enroll_row).execute()
+        enroll_rows.append(
+            {
+                "class_id": class_id,
+                "student_id": s.get("studentId") or "",
+                "student_record_id": student_record_id,
+                "name": s["name"],
+                "roll_no": s.get("rollNo"),
+                "email": s.get("email"),
+                "status": "active",
+            }
+        )
 
         attendance = s.get("attendance") or {}
         for date_str, status_val in attendance.items():
-            supabase.table("attendance_entries").insert(
+            attendance_rows.append(
                 {
                     "class_id": class_id,
                     "student_record_id": student_record_id,
                     "attendance_date": date_str,
                     "status": status_val,
                 }
-            ).execute()
+            )
 
-    return {"success": True, "class": class_row}
+    # Attendance rows reference the enrollments, so those go in first
+    enroll_trips = await bulk_insert("class_enrollments", enroll_rows)
+    attendance_trips = await bulk_insert("attendance_entries", attendance_rows)
+
+    return {
+        "success": True,
+        "class": class_row,
+        "rows_inserted": 1 + len(enroll_rows) + len(attendance_rows),
+        "round_trips": 1 + enroll_trips + attendance_trips,
+    }
 
 @app.get("/classes/{class_id}")
-async def get_class(class_id: str, email: str = Depends(verify_token)):
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def get_class(
+    class_id: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    month: Optional[str] = None,
+    principal: Dict[str, Any] = Depends(get_principal),
+):
+    """
+    A class with its active students and their attendance.
+
+    from/to (YYYY-MM-DD, either end optional) or month=YYYY-MM limit the
+    attendance to that range; without them the full history is returned
+    """
+    user = require_role(principal, "teacher")
 
     class_id_int = int(class_id)
+    range_from, range_to = resolve_date_range(date_from, date_to, month)
 
-    class_res = (
-        supabase.table("classes")
-        .select("*")
-        .eq("id", class_id_int)
-        .eq("teacher_id", user["id"])
-        .maybe_single()
+    # Ownership is checked before anything is returned, so both can load at once
+    class_row, enroll_res = await asyncio.gather(
+        fetch_one(
+            supabase.table("classes")
+            .select("*")
+            .eq("id", class_id_int)
+            .eq("teacher_id", user["id"])
+        ),
+        db_call(
+            supabase.table("class_enrollments")
+            .select("*")
+            .eq("class_id", class_id_int)
+            .eq("status", "active")
+        ),
     )
-    if not class_res.data:
+    if not class_row:
         raise HTTPException(status_code=404, detail="Class not found")
 
-    enroll_res = (
-        supabase.table("class_enrollments")
-        .select("*")
-        .eq("class_id", class_id_int)
-        .eq("status", "active")
-        .execute()
-    )
     enrollments = enroll_res.data or []
 
     student_record_ids = [e["student_record_id"] for e in enrollments]
-    if student_record_ids:
-        att_res = (
+
+    def attendance_query():
+        att_query = (
             supabase.table("attendance_entries")
-            .select("*")
+            .select("student_record_id, attendance_date, status")
             .eq("class_id", class_id_int)
             .in_("student_record_id", student_record_ids)
-            .execute()
         )
-        attendance_rows = att_res.data or []
+        if range_from:
+            att_query = att_query.gte("attendance_date", range_from)
+        if range_to:
+            att_query = att_query.lte("attendance_date", range_to)
+        return att_query
+
+    if student_record_ids:
+        attendance_rows = await fetch_all(attendance_query, "attendance_date", "student_record_id")
     else:
         attendance_rows = []
 
@@ -1060,147 +1417,189 @@ async def get_class(class_id: str, email: str = Depends(verify_token)):
             }
         )
 
-    payload = class_res.data
+    payload = class_row
     payload["students"] = students_payload
+    if range_from or range_to:
+        payload["attendance_range"] = {"from": range_from, "to": range_to}
     return payload
 
 @app.put("/classes/{class_id}")
 async def update_class(
     class_id: str,
     class_data: ClassRequest,
-    email: str = Depends(verify_token),
+    principal: Dict[str, Any] = Depends(get_principal),
 ):
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    user = require_role(principal, "teacher")
 
     class_id_int = int(class_id)
 
     # Ensure class belongs to this teacher
-    class_res = (
+    class_row = await fetch_one(
         supabase.table("classes")
         .select("*")
         .eq("id", class_id_int)
         .eq("teacher_id", user["id"])
-        .maybe_single()
     )
-    if not class_res.data:
+    if not class_row:
         raise HTTPException(status_code=404, detail="Class not found")
 
-    # 1) Update basic class fields
-    supabase.table("classes").update(
-        {
-            "name": class_data.name,
-            "custom_columns": class_data.customColumns,
-            "thresholds": class_data.thresholds or {},
-            "updated_at": datetime.utcnow().isoformat(),
-        }
-    ).eq("id", class_id_int).execute()
+    # Only stored cells on the dates the payload carries can differ from it
+    payload_dates = sorted({d for s in class_data.students for d in (s.get("attendance") or {})})
 
-    # 2) Sync enrollments (active list = class_data.students)
-    enroll_res = (
-        supabase.table("class_enrollments")
-        .select("*")
-        .eq("class_id", class_id_int)
-        .execute()
+    async def load_attendance() -> List[Dict[str, Any]]:
+        if not payload_dates:
+            return []
+        return await fetch_all(
+            lambda: supabase.table("attendance_entries")
+            .select("student_record_id, attendance_date, status")
+            .eq("class_id", class_id_int)
+            .gte("attendance_date", payload_dates[0])
+            .lte("attendance_date", payload_dates[-1]),
+            "attendance_date",
+            "student_record_id",
+        )
+
+    # 1) Update basic class fields while the current enrollments and attendance load
+    _, enrollment_rows, attendance_rows_stored = await asyncio.gather(
+        db_call(supabase.table("classes").update(
+            {
+                "name": class_data.name,
+                "custom_columns": class_data.customColumns,
+                "thresholds": class_data.thresholds or {},
+                "updated_at": datetime.utcnow().isoformat(),
+            }
+        ).eq("id", class_id_int)),
+        fetch_all(
+            lambda: supabase.table("class_enrollments")
+            .select("*")
+            .eq("class_id", class_id_int),
+            "student_record_id",
+        ),
+        load_attendance(),
     )
-    existing_enrollments = {e["student_record_id"]: e for e in (enroll_res.data or [])}
+    # fetch_all reads len // DB_PAGE_SIZE + 1 pages
+    reads = [enrollment_rows] + ([attendance_rows_stored] if payload_dates else [])
+    round_trips = 1 + sum(len(rows) // max(1, DB_PAGE_SIZE) + 1 for rows in reads)
+
+    # 2) Sync enrollments (active list = class_data.students)
+    existing_enrollments = {e["student_record_id"]: e for e in enrollment_rows}
 
     incoming_ids = set(int(s["id"]) for s in class_data.students)
     existing_ids = set(existing_enrollments.keys())
 
-    # Newly added students
+    new_enrollments = []
+    changed_enrollments = []
     for s in class_data.students:
         srid = int(s["id"])
         if srid not in existing_ids:
-            enroll_row = {
-                "class_id": class_id_int,
-                "student_id": s.get("studentId") or "",
-                "student_record_id": srid,
-                "name": s["name"],
-                "roll_no": s.get("rollNo"),
-                "email": s.get("email"),
-                "status": "active",
-                "enrolled_at": datetime.utcnow().isoformat(),
-            }
-            supabase.table("class_enrollments").insert(enroll_row).execute()
-        else:
-            # Existing: update basic info and ensure status active
-            supabase.table("class_enrollments").update(
+            new_enrollments.append(
                 {
+                    "class_id": class_id_int,
+                    "student_id": s.get("studentId") or "",
+                    "student_record_id": srid,
                     "name": s["name"],
                     "roll_no": s.get("rollNo"),
                     "email": s.get("email"),
                     "status": "active",
+                    "enrolled_at": datetime.utcnow().isoformat(),
                 }
-            ).eq("class_id", class_id_int).eq("student_record_id", srid).execute()
+            )
+            continue
+
+        # Existing: update basic info and ensure status active, only when something changed
+        row = {
+            "class_id": class_id_int,
+            "student_record_id": srid,
+            "name": s["name"],
+            "roll_no": s.get("rollNo"),
+            "email": s.get("email"),
+            "status": "active",
+        }
+        current = existing_enrollments[srid]
+        if any(current.get(k) != row[k] for k in ("name", "roll_no", "email", "status")):
+            changed_enrollments.append(row)
+
+    round_trips += await bulk_insert("class_enrollments", new_enrollments)
+    round_trips += await bulk_upsert(
+        "class_enrollments", changed_enrollments, "class_id,student_record_id"
+    )
 
     # Students removed in UI → mark inactive (do NOT delete)
-    deleted_ids = existing_ids - incoming_ids
+    deleted_ids = [
+        srid for srid in existing_ids - incoming_ids
+        if existing_enrollments[srid].get("status") == "active"
+    ]
     if deleted_ids:
-        supabase.table("class_enrollments").update(
+        await db_call(supabase.table("class_enrollments").update(
             {
                 "status": "inactive",
                 "unenrolled_at": datetime.utcnow().isoformat(),
             }
-        ).eq("class_id", class_id_int).in_("student_record_id", list(deleted_ids)).execute()
+        ).eq("class_id", class_id_int).in_("student_record_id", deleted_ids))
+        round_trips += 1
 
-    # 3) Sync attendance map for each student
+    if new_enrollments or changed_enrollments or deleted_ids:
+        qr_roster_cache.invalidate(class_id_int)
+
+    # 3) Sync attendance: upsert only the cells that differ from what is stored
+    existing_attendance = {
+        (row["student_record_id"], str(row["attendance_date"])): row["status"]
+        for row in attendance_rows_stored
+    }
+    attendance_rows = []
     for s in class_data.students:
         srid = int(s["id"])
         attendance = s.get("attendance") or {}
         for date_str, status_val in attendance.items():
-            # Upsert row for (class_id, student_record_id, date)
-            existing_att = (
-                supabase.table("attendance_entries")
-                .select("id")
-                .eq("class_id", class_id_int)
-                .eq("student_record_id", srid)
-                .eq("attendance_date", date_str)
-                .maybe_single()
+            if existing_attendance.get((srid, date_str)) == status_val:
+                continue
+            attendance_rows.append(
+                {
+                    "class_id": class_id_int,
+                    "student_record_id": srid,
+                    "attendance_date": date_str,
+                    "status": status_val,
+                }
             )
-            if existing_att.data:
-                supabase.table("attendance_entries").update(
-                    {"status": status_val}
-                ).eq("id", existing_att.data["id"]).execute()
-            else:
-                supabase.table("attendance_entries").insert(
-                    {
-                        "class_id": class_id_int,
-                        "student_record_id": srid,
-                        "attendance_date": date_str,
-                        "status": status_val,
-                    }
-                ).execute()
 
-    return {"success": True}
+    round_trips += await bulk_upsert(
+        "attendance_entries", attendance_rows, "class_id,student_record_id,attendance_date"
+    )
+
+    return {
+        "success": True,
+        "enrollments_added": len(new_enrollments),
+        "enrollments_updated": len(changed_enrollments),
+        "enrollments_deactivated": len(deleted_ids),
+        "attendance_written": len(attendance_rows),
+        "round_trips": round_trips,
+    }
 
 @app.delete("/classes/{class_id}")
-async def delete_class(class_id: str, email: str = Depends(verify_token)):
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def delete_class(class_id: str, principal: Dict[str, Any] = Depends(get_principal)):
+    user = require_role(principal, "teacher")
 
     class_id_int = int(class_id)
 
     # Ensure class belongs to this teacher
-    class_res = (
+    class_row = await fetch_one(
         supabase.table("classes")
         .select("id, teacher_id")
         .eq("id", class_id_int)
-        .maybe_single()
     )
-    if not class_res.data or class_res.data["teacher_id"] != user["id"]:
+    if not class_row or class_row["teacher_id"] != user["id"]:
         raise HTTPException(status_code=404, detail="Class not found or unauthorized")
 
     # Delete related data (foreign keys are ON DELETE CASCADE, but this is explicit)
-    supabase.table("attendance_entries").delete().eq("class_id", class_id_int).execute()
-    supabase.table("class_enrollments").delete().eq("class_id", class_id_int).execute()
-    supabase.table("qr_scanned_students").delete().eq("class_id", class_id_int).execute()
-    supabase.table("qr_sessions").delete().eq("class_id", class_id_int).execute()
+    await db_call(supabase.table("attendance_entries").delete().eq("class_id", class_id_int))
+    await db_call(supabase.table("class_enrollments").delete().eq("class_id", class_id_int))
+    await db_call(supabase.table("qr_scanned_students").delete().eq("class_id", class_id_int))
+    await db_call(supabase.table("qr_sessions").delete().eq("class_id", class_id_int))
 
     # Finally delete the class
-    supabase.table("classes").delete().eq("id", class_id_int).execute()
+    await db_call(supabase.table("classes").delete().eq("id", class_id_int))
+    qr_registry.forget(class_id_int)
+    qr_roster_cache.invalidate(class_id_int)
 
     return {"success": True, "message": "Class deleted successfully"}
 
@@ -1208,7 +1607,7 @@ async def delete_class(class_id: str, email: str = Depends(verify_token)):
     # ==================== QR CODE ATTENDANCE ENDPOINTS ====================
 
 @app.post("/qr/start-session")
-async def start_qr_session(request: dict, email: str = Depends(verify_token)):
+async def start_qr_session(request: dict, principal: Dict[str, Any] = Depends(get_principal)):
     class_id = request.get("class_id")
     rotation_interval = int(request.get("rotation_interval", 5))
 
@@ -1217,168 +1616,141 @@ async def start_qr_session(request: dict, email: str = Depends(verify_token)):
 
     print(f"[API] QR start request: class_id={class_id}")
 
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    user = require_role(principal, "teacher")
 
     class_id_int = int(class_id)
 
     # Verify class belongs to this teacher
-    class_res = (
+    class_row = await fetch_one(
         supabase.table("classes")
         .select("id, teacher_id")
         .eq("id", class_id_int)
-        .maybe_single()
     )
-    if not class_res.data or class_res.data["teacher_id"] != user["id"]:
+    if not class_row or class_row["teacher_id"] != user["id"]:
         raise HTTPException(status_code=404, detail="Class not found or unauthorized")
 
-    today = datetime.utcnow().date()
-    # You can replace this with your own QR code generator if you prefer letters+digits
-    qr_code = generate_verification_code()
-
-    session_row = {
-        "class_id": class_id_int,
-        "teacher_id": user["id"],
-        "started_at": datetime.utcnow().isoformat(),
-        "rotation_interval": rotation_interval,
-        "current_code": qr_code,
-        "code_generated_at": datetime.utcnow().isoformat(),
-        "attendance_date": today.isoformat(),
-        "status": "active",
-        "last_scan_at": None,
-        "stopped_at": None,
-    }
-
-    # Upsert session for this class
-    existing = (
-        supabase.table("qr_sessions")
-        .select("class_id")
-        .eq("class_id", class_id_int)
-        .maybe_single()
-    )
-    if existing.data:
-        supabase.table("qr_sessions").update(session_row).eq("class_id", class_id_int).execute()
-        supabase.table("qr_scanned_students").delete().eq("class_id", class_id_int).execute()
-    else:
-        supabase.table("qr_sessions").insert(session_row).execute()
+    session = await qr_registry.start(class_id_int, user["id"], rotation_interval)
+    qr_roster_cache.invalidate(class_id_int)
 
-    return {"success": True, "session": session_row}
+    return {"success": True, "session": session}
 
 @app.get("/qr/session/{class_id}")
-async def get_qr_session(class_id: str, email: str = Depends(verify_token)):
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def get_qr_session(class_id: str, principal: Dict[str, Any] = Depends(get_principal)):
+    user = require_role(principal, "teacher")
 
     class_id_int = int(class_id)
 
-    session_res = (
-        supabase.table("qr_sessions")
-        .select("*")
-        .eq("class_id", class_id_int)
-        .eq("status", "active")
-        .maybe_single()
-    )
-    session = session_res.data
+    session = await qr_registry.get(class_id_int)
     if not session or session["teacher_id"] != user["id"]:
         return {"active": False}
 
     return {"active": True, "session": session}
 
+@app.post("/qr/session/{class_id}/stream-ticket")
+async def create_qr_stream_ticket(class_id: str, principal: Dict[str, Any] = Depends(get_principal)):
+    """Ticket for GET /qr/session/{class_id}/stream, valid QR_STREAM_TICKET_TTL seconds"""
+    user = require_role(principal, "teacher")
+
+    class_id_int = int(class_id)
+
+    session = await qr_registry.get(class_id_int)
+    if not session or session["teacher_id"] != user["id"]:
+        raise HTTPException(status_code=404, detail="No active session")
+
+    return {"ticket": create_stream_ticket(user["id"], class_id_int), "expires_in": QR_STREAM_TICKET_TTL}
+
+@app.get("/qr/session/{class_id}/stream")
+async def stream_qr_session(class_id: str, request: Request, ticket: str):
+    """
+    Server-sent events for a running QR session: "session" (full state),
+    "code" (rotation), "scan" (new scanned_count) and "end".
+    EventSource cannot send headers, so this takes a ?ticket= from
+    POST /qr/session/{class_id}/stream-ticket rather than the access token
+    """
+    class_id_int = int(class_id)
+    user_id = decode_stream_ticket(ticket, class_id_int)
+
+    session = await qr_registry.get(class_id_int)
+    if not session or session["teacher_id"] != user_id:
+        raise HTTPException(status_code=404, detail="No active session")
+
+    async def event_stream():
+        async for event, data in qr_broker.events(class_id_int):
+            if await request.is_disconnected():
+                break
+            if event == "ping":
+                yield ": ping\n\n"
+                continue
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/qr/scan")
 async def scan_qr_code(
     class_id: str,
     qr_code: str,
-    email: str = Depends(verify_token),
+    principal: Dict[str, Any] = Depends(get_principal),
 ):
     """
     Student scans QR code to mark attendance
     """
     try:
-        student = get_student_by_email(email)
-        if not student:
+        if principal["role"] != "student":
             raise HTTPException(status_code=404, detail="Student not found")
+        student = principal
 
         class_id_int = int(class_id)
 
-        # Load active session
-        session_res = (
-            supabase.table("qr_sessions")
-            .select("*")
-            .eq("class_id", class_id_int)
-            .eq("status", "active")
-            .maybe_single()
-        )
-        session = session_res.data
-        if not session:
-            raise HTTPException(status_code=400, detail="No active session")
-
-        if session["current_code"] != qr_code:
-            raise HTTPException(status_code=400, detail="Invalid or expired QR code")
+        # The session is served from memory and the roster from a short-lived cache;
+        # an unknown student is re-checked against the database before being rejected
+        try:
+            session = await qr_registry.check_code(class_id_int, qr_code)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
         attendance_date = session["attendance_date"]
 
         # Find enrollment for this student in this class to get student_record_id
-        enroll_res = (
-            supabase.table("class_enrollments")
-            .select("*")
-            .eq("class_id", class_id_int)
-            .eq("student_id", student["id"])
-            .eq("status", "active")
-            .maybe_single()
-        )
-        enrollment = enroll_res.data
-        if not enrollment:
+        student_record_id = (await get_class_roster(class_id_int)).get(student["id"])
+        if student_record_id is None:
+            student_record_id = (await get_class_roster(class_id_int, fresh=True)).get(student["id"])
+        if student_record_id is None:
             raise HTTPException(
                 status_code=400,
                 detail="Student not actively enrolled in this class",
             )
 
-        student_record_id = enrollment["student_record_id"]
-
-        # Mark attendance as Present
-        existing_att = (
-            supabase.table("attendance_entries")
-            .select("id")
-            .eq("class_id", class_id_int)
-            .eq("student_record_id", student_record_id)
-            .eq("attendance_date", attendance_date)
-            .maybe_single()
-        )
-        if existing_att.data:
-            supabase.table("attendance_entries").update(
-                {"status": "P"}
-            ).eq("id", existing_att.data["id"]).execute()
-        else:
-            supabase.table("attendance_entries").insert(
-                {
-                    "class_id": class_id_int,
-                    "student_record_id": student_record_id,
-                    "attendance_date": attendance_date,
-                    "status": "P",
-                }
-            ).execute()
-
-        # Record scan
-        existing_scan = (
-            supabase.table("qr_scanned_students")
-            .select("id")
-            .eq("class_id", class_id_int)
-            .eq("student_record_id", student_record_id)
-            .maybe_single()
+        # Mark attendance as Present and record the scan - both idempotent, in one round trip
+        await asyncio.gather(
+            db_call(
+                supabase.table("attendance_entries").upsert(
+                    {
+                        "class_id": class_id_int,
+                        "student_record_id": student_record_id,
+                        "attendance_date": attendance_date,
+                        "status": "P",
+                    },
+                    on_conflict="class_id,student_record_id,attendance_date",
+                )
+            ),
+            db_call(
+                supabase.table("qr_scanned_students").upsert(
+                    {
+                        "class_id": class_id_int,
+                        "student_record_id": student_record_id,
+                    },
+                    on_conflict="class_id,student_record_id",
+                    ignore_duplicates=True,
+                )
+            ),
         )
-        if not existing_scan.data:
-            supabase.table("qr_scanned_students").insert(
-                {
-                    "class_id": class_id_int,
-                    "student_record_id": student_record_id,
-                }
-            ).execute()
 
-        supabase.table("qr_sessions").update(
-            {"last_scan_at": datetime.utcnow().isoformat()}
-        ).eq("class_id", class_id_int).execute()
+        # Scan count is updated in memory; last_scan_at is written by the registry in batches
+        qr_registry.record_scan(class_id_int, student_record_id)
 
         return {
             "success": True,
@@ -1399,80 +1771,67 @@ async def scan_qr_code(
         )
 
 @app.post("/qr/stop-session")
-async def stop_qr_session(payload: dict, email: str = Depends(verify_token)):
+async def stop_qr_session(payload: dict, principal: Dict[str, Any] = Depends(get_principal)):
     class_id = payload.get("class_id")
     if not class_id:
         raise HTTPException(status_code=400, detail="class_id required")
 
-    user = get_teacher_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    user = require_role(principal, "teacher")
 
     class_id_int = int(class_id)
 
     try:
-        session_res = (
-            supabase.table("qr_sessions")
-            .select("*")
-            .eq("class_id", class_id_int)
-            .eq("status", "active")
-            .maybe_single()
-        )
-        session = session_res.data
+        session = await qr_registry.get(class_id_int, fresh=True)
         if not session or session["teacher_id"] != user["id"]:
             raise HTTPException(status_code=400, detail="No active session or unauthorized")
 
         attendance_date = session["attendance_date"]
 
-        # Active enrollments
-        enroll_res = (
-            supabase.table("class_enrollments")
-            .select("student_record_id")
-            .eq("class_id", class_id_int)
-            .eq("status", "active")
-            .execute()
-        )
-        active_ids = [e["student_record_id"] for e in (enroll_res.data or [])]
-
-        # Scanned IDs
-        scan_res = (
-            supabase.table("qr_scanned_students")
-            .select("student_record_id")
-            .eq("class_id", class_id_int)
-            .execute()
-        )
-        scanned_ids = {r["student_record_id"] for r in (scan_res.data or [])}
-
-        absent_count = 0
-        for srid in active_ids:
-            if srid in scanned_ids:
-                continue
-
-            existing_att = (
+        # Active enrollments, scanned ids and the ids already marked for the date, in parallel
+        enroll_res, scan_res, marked_res = await asyncio.gather(
+            db_call(
+                supabase.table("class_enrollments")
+                .select("student_record_id")
+                .eq("class_id", class_id_int)
+                .eq("status", "active")
+            ),
+            db_call(
+                supabase.table("qr_scanned_students")
+                .select("student_record_id")
+                .eq("class_id", class_id_int)
+            ),
+            db_call(
                 supabase.table("attendance_entries")
-                .select("id, status")
+                .select("student_record_id")
                 .eq("class_id", class_id_int)
-                .eq("student_record_id", srid)
                 .eq("attendance_date", attendance_date)
-                .maybe_single()
-            )
-            if existing_att.data:
-                # already marked (e.g. P/L) – do not override
-                continue
+            ),
+        )
+        active_ids = [e["student_record_id"] for e in (enroll_res.data or [])]
+        scanned_ids = {r["student_record_id"] for r in (scan_res.data or [])}
+        # already marked (e.g. P/L) – do not override
+        marked_ids = {r["student_record_id"] for r in (marked_res.data or [])}
 
-            supabase.table("attendance_entries").insert(
-                {
-                    "class_id": class_id_int,
-                    "student_record_id": srid,
-                    "attendance_date": attendance_date,
-                    "status": "A",
-                }
-            ).execute()
-            absent_count += 1
+        absent_rows = [
+            {
+                "class_id": class_id_int,
+                "student_record_id": srid,
+                "attendance_date": attendance_date,
+                "status": "A",
+            }
+            for srid in active_ids
+            if srid not in scanned_ids and srid not in marked_ids
+        ]
+        # ignore_duplicates keeps a mark that lands between the read and this write
+        await bulk_upsert(
+            "attendance_entries",
+            absent_rows,
+            "class_id,student_record_id,attendance_date",
+            ignore_duplicates=True,
+        )
+        absent_count = len(absent_rows)
 
-        supabase.table("qr_sessions").update(
-            {"status": "stopped", "stopped_at": datetime.utcnow().isoformat()}
-        ).eq("class_id", class_id_int).execute()
+        await qr_registry.stop(class_id_int)
 
         return {
             "success": True,
@@ -1501,7 +1860,7 @@ async def submit_contact(request: ContactRequest):
             "status": "unread"
         }
         
-        supabase.table("contact_messages").insert(message_data).execute()
+        await db_call(supabase.table("contact_messages").insert(message_data))
         
         return {"success": True, "message": "Message received successfully"}
     
@@ -0,0 +1,40 @@
+-- Unique keys behind the on_conflict targets of the bulk upserts in main.py.
+-- PostgREST rejects an upsert whose on_conflict columns have no unique
+-- constraint or index, so apply this before deploying the bulk writes:
+--   class_enrollments    (class_id, student_record_id)                   PUT /classes/{id}
+--   attendance_entries   (class_id, student_record_id, attendance_date)  PUT /classes/{id}, /qr/scan, /qr/stop-session
+--   qr_scanned_students  (class_id, student_record_id)                   /qr/scan
+-- Safe to re-run. Duplicates written by the older insert-only code are
+-- dropped first, keeping one row per key.
+
+BEGIN;
+
+DELETE FROM class_enrollments a
+USING class_enrollments b
+WHERE a.class_id = b.class_id
+  AND a.student_record_id = b.student_record_id
+  AND a.ctid < b.ctid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS class_enrollments_class_record_key
+    ON class_enrollments (class_id, student_record_id);
+
+DELETE FROM attendance_entries a
+USING attendance_entries b
+WHERE a.class_id = b.class_id
+  AND a.student_record_id = b.student_record_id
+  AND a.attendance_date = b.attendance_date
+  AND a.ctid < b.ctid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS attendance_entries_class_record_date_key
+    ON attendance_entries (class_id, student_record_id, attendance_date);
+
+DELETE FROM qr_scanned_students a
+USING qr_scanned_students b
+WHERE a.class_id = b.class_id
+  AND a.student_record_id = b.student_record_id
+  AND a.ctid < b.ctid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS qr_scanned_students_class_record_key
+    ON qr_scanned_students (class_id, student_record_id);
+
+COMMIT;
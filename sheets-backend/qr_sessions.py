@@ -0,0 +1,538 @@
+"""In-process registry of active QR attendance sessions"""
+import asyncio
+import os
+import random
+import string
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from db_executor import db_call, fetch_one
+from supabase_client import supabase
+from ttl_cache import MISSING, TTLCache
+
+# Sessions this worker does not own are re-read from the database at most this often,
+# and the scans of the ones it owns are re-read this often
+QR_SESSION_CACHE_TTL = float(os.getenv("QR_SESSION_CACHE_TTL", "2"))
+# Sessions nobody has read or scanned for this long are dropped from memory
+QR_SESSION_IDLE_TTL = float(os.getenv("QR_SESSION_IDLE_TTL", "1800"))
+# The code that was just rotated out is still accepted for this long
+QR_CODE_GRACE_SECONDS = float(os.getenv("QR_CODE_GRACE_SECONDS", "2"))
+QR_LAST_SCAN_FLUSH_SECONDS = float(os.getenv("QR_LAST_SCAN_FLUSH_SECONDS", "5"))
+QR_REGISTRY_TICK_SECONDS = 1.0
+# Streams send a keep-alive this often so proxies do not close idle connections
+QR_STREAM_HEARTBEAT_SECONDS = float(os.getenv("QR_STREAM_HEARTBEAT_SECONDS", "15"))
+QR_STREAM_QUEUE_SIZE = 32
+
+
+def new_qr_code() -> str:
+    """6-digit session code"""
+    return ''.join(random.choices(string.digits, k=6))
+
+
+def _parse_ts(value: Optional[str]) -> Optional[datetime]:
+    """Naive UTC datetime from an ISO timestamp as written by us or returned by Postgres"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class _Entry:
+    """A session held in memory, plus the ids that have scanned into it"""
+
+    def __init__(self, session: Dict[str, Any], scanned: List[int], owned: bool):
+        self.session = session
+        self.scanned = set(scanned)
+        self.owned = owned
+        self.loaded_at = time.monotonic()
+        self.last_access = self.loaded_at
+        self.previous_code: Optional[str] = None
+        self.previous_valid_until = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        session = dict(self.session)
+        session["scanned_students"] = sorted(self.scanned)
+        session["scanned_count"] = len(self.scanned)
+        return session
+
+    def code_age(self) -> float:
+        generated_at = _parse_ts(self.session.get("code_generated_at"))
+        if generated_at is None:
+            return float("inf")
+        return (datetime.utcnow() - generated_at).total_seconds()
+
+
+class QRSessionRegistry:
+    """
+    Active QR sessions, served from memory.
+
+    The worker that starts a session owns it: it rotates the code every
+    rotation_interval seconds and persists each rotation. Other workers read the
+    session from the database at most every QR_SESSION_CACHE_TTL seconds, and
+    adopt it when its code has not rotated for two intervals (owner gone).
+    Rotations compare-and-swap on the current code, so of several workers
+    adopting at once exactly one becomes the owner.
+    Scans update the in-memory count at once; last_scan_at is coalesced. The
+    owner re-reads the scan list every QR_SESSION_CACHE_TTL seconds, so scans
+    handled by other workers reach its count and its stream events too.
+    """
+
+    def __init__(self):
+        self._entries: Dict[int, _Entry] = {}
+        # class_id -> None for classes known to have no active session
+        self._inactive = TTLCache(maxsize=4096, ttl=QR_SESSION_CACHE_TTL, name="qr_inactive")
+        # class_id -> latest scan time not yet written to qr_sessions.last_scan_at
+        self._pending_last_scan: Dict[int, str] = {}
+        self._last_flush = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._rotations = 0
+        self._db_reads = 0
+        self._memory_reads = 0
+        self._evictions = 0
+        self._listeners: List[Callable[[int], None]] = []
+
+    def add_listener(self, listener: Callable[[int], None]):
+        """listener(class_id) is called whenever a session changes in this worker"""
+        self._listeners.append(listener)
+
+    def _notify(self, class_id: int):
+        for listener in self._listeners:
+            listener(class_id)
+
+    # ---- Lifecycle ----------------------------------------------------------
+
+    async def load_active(self):
+        """Pick up the sessions that were active before this worker started"""
+        res = await db_call(supabase.table("qr_sessions").select("*").eq("status", "active"))
+        for session in res.data or []:
+            await self._load(int(session["class_id"]), session)
+        print(f"[QR_REGISTRY] Loaded {len(res.data or [])} active session(s)")
+
+    def start_background(self):
+        """Run rotation, eviction and last_scan_at flushing on the current loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush_last_scan_times()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(QR_REGISTRY_TICK_SECONDS)
+            try:
+                await self._tick()
+            except Exception as e:
+                print(f"[QR_REGISTRY] Error: {e}")
+
+    async def _tick(self):
+        now = time.monotonic()
+        stale_scans = []
+        for class_id, entry in list(self._entries.items()):
+            if now - entry.last_access > QR_SESSION_IDLE_TTL:
+                self._entries.pop(class_id, None)
+                self._evictions += 1
+                continue
+
+            interval = max(1, int(entry.session.get("rotation_interval") or 5))
+            if not entry.owned:
+                if entry.code_age() < 2 * interval:
+                    continue
+                # Looks orphaned - re-check, then rotate; only the worker whose
+                # rotation lands takes the session over
+                entry = await self._load(class_id)
+                if entry is None or entry.code_age() < 2 * interval:
+                    continue
+                if await self._rotate(class_id, entry):
+                    print(f"[QR_REGISTRY] Adopted session for class {class_id}")
+                continue
+
+            if entry.code_age() >= interval:
+                await self._rotate(class_id, entry)
+            if now - entry.loaded_at >= QR_SESSION_CACHE_TTL:
+                stale_scans.append((class_id, entry))
+
+        if stale_scans:
+            await asyncio.gather(*(self._refresh_scans(cid, e) for cid, e in stale_scans))
+
+        if now - self._last_flush >= QR_LAST_SCAN_FLUSH_SECONDS:
+            self._last_flush = now
+            await self.flush_last_scan_times()
+
+    # ---- Reads --------------------------------------------------------------
+
+    async def _load(self, class_id: int, session: Optional[Dict[str, Any]] = None) -> Optional[_Entry]:
+        """(Re)load a session and its scans from the database; keeps ownership"""
+        self._db_reads += 1
+        if session is None:
+            session = await fetch_one(
+                supabase.table("qr_sessions")
+                .select("*")
+                .eq("class_id", class_id)
+                .eq("status", "active")
+            )
+        if not session:
+            self._entries.pop(class_id, None)
+            self._inactive.set(class_id, None)
+            return None
+
+        scan_res = await db_call(
+            supabase.table("qr_scanned_students")
+            .select("student_record_id")
+            .eq("class_id", class_id)
+        )
+        scanned = [r["student_record_id"] for r in (scan_res.data or [])]
+
+        previous = self._entries.get(class_id)
+        entry = _Entry(session, scanned, owned=False)
+        same_session = previous is not None and (
+            _parse_ts(previous.session.get("started_at")) == _parse_ts(session.get("started_at"))
+        )
+        if same_session:
+            entry.owned = previous.owned
+            entry.scanned |= previous.scanned
+            entry.last_access = previous.last_access
+            if previous.session.get("current_code") != session.get("current_code"):
+                entry.previous_code = previous.session.get("current_code")
+                entry.previous_valid_until = time.monotonic() + QR_CODE_GRACE_SECONDS
+            else:
+                entry.previous_code = previous.previous_code
+                entry.previous_valid_until = previous.previous_valid_until
+        self._entries[class_id] = entry
+        self._inactive.invalidate(class_id)
+        return entry
+
+    async def _refresh_scans(self, class_id: int, entry: _Entry):
+        """Merge scans recorded by other workers into an owned session"""
+        self._db_reads += 1
+        entry.loaded_at = time.monotonic()
+        try:
+            scan_res = await db_call(
+                supabase.table("qr_scanned_students")
+                .select("student_record_id")
+                .eq("class_id", class_id)
+            )
+        except Exception as e:
+            print(f"[QR_REGISTRY] Failed to refresh scans for class {class_id}: {e}")
+            return
+        if self._entries.get(class_id) is not entry:
+            return  # stopped or restarted while we were reading
+        before = len(entry.scanned)
+        entry.scanned.update(r["student_record_id"] for r in (scan_res.data or []))
+        if len(entry.scanned) != before:
+            self._notify(class_id)
+
+    async def _entry(self, class_id: int, fresh: bool = False) -> Optional[_Entry]:
+        entry = self._entries.get(class_id)
+        if not fresh:
+            if entry is not None and (entry.owned or time.monotonic() - entry.loaded_at < QR_SESSION_CACHE_TTL):
+                self._memory_reads += 1
+                entry.last_access = time.monotonic()
+                return entry
+            if entry is None and self._inactive.get(class_id) is not MISSING:
+                self._memory_reads += 1
+                return None
+        entry = await self._load(class_id)
+        if entry is not None:
+            entry.last_access = time.monotonic()
+        return entry
+
+    async def get(self, class_id: int, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        """Active session of a class with its scanned_students, or None"""
+        entry = await self._entry(class_id, fresh)
+        return entry.snapshot() if entry is not None else None
+
+    async def check_code(self, class_id: int, code: str) -> Optional[Dict[str, Any]]:
+        """
+        The active session when code is valid for it.
+
+        Raises ValueError("No active session") or ValueError("Invalid or expired QR code").
+        A mismatch against a session this worker does not own is re-read once,
+        in case the owner rotated in the meantime.
+        """
+        entry = await self._entry(class_id)
+        if entry is None or (not self._code_matches(entry, code) and not entry.owned):
+            entry = await self._entry(class_id, fresh=True)
+        if entry is None:
+            raise ValueError("No active session")
+        if not self._code_matches(entry, code):
+            raise ValueError("Invalid or expired QR code")
+        return entry.session
+
+    def _code_matches(self, entry: _Entry, code: str) -> bool:
+        if entry.session.get("current_code") == code:
+            return True
+        return entry.previous_code == code and time.monotonic() < entry.previous_valid_until
+
+    # ---- State changes (persisted) ------------------------------------------
+
+    async def start(self, class_id: int, teacher_id: str, rotation_interval: int) -> Dict[str, Any]:
+        """Start (or restart) the session of a class; this worker becomes its owner"""
+        now = datetime.utcnow()
+        session_row = {
+            "class_id": class_id,
+            "teacher_id": teacher_id,
+            "started_at": now.isoformat(),
+            "rotation_interval": rotation_interval,
+            "current_code": new_qr_code(),
+            "code_generated_at": now.isoformat(),
+            "attendance_date": now.date().isoformat(),
+            "status": "active",
+            "last_scan_at": None,
+            "stopped_at": None,
+        }
+
+        # Upsert session for this class
+        existing = await fetch_one(
+            supabase.table("qr_sessions")
+            .select("class_id")
+            .eq("class_id", class_id)
+        )
+        if existing:
+            await db_call(supabase.table("qr_sessions").update(session_row).eq("class_id", class_id))
+            await db_call(supabase.table("qr_scanned_students").delete().eq("class_id", class_id))
+        else:
+            await db_call(supabase.table("qr_sessions").insert(session_row))
+
+        # A pending last_scan_at belongs to the previous session
+        self._pending_last_scan.pop(class_id, None)
+        self._entries[class_id] = _Entry(session_row, [], owned=True)
+        self._inactive.invalidate(class_id)
+        self._notify(class_id)
+        return self._entries[class_id].snapshot()
+
+    async def stop(self, class_id: int):
+        """Mark the session stopped and forget it"""
+        await db_call(supabase.table("qr_sessions").update(
+            {"status": "stopped", "stopped_at": datetime.utcnow().isoformat()}
+        ).eq("class_id", class_id))
+        self._entries.pop(class_id, None)
+        self._pending_last_scan.pop(class_id, None)
+        self._inactive.set(class_id, None)
+        self._notify(class_id)
+
+    def forget(self, class_id: int):
+        """Drop a class's session from memory (e.g. the class was deleted)"""
+        self._entries.pop(class_id, None)
+        self._pending_last_scan.pop(class_id, None)
+        self._inactive.invalidate(class_id)
+        self._notify(class_id)
+
+    def record_scan(self, class_id: int, student_record_id: int) -> bool:
+        """Count a scan in memory; True when it is the student's first in this session"""
+        self._pending_last_scan[class_id] = datetime.utcnow().isoformat()
+        entry = self._entries.get(class_id)
+        if entry is None or student_record_id in entry.scanned:
+            return False
+        entry.scanned.add(student_record_id)
+        entry.last_access = time.monotonic()
+        self._notify(class_id)
+        return True
+
+    async def _rotate(self, class_id: int, entry: _Entry) -> bool:
+        """
+        Replace the code, compare-and-swap on the one we hold; True if it landed.
+
+        The write matches nothing when another worker stopped, restarted or
+        rotated the session first. That worker owns it now, so the session is
+        re-read and kept as a non-owner (or dropped if it ended).
+        """
+        now = datetime.utcnow().isoformat()
+        code = new_qr_code()
+        res = await db_call(
+            supabase.table("qr_sessions")
+            .update({"current_code": code, "code_generated_at": now})
+            .eq("class_id", class_id)
+            .eq("status", "active")
+            .eq("started_at", entry.session["started_at"])
+            .eq("current_code", entry.session["current_code"])
+        )
+        if not res.data:
+            entry = await self._load(class_id)
+            if entry is None:
+                print(f"[QR_REGISTRY] Session for class {class_id} ended elsewhere, dropping it")
+            else:
+                entry.owned = False
+            self._notify(class_id)
+            return False
+
+        entry.owned = True
+        entry.previous_code = entry.session.get("current_code")
+        entry.previous_valid_until = time.monotonic() + QR_CODE_GRACE_SECONDS
+        entry.session["current_code"] = code
+        entry.session["code_generated_at"] = now
+        self._rotations += 1
+        self._notify(class_id)
+        return True
+
+    async def flush_last_scan_times(self):
+        """Write the coalesced last_scan_at values, one update per class"""
+        if not self._pending_last_scan:
+            return
+        batch = dict(self._pending_last_scan)
+        self._pending_last_scan.clear()
+        results = await asyncio.gather(
+            *(
+                db_call(supabase.table("qr_sessions").update({"last_scan_at": scanned_at}).eq("class_id", cid))
+                for cid, scanned_at in batch.items()
+            ),
+            return_exceptions=True,
+        )
+        for (cid, scanned_at), result in zip(batch.items(), results):
+            if isinstance(result, Exception):
+                print(f"[QR_REGISTRY] Failed to write last_scan_at for class {cid}: {result}")
+                # Retry next round unless a newer scan already replaced it
+                self._pending_last_scan.setdefault(cid, scanned_at)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": "qr_sessions",
+            "sessions": len(self._entries),
+            "owned": sum(1 for e in self._entries.values() if e.owned),
+            "memory_reads": self._memory_reads,
+            "db_reads": self._db_reads,
+            "rotations": self._rotations,
+            "evictions": self._evictions,
+            "pending_last_scan": len(self._pending_last_scan),
+        }
+
+
+def _code_event(session: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "current_code": session["current_code"],
+        "code_generated_at": session.get("code_generated_at"),
+        "rotation_interval": session.get("rotation_interval"),
+    }
+
+
+class QRSessionBroker:
+    """
+    Fans session changes out to every stream watching a class.
+
+    Each watched class has one producer task, however many streams are open:
+    it wakes on registry changes (or every QR_SESSION_CACHE_TTL seconds for
+    sessions owned by another worker), diffs the session and publishes
+    "code", "scan", "session" and "end" events to the subscriber queues.
+    """
+
+    def __init__(self, registry: QRSessionRegistry):
+        self.registry = registry
+        self._queues: Dict[int, Set[asyncio.Queue]] = {}
+        self._wakeups: Dict[int, asyncio.Event] = {}
+        self._producers: Dict[int, asyncio.Task] = {}
+        self._published = 0
+        self._dropped = 0
+        registry.add_listener(self.notify)
+
+    def notify(self, class_id: int):
+        wakeup = self._wakeups.get(class_id)
+        if wakeup is not None:
+            wakeup.set()
+
+    def subscribe(self, class_id: int) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=QR_STREAM_QUEUE_SIZE)
+        self._queues.setdefault(class_id, set()).add(queue)
+        if class_id not in self._producers:
+            self._wakeups[class_id] = asyncio.Event()
+            self._producers[class_id] = asyncio.create_task(self._produce(class_id))
+        return queue
+
+    def unsubscribe(self, class_id: int, queue: asyncio.Queue):
+        queues = self._queues.get(class_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            self._queues.pop(class_id, None)
+            self._wakeups.pop(class_id, None)
+            producer = self._producers.pop(class_id, None)
+            if producer is not None:
+                producer.cancel()
+
+    async def close(self):
+        """Stop every producer task (on shutdown; open streams end with the server)"""
+        producers = list(self._producers.values())
+        self._producers.clear()
+        self._wakeups.clear()
+        for producer in producers:
+            producer.cancel()
+        await asyncio.gather(*producers, return_exceptions=True)
+
+    def _publish(self, class_id: int, event: str, data: Dict[str, Any]):
+        for queue in self._queues.get(class_id, ()):
+            if queue.full():
+                # A slow watcher only needs the latest state - drop its oldest event
+                queue.get_nowait()
+                self._dropped += 1
+            queue.put_nowait((event, data))
+        self._published += 1
+
+    async def _produce(self, class_id: int):
+        wakeup = self._wakeups[class_id]
+        last = await self.registry.get(class_id)
+        while self._queues.get(class_id):
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=QR_SESSION_CACHE_TTL)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+            try:
+                session = await self.registry.get(class_id)
+            except Exception as e:
+                print(f"[QR_BROKER] Error reading session for class {class_id}: {e}")
+                continue
+
+            if session is None:
+                if last is not None:
+                    self._publish(class_id, "end", {"active": False})
+                last = None
+                continue
+            if last is None or _parse_ts(session.get("started_at")) != _parse_ts(last.get("started_at")):
+                self._publish(class_id, "session", session)
+            else:
+                if session["current_code"] != last["current_code"]:
+                    self._publish(class_id, "code", _code_event(session))
+                if session["scanned_count"] != last["scanned_count"]:
+                    self._publish(class_id, "scan", {"scanned_count": session["scanned_count"]})
+            last = session
+
+    async def events(self, class_id: int) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """(event, data) pairs for one watcher: the current session first, then changes"""
+        queue = self.subscribe(class_id)
+        try:
+            session = await self.registry.get(class_id)
+            if session is None:
+                yield "end", {"active": False}
+                return
+            yield "session", session
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=QR_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield "ping", {}
+                    continue
+                yield event, data
+                if event == "end":
+                    return
+        finally:
+            self.unsubscribe(class_id, queue)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": "qr_streams",
+            "classes": len(self._queues),
+            "watchers": sum(len(q) for q in self._queues.values()),
+            "producers": len(self._producers),
+            "published": self._published,
+            "dropped": self._dropped,
+        }
+
+
+qr_registry = QRSessionRegistry()
+qr_broker = QRSessionBroker(qr_registry)
@@ -0,0 +1,1088 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, List
+from datetime import datetime
+
+from attendance_stats import COUNTER_FIELDS, new_counts
+from storage_engine import StorageEngine
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+
+CREATE TABLE IF NOT EXISTS students (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_students_email ON students(email);
+
+CREATE TABLE IF NOT EXISTS classes (
+    id TEXT PRIMARY KEY,
+    teacher_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_classes_teacher ON classes(teacher_id);
+
+-- record_id is untyped on purpose: ids keep whatever type the client sent
+CREATE TABLE IF NOT EXISTS class_students (
+    class_id TEXT NOT NULL,
+    record_id NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (class_id, record_id)
+);
+
+CREATE TABLE IF NOT EXISTS attendance (
+    class_id TEXT NOT NULL,
+    record_id NOT NULL,
+    date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (class_id, record_id, date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS enrollments (
+    class_id TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    record_id NOT NULL,
+    status TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (class_id, student_id)
+);
+CREATE INDEX IF NOT EXISTS idx_enrollments_class_status ON enrollments(class_id, status);
+CREATE INDEX IF NOT EXISTS idx_enrollments_student ON enrollments(student_id);
+
+CREATE TABLE IF NOT EXISTS qr_sessions (
+    class_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS qr_scans (
+    class_id TEXT NOT NULL,
+    record_id NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (class_id, record_id)
+);
+
+CREATE TABLE IF NOT EXISTS contact_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_contact_messages_email ON contact_messages(email);
+"""
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def _student_row_data(student: Dict[str, Any]) -> Dict[str, Any]:
+    """Student document without the fields derived from the attendance table"""
+    return {k: v for k, v in student.items() if k not in ("attendance", "counts")}
+
+
+class SQLiteDatabaseManager(StorageEngine):
+    """
+    SQLite storage engine with the same public API as the file-based DatabaseManager.
+
+    Entities keep their JSON documents in a `data` column. Everything that is
+    looked up or updated on its own gets a real column and index: emails,
+    class ownership, enrollment status, and one row per attendance cell.
+    """
+
+    def __init__(self, base_dir: str = "data", db_file: str = "attendsheets.db"):
+        super().__init__(base_dir)
+        os.makedirs(base_dir, exist_ok=True)
+        self.db_path = os.path.join(base_dir, db_file)
+        self._local = threading.local()
+        # executescript commits on its own, so it runs outside _transaction
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """One connection per thread (sqlite3 connections are not thread-safe)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _begin_immediate(self, conn: sqlite3.Connection):
+        """Take the database write lock, recording how long we waited when contended"""
+        conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            waited = None
+        except sqlite3.OperationalError:
+            started = time.monotonic()
+            conn.execute("PRAGMA busy_timeout = 30000")
+            conn.execute("BEGIN IMMEDIATE")
+            waited = (time.monotonic() - started) * 1000
+        finally:
+            conn.execute("PRAGMA busy_timeout = 30000")
+
+        with self._lock_stats_lock:
+            self._lock_counters["acquired"] += 1
+            if waited is not None:
+                self._lock_counters["contended"] += 1
+                self._lock_counters["total_wait_ms"] += waited
+                self._lock_counters["max_wait_ms"] = max(self._lock_counters["max_wait_ms"], waited)
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT, joining an already open transaction"""
+        conn = self._conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        self._begin_immediate(conn)
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _fetch_data(self, query: str, params: tuple) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(query, params).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # ==================== USER OPERATIONS ====================
+
+    def create_user(self, user_id: str, email: str, name: str, password_hash: str) -> Dict[str, Any]:
+        """Create a new user"""
+        user_data = {
+            "id": user_id,
+            "email": email,
+            "name": name,
+            "password": password_hash,
+            "created_at": datetime.utcnow().isoformat(),
+            "verified": True,
+            "role": "teacher",
+            "overview": {
+                "total_classes": 0,
+                "total_students": 0,
+                "last_updated": datetime.utcnow().isoformat()
+            }
+        }
+        with self._transaction() as conn:
+            # Overwrites an existing id, like the file store
+            conn.execute(
+                "INSERT INTO users (id, email, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET email = excluded.email, data = excluded.data",
+                (user_id, email, _dumps(user_data)),
+            )
+        return user_data
+
+    def create_student(self, student_id: str, email: str, name: str, password_hash: str) -> Dict[str, Any]:
+        """Create a new student user"""
+        student_data = {
+            "id": student_id,
+            "email": email,
+            "name": name,
+            "password": password_hash,
+            "created_at": datetime.utcnow().isoformat(),
+            "verified": True,
+            "role": "student",
+            "enrolled_classes": []
+        }
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO students (id, email, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET email = excluded.email, data = excluded.data",
+                (student_id, email, _dumps(student_data)),
+            )
+        return student_data
+
+    def _read_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Read the stored user document"""
+        return self._fetch_data("SELECT data FROM users WHERE id = ?", (user_id,))
+
+    def get_student(self, student_id: str) -> Optional[Dict[str, Any]]:
+        """Get student data"""
+        return self._fetch_data("SELECT data FROM students WHERE id = ?", (student_id,))
+
+    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """Get user by email (teachers)"""
+        return self._fetch_data("SELECT data FROM users WHERE email = ? ORDER BY rowid LIMIT 1", (email,))
+
+    def get_student_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """Get student by email"""
+        return self._fetch_data("SELECT data FROM students WHERE email = ? ORDER BY rowid LIMIT 1", (email,))
+
+    def update_user(self, user_id: str, **updates) -> Dict[str, Any]:
+        """Update user data"""
+        with self._transaction() as conn:
+            user_data = self.get_user(user_id)
+            if not user_data:
+                raise ValueError(f"User {user_id} not found")
+
+            user_data.update(updates)
+            user_data["updated_at"] = datetime.utcnow().isoformat()
+            conn.execute(
+                "UPDATE users SET email = ?, data = ? WHERE id = ?",
+                (user_data.get("email", ""), _dumps(user_data), user_id),
+            )
+        return user_data
+
+    def update_student(self, student_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+        """Update student data"""
+        with self._transaction() as conn:
+            student_data = self.get_student(student_id)
+            if not student_data:
+                raise ValueError(f"Student {student_id} not found")
+
+            student_data.update(updates)
+            student_data["updated_at"] = datetime.utcnow().isoformat()
+            conn.execute(
+                "UPDATE students SET email = ?, data = ? WHERE id = ?",
+                (student_data.get("email", ""), _dumps(student_data), student_id),
+            )
+        return student_data
+
+    def _drop_enrolled_class(self, student_id: str, class_id: str):
+        """Remove class_id from a student's enrolled_classes list"""
+        student_data = self.get_student(student_id)
+        if student_data:
+            enrolled_classes = student_data.get("enrolled_classes", [])
+            enrolled_classes = [ec for ec in enrolled_classes if ec.get("class_id") != class_id]
+            self.update_student(student_id, {"enrolled_classes": enrolled_classes})
+
+    def _delete_class_rows(self, conn: sqlite3.Connection, class_id: str):
+        for table in ("class_students", "attendance", "enrollments", "qr_scans", "qr_sessions"):
+            conn.execute(f"DELETE FROM {table} WHERE class_id = ?", (class_id,))
+        conn.execute("DELETE FROM classes WHERE id = ?", (class_id,))
+
+    def delete_user(self, user_id: str) -> bool:
+        """Delete user and all associated data"""
+        if not self.get_user(user_id):
+            return False
+
+        try:
+            with self._transaction() as conn:
+                class_ids = [r[0] for r in conn.execute("SELECT id FROM classes WHERE teacher_id = ?", (user_id,))]
+                for class_id in class_ids:
+                    for (student_id,) in conn.execute(
+                        "SELECT student_id FROM enrollments WHERE class_id = ?", (class_id,)
+                    ).fetchall():
+                        self._drop_enrolled_class(student_id, class_id)
+                    self._delete_class_rows(conn, class_id)
+                conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            return True
+        except Exception as e:
+            print(f"Error deleting user {user_id}: {e}")
+            return False
+
+    def delete_student(self, student_id: str) -> bool:
+        """Delete student account and all their data, clean up enrollments"""
+        print(f"\n[DELETE_STUDENT] Starting deletion for student {student_id}")
+        try:
+            student_data = self.get_student(student_id)
+            if not student_data:
+                print(f"[DELETE_STUDENT] Student {student_id} not found")
+                return False
+
+            with self._transaction() as conn:
+                class_ids = [ec.get("class_id") for ec in student_data.get("enrolled_classes", []) if ec.get("class_id")]
+                conn.execute("DELETE FROM enrollments WHERE student_id = ?", (student_id,))
+                conn.execute("DELETE FROM students WHERE id = ?", (student_id,))
+
+                teacher_ids = set()
+                for class_id in class_ids:
+                    row = conn.execute("SELECT teacher_id FROM classes WHERE id = ?", (class_id,)).fetchone()
+                    if row:
+                        teacher_ids.add(row[0])
+                for teacher_id in teacher_ids:
+                    self.update_user_overview(teacher_id)
+
+            print(f"[DELETE_STUDENT] ✅ Successfully deleted student {student_id}\n")
+            return True
+        except Exception as e:
+            print(f"[DELETE_STUDENT] ❌ ERROR: {e}")
+            return False
+
+    def update_user_overview(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Update user overview statistics - counts only ACTIVE enrollments (one aggregate query, kept eager)"""
+        with self._transaction() as conn:
+            user_data = self._read_user(user_id)
+            if not user_data:
+                return None
+
+            total_classes, total_active_students = conn.execute(
+                """
+                SELECT COUNT(DISTINCT c.id), COUNT(e.student_id)
+                FROM classes c
+                LEFT JOIN enrollments e ON e.class_id = c.id AND e.status = 'active'
+                WHERE c.teacher_id = ?
+                """,
+                (user_id,),
+            ).fetchone()
+
+            user_data["overview"] = {
+                "total_classes": total_classes,
+                "total_students": total_active_students,
+                "last_updated": datetime.utcnow().isoformat()
+            }
+            conn.execute("UPDATE users SET data = ? WHERE id = ?", (_dumps(user_data), user_id))
+            return user_data
+
+    # ==================== CLASS OPERATIONS ====================
+
+    def _load_class(self, class_id: str, teacher_id: Optional[str] = None, active_only: bool = False) -> Optional[Dict[str, Any]]:
+        """Assemble a class document from its class, student and attendance rows"""
+        conn = self._conn()
+        if teacher_id is None:
+            row = conn.execute("SELECT data FROM classes WHERE id = ?", (class_id,)).fetchone()
+        else:
+            row = conn.execute("SELECT data FROM classes WHERE id = ? AND teacher_id = ?", (class_id, teacher_id)).fetchone()
+        if not row:
+            return None
+
+        class_data = json.loads(row[0])
+        active_filter = (
+            " AND record_id IN (SELECT record_id FROM enrollments WHERE class_id = ? AND status = 'active')"
+            if active_only else ""
+        )
+        params = (class_id, class_id) if active_only else (class_id,)
+
+        students = []
+        students_by_id = {}
+        for record_id, data in conn.execute(
+            f"SELECT record_id, data FROM class_students WHERE class_id = ?{active_filter} ORDER BY position", params
+        ):
+            student = json.loads(data)
+            student["attendance"] = {}
+            students.append(student)
+            students_by_id[record_id] = student
+
+        for record_id, date, status in conn.execute(
+            f"SELECT record_id, date, status FROM attendance WHERE class_id = ?{active_filter} ORDER BY date", params
+        ):
+            student = students_by_id.get(record_id)
+            if student is not None:
+                student["attendance"][date] = status
+
+        # Counters are derived here rather than stored, so they cannot drift
+        for student in students:
+            student["counts"] = new_counts(student["attendance"])
+        class_data["students"] = students
+        class_data["attendance_counts"] = self._attendance_totals(conn, class_id)
+        return class_data
+
+    def _attendance_totals(self, conn: sqlite3.Connection, class_id: str) -> Dict[str, int]:
+        """Class-level attendance counters over all records"""
+        totals = {"present": 0, "late": 0, "absent": 0, "total": 0}
+        for status, count in conn.execute(
+            "SELECT status, COUNT(*) FROM attendance WHERE class_id = ? GROUP BY status", (class_id,)
+        ):
+            field = COUNTER_FIELDS.get(status)
+            if field:
+                totals[field] += count
+            totals["total"] += count
+        return totals
+
+    def _write_class_row(self, conn: sqlite3.Connection, class_id: str, teacher_id: str, class_data: Dict[str, Any]):
+        row_data = {k: v for k, v in class_data.items() if k not in ("students", "attendance_counts")}
+        conn.execute(
+            "INSERT INTO classes (id, teacher_id, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET teacher_id = excluded.teacher_id, data = excluded.data",
+            (class_id, teacher_id, _dumps(row_data)),
+        )
+
+    def _write_student_rows(self, conn: sqlite3.Connection, class_id: str, students: List[Dict[str, Any]]):
+        """Upsert student rows in list order (attendance lives in its own table)"""
+        conn.executemany(
+            "INSERT INTO class_students (class_id, record_id, position, data) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(class_id, record_id) DO UPDATE SET position = excluded.position, data = excluded.data",
+            [
+                (class_id, s.get("id"), position, _dumps(_student_row_data(s)))
+                for position, s in enumerate(students)
+            ],
+        )
+
+    def _set_attendance(self, conn: sqlite3.Connection, class_id: str, record_id: Any, date: str, status: str):
+        conn.execute(
+            "INSERT INTO attendance (class_id, record_id, date, status) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(class_id, record_id, date) DO UPDATE SET status = excluded.status",
+            (class_id, record_id, date, status),
+        )
+
+    def create_class(self, user_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create a new class"""
+        class_id = str(class_data["id"])
+        for student in class_data.get("students", []):
+            student["counts"] = new_counts(student.get("attendance"))
+        full_class_data = {
+            **class_data,
+            "teacher_id": user_id,
+            "created_at": datetime.utcnow().isoformat(),
+            "updated_at": datetime.utcnow().isoformat(),
+            "statistics": self.calculate_class_statistics(class_data, class_id)
+        }
+
+        students = class_data.get("students", [])
+        with self._transaction() as conn:
+            self._write_class_row(conn, class_id, user_id, full_class_data)
+            self._write_student_rows(conn, class_id, students)
+            conn.executemany(
+                "INSERT OR REPLACE INTO attendance (class_id, record_id, date, status) VALUES (?, ?, ?, ?)",
+                [
+                    (class_id, s.get("id"), date, status)
+                    for s in students
+                    for date, status in (s.get("attendance") or {}).items()
+                ],
+            )
+            full_class_data["attendance_counts"] = self._attendance_totals(conn, class_id)
+            self.update_user_overview(user_id)
+
+        return full_class_data
+
+    def get_class(self, user_id: str, class_id: str) -> Optional[Dict[str, Any]]:
+        """Get a specific class - FILTERS to show only ACTIVE students"""
+        return self._load_class(str(class_id), teacher_id=user_id, active_only=True)
+
+    def get_class_by_id(self, class_id: str) -> Optional[Dict[str, Any]]:
+        """Get a class by ID - returns RAW data with ALL students (for internal use)"""
+        return self._load_class(str(class_id))
+
+    def get_all_classes(self, user_id: str) -> List[Dict[str, Any]]:
+        """Get all classes for a user - FILTERS to show only ACTIVE students"""
+        class_ids = [r[0] for r in self._conn().execute("SELECT id FROM classes WHERE teacher_id = ?", (user_id,))]
+        classes = []
+        for class_id in class_ids:
+            class_data = self._load_class(class_id, active_only=True)
+            if class_data:
+                classes.append(class_data)
+        return classes
+
+    def update_class(self, user_id: str, class_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Update class data - preserves inactive students"""
+        class_id = str(class_id)
+        with self._transaction() as conn:
+            current_class = self._load_class(class_id, teacher_id=user_id)
+            if not current_class:
+                raise ValueError(f"Class {class_id} not found")
+
+            all_students_in_file = current_class.get('students', [])
+            incoming_students = class_data.get('students', [])
+
+            current_ids = {s.get('id') for s in all_students_in_file}
+            new_ids = {s.get('id') for s in incoming_students}
+            deleted_ids = current_ids - new_ids
+
+            # Mark deleted students as inactive in enrollments
+            for record_id in deleted_ids:
+                for student_id, data in conn.execute(
+                    "SELECT student_id, data FROM enrollments WHERE class_id = ? AND record_id = ? AND status = 'active'",
+                    (class_id, record_id),
+                ).fetchall():
+                    enrollment = json.loads(data)
+                    enrollment['status'] = 'inactive'
+                    enrollment['removed_by_teacher_at'] = datetime.utcnow().isoformat()
+                    conn.execute(
+                        "UPDATE enrollments SET status = 'inactive', data = ? WHERE class_id = ? AND student_id = ?",
+                        (_dumps(enrollment), class_id, student_id),
+                    )
+                    if student_id:
+                        try:
+                            self._drop_enrolled_class(student_id, class_id)
+                        except Exception as e:
+                            print(f"Error updating student {student_id}: {e}")
+
+            # Build final student list (active + inactive preserved)
+            updated_students_map = {s.get('id'): s for s in incoming_students}
+            final_students = [updated_students_map.get(s.get('id'), s) for s in all_students_in_file]
+
+            # Only the attendance cells that changed are written
+            current_attendance = {s.get('id'): s.get('attendance', {}) for s in all_students_in_file}
+            for student in final_students:
+                record_id = student.get('id')
+                old_attendance = current_attendance.get(record_id, {})
+                new_attendance = student.get('attendance', {})
+                for date, status in new_attendance.items():
+                    if old_attendance.get(date) != status:
+                        self._set_attendance(conn, class_id, record_id, date, status)
+                for date in old_attendance.keys() - new_attendance.keys():
+                    conn.execute(
+                        "DELETE FROM attendance WHERE class_id = ? AND record_id = ? AND date = ?",
+                        (class_id, record_id, date),
+                    )
+
+            for student in final_students:
+                student['counts'] = new_counts(student.get('attendance'))
+            class_data['students'] = final_students
+            class_data['attendance_counts'] = self._attendance_totals(conn, class_id)
+            class_data["updated_at"] = datetime.utcnow().isoformat()
+            class_data["statistics"] = self.calculate_class_statistics(class_data, class_id)
+
+            self._write_class_row(conn, class_id, user_id, class_data)
+            self._write_student_rows(conn, class_id, final_students)
+            self.update_user_overview(user_id)
+
+        return class_data
+
+    def delete_class(self, user_id: str, class_id: str) -> bool:
+        """Delete a class and clean up enrollments"""
+        class_id = str(class_id)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT 1 FROM classes WHERE id = ? AND teacher_id = ?", (class_id, user_id)).fetchone()
+            if not row:
+                return False
+
+            for (student_id,) in conn.execute(
+                "SELECT student_id FROM enrollments WHERE class_id = ?", (class_id,)
+            ).fetchall():
+                if student_id:
+                    try:
+                        self._drop_enrolled_class(student_id, class_id)
+                    except Exception as e:
+                        print(f"Error updating student {student_id} after class deletion: {e}")
+
+            self._delete_class_rows(conn, class_id)
+            self.update_user_overview(user_id)
+        return True
+
+    # ==================== ENROLLMENT OPERATIONS ====================
+
+    def _write_enrollment(self, conn: sqlite3.Connection, enrollment: Dict[str, Any]):
+        conn.execute(
+            "INSERT INTO enrollments (class_id, student_id, record_id, status, position, data) "
+            "VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM enrollments WHERE class_id = ?), ?) "
+            "ON CONFLICT(class_id, student_id) DO UPDATE SET "
+            "record_id = excluded.record_id, status = excluded.status, data = excluded.data",
+            (
+                enrollment["class_id"], enrollment["student_id"], enrollment["student_record_id"],
+                enrollment["status"], enrollment["class_id"], _dumps(enrollment),
+            ),
+        )
+
+    def _append_student_row(self, conn: sqlite3.Connection, class_id: str, student: Dict[str, Any]):
+        conn.execute(
+            "INSERT OR REPLACE INTO class_students (class_id, record_id, position, data) "
+            "VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM class_students WHERE class_id = ?), ?)",
+            (class_id, student.get("id"), class_id, _dumps(_student_row_data(student))),
+        )
+
+    def enroll_student(self, student_id: str, class_id: str, student_info: dict) -> dict:
+        """
+        Enroll a student in a class.
+        - Uses student_id to check if they were enrolled before
+        - If re-enrolling, restores their exact same record with all attendance
+        - If new, creates new record
+        """
+        class_id = str(class_id)
+        with self._transaction() as conn:
+            class_data = self._load_class(class_id)
+            if not class_data:
+                raise ValueError("Class not found")
+
+            teacher_id = class_data.get('teacher_id')
+            if not teacher_id:
+                raise ValueError("Invalid class data")
+
+            row = conn.execute(
+                "SELECT data FROM enrollments WHERE class_id = ? AND student_id = ?", (class_id, student_id)
+            ).fetchone()
+            previous_enrollment = json.loads(row[0]) if row else None
+            if previous_enrollment and previous_enrollment.get('status') == 'active':
+                raise ValueError("You are already enrolled in this class")
+
+            students = class_data.get('students', [])
+
+            if previous_enrollment:
+                # RE-ENROLLMENT
+                student_record_id = previous_enrollment['student_record_id']
+                previous_enrollment['status'] = 'active'
+                previous_enrollment['re_enrolled_at'] = datetime.utcnow().isoformat()
+                previous_enrollment['roll_no'] = student_info['rollNo']
+                self._write_enrollment(conn, previous_enrollment)
+
+                student_record = next((s for s in students if s.get('id') == student_record_id), None)
+                if student_record:
+                    student_record['rollNo'] = student_info['rollNo']
+                    student_record['name'] = student_info['name']
+                    conn.execute(
+                        "UPDATE class_students SET data = ? WHERE class_id = ? AND record_id = ?",
+                        (_dumps(_student_row_data(student_record)), class_id, student_record_id),
+                    )
+                else:
+                    student_record = {
+                        "id": student_record_id,
+                        "rollNo": student_info['rollNo'],
+                        "name": student_info['name'],
+                        "email": student_info['email'],
+                        "attendance": {}
+                    }
+                    self._append_student_row(conn, class_id, student_record)
+
+                student_data = self.get_student(student_id)
+                if student_data:
+                    enrolled_classes = student_data.get('enrolled_classes', [])
+                    class_info = {
+                        "class_id": class_id,
+                        "class_name": class_data.get('name'),
+                        "teacher_name": self.get_teacher_name(teacher_id),
+                        "enrolled_at": previous_enrollment.get('enrolled_at'),
+                        "re_enrolled_at": previous_enrollment['re_enrolled_at']
+                    }
+                    if not any(ec.get('class_id') == class_id for ec in enrolled_classes):
+                        enrolled_classes.append(class_info)
+                        self.update_student(student_id, {"enrolled_classes": enrolled_classes})
+
+                self.update_user_overview(teacher_id)
+
+                attendance_count = len(student_record.get('attendance', {}))
+                return {
+                    "class_id": class_id,
+                    "student_id": student_id,
+                    "student_record_id": student_record_id,
+                    "status": "re-enrolled",
+                    "message": f"Welcome back! Your {attendance_count} attendance records have been restored."
+                }
+
+            # NEW ENROLLMENT
+            student_record_id = self._generate_student_record_id()
+            new_enrollment = {
+                "student_id": student_id,
+                "student_record_id": student_record_id,
+                "class_id": class_id,
+                "name": student_info['name'],
+                "roll_no": student_info['rollNo'],
+                "email": student_info['email'],
+                "enrolled_at": datetime.utcnow().isoformat(),
+                "status": "active"
+            }
+            self._write_enrollment(conn, new_enrollment)
+            self._append_student_row(conn, class_id, {
+                "id": student_record_id,
+                "rollNo": student_info['rollNo'],
+                "name": student_info['name'],
+                "email": student_info['email'],
+            })
+
+            student_data = self.get_student(student_id)
+            if student_data:
+                enrolled_classes = student_data.get('enrolled_classes', [])
+                enrolled_classes.append({
+                    "class_id": class_id,
+                    "class_name": class_data.get('name'),
+                    "teacher_name": self.get_teacher_name(teacher_id),
+                    "enrolled_at": new_enrollment['enrolled_at']
+                })
+                self.update_student(student_id, {"enrolled_classes": enrolled_classes})
+
+            self.update_user_overview(teacher_id)
+
+        return {
+            "class_id": class_id,
+            "student_id": student_id,
+            "student_record_id": student_record_id,
+            "status": "enrolled",
+            "message": "Successfully enrolled in class!"
+        }
+
+    def unenroll_student(self, student_id: str, class_id: str) -> bool:
+        """
+        Unenroll a student from a class
+        - Marks enrollment as 'inactive' (NOT deleted!)
+        - Student record stays in class with ALL attendance
+        """
+        class_id = str(class_id)
+        try:
+            with self._transaction() as conn:
+                row = conn.execute(
+                    "SELECT data FROM enrollments WHERE class_id = ? AND student_id = ? AND status = 'active'",
+                    (class_id, student_id),
+                ).fetchone()
+                if not row:
+                    print(f"[UNENROLL] ❌ Student not actively enrolled")
+                    return False
+
+                enrollment = json.loads(row[0])
+                enrollment['status'] = 'inactive'
+                enrollment['unenrolled_at'] = datetime.utcnow().isoformat()
+                self._write_enrollment(conn, enrollment)
+
+                self._drop_enrolled_class(student_id, class_id)
+
+                teacher = conn.execute("SELECT teacher_id FROM classes WHERE id = ?", (class_id,)).fetchone()
+                if teacher:
+                    self.update_user_overview(teacher[0])
+            return True
+        except Exception as e:
+            print(f"[UNENROLL] ❌ ERROR: {e}")
+            return False
+
+    def get_class_enrollments(self, class_id: str) -> List[Dict[str, Any]]:
+        """Get all ACTIVE enrollments for a class"""
+        return [
+            json.loads(data)
+            for (data,) in self._conn().execute(
+                "SELECT data FROM enrollments WHERE class_id = ? AND status = 'active' ORDER BY position", (str(class_id),)
+            )
+        ]
+
+    # ==================== CONTACT OPERATIONS ====================
+
+    def save_contact_message(self, email: str, message_data: Dict[str, Any]) -> bool:
+        """Save a contact form message"""
+        try:
+            message_entry = {
+                "email": email,
+                "timestamp": datetime.utcnow().isoformat(),
+                **message_data
+            }
+            with self._transaction() as conn:
+                conn.execute(
+                    "INSERT INTO contact_messages (email, data) VALUES (?, ?)",
+                    (message_entry.get("email"), _dumps(message_entry)),
+                )
+            return True
+        except Exception as e:
+            print(f"Error saving contact message: {e}")
+            return False
+
+    def iter_contact_messages(self, email: Optional[str] = None, offset: int = 0, limit: int = -1) -> Iterator[Dict[str, Any]]:
+        """Stream contact messages in arrival order, optionally filtered by email"""
+        if email:
+            rows = self._conn().execute(
+                "SELECT data FROM contact_messages WHERE email = ? ORDER BY id LIMIT ? OFFSET ?", (email, limit, offset)
+            )
+        else:
+            rows = self._conn().execute("SELECT data FROM contact_messages ORDER BY id LIMIT ? OFFSET ?", (limit, offset))
+        for (data,) in rows:
+            yield json.loads(data)
+
+    def get_contact_messages(self, email: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get contact messages, optionally filtered by email, one page at a time"""
+        return list(self.iter_contact_messages(email, offset, -1 if limit is None else limit))
+
+    # ==================== QR CODE SYSTEM ====================
+
+    def _load_session(self, class_id: str) -> Optional[Dict[str, Any]]:
+        session_data = self._fetch_data("SELECT data FROM qr_sessions WHERE class_id = ?", (class_id,))
+        if session_data is not None:
+            session_data["scanned_students"] = [
+                r[0] for r in self._conn().execute(
+                    "SELECT record_id FROM qr_scans WHERE class_id = ? ORDER BY position", (class_id,)
+                )
+            ]
+        return session_data
+
+    def _write_session(self, conn: sqlite3.Connection, class_id: str, session_data: Dict[str, Any]):
+        row_data = {k: v for k, v in session_data.items() if k != "scanned_students"}
+        conn.execute(
+            "INSERT INTO qr_sessions (class_id, status, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(class_id) DO UPDATE SET status = excluded.status, data = excluded.data",
+            (class_id, session_data.get("status", ""), _dumps(row_data)),
+        )
+
+    def start_qr_session(self, class_id: str, teacher_id: str, rotation_interval: int = 5) -> dict:
+        class_id = str(class_id)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT teacher_id FROM classes WHERE id = ?", (class_id,)).fetchone()
+            if not row or row[0] != teacher_id:
+                raise ValueError("Class not found or unauthorized")
+
+            session_data = {
+                "class_id": class_id,
+                "teacher_id": teacher_id,
+                "started_at": datetime.now().isoformat(),
+                "rotation_interval": rotation_interval,
+                "current_code": self._generate_qr_code(),
+                "code_generated_at": datetime.now().isoformat(),
+                "scanned_students": [],
+                "attendance_date": datetime.now().strftime("%Y-%m-%d"),
+                "status": "active"
+            }
+            self._write_session(conn, class_id, session_data)
+            conn.execute("DELETE FROM qr_scans WHERE class_id = ?", (class_id,))
+        return session_data
+
+    def get_qr_session(self, class_id: str) -> dict:
+        class_id = str(class_id)
+        session_data = self._load_session(class_id)
+        if not session_data or session_data.get("status") != "active":
+            return None
+
+        code_time = datetime.fromisoformat(session_data["code_generated_at"])
+        if (datetime.now() - code_time).total_seconds() < session_data["rotation_interval"]:
+            return session_data
+
+        with self._transaction() as conn:
+            # Only rotates the code we read: a stop or rotation since then wins
+            conn.execute(
+                "UPDATE qr_sessions SET data = json_set(data, '$.current_code', ?, '$.code_generated_at', ?) "
+                "WHERE class_id = ? AND status = 'active' AND json_extract(data, '$.code_generated_at') = ?",
+                (self._generate_qr_code(), datetime.now().isoformat(), class_id, session_data["code_generated_at"]),
+            )
+            session_data = self._load_session(class_id)
+        if not session_data or session_data.get("status") != "active":
+            return None
+        return session_data
+
+    def scan_qr_code(self, student_id: str, class_id: str, qr_code: str) -> Dict[str, Any]:
+        """
+        Handle a student scanning a QR code: one attendance row upsert plus the scan record.
+        """
+        class_id = str(class_id)
+        with self._transaction() as conn:
+            session_data = self._fetch_data("SELECT data FROM qr_sessions WHERE class_id = ?", (class_id,))
+            if not session_data or session_data.get("status") != "active":
+                raise ValueError("No active session")
+            if session_data.get("current_code") != qr_code:
+                raise ValueError("Invalid or expired QR code")
+
+            attendance_date = session_data["attendance_date"]
+
+            row = conn.execute(
+                "SELECT data FROM enrollments WHERE class_id = ? AND student_id = ? AND status = 'active'",
+                (class_id, student_id),
+            ).fetchone()
+            if not row:
+                raise ValueError("Student not actively enrolled in this class")
+            enrollment = json.loads(row[0])
+            student_record_id = enrollment.get("student_record_id")
+
+            if not conn.execute("SELECT 1 FROM classes WHERE id = ?", (class_id,)).fetchone():
+                raise ValueError("Class not found")
+
+            if not conn.execute(
+                "SELECT 1 FROM class_students WHERE class_id = ? AND record_id = ?", (class_id, student_record_id)
+            ).fetchone():
+                # create record if somehow missing
+                self._append_student_row(conn, class_id, {
+                    "id": student_record_id,
+                    "name": enrollment.get("name"),
+                    "rollNo": enrollment.get("roll_no"),
+                    "email": enrollment.get("email"),
+                })
+
+            self._set_attendance(conn, class_id, student_record_id, attendance_date, "P")
+            conn.execute(
+                "INSERT OR IGNORE INTO qr_scans (class_id, record_id, position) "
+                "VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM qr_scans WHERE class_id = ?))",
+                (class_id, student_record_id, class_id),
+            )
+            session_data["last_scan_at"] = datetime.utcnow().isoformat()
+            self._write_session(conn, class_id, session_data)
+
+        return {
+            "success": True,
+            "message": "Attendance marked as Present",
+            "date": attendance_date,
+        }
+
+    def stop_qr_session(self, class_id: str, teacher_id: str) -> Dict[str, Any]:
+        """
+        Stop an active QR session, marking every active student who did not
+        scan and has no mark for the date as Absent in one statement.
+        """
+        class_id = str(class_id)
+        with self._transaction() as conn:
+            session_data = self._load_session(class_id)
+            if not session_data or session_data.get("status") != "active":
+                raise ValueError("No active session")
+            if session_data.get("teacher_id") != teacher_id:
+                raise ValueError("Unauthorized")
+            if not conn.execute("SELECT 1 FROM classes WHERE id = ?", (class_id,)).fetchone():
+                raise ValueError("Class not found")
+
+            attendance_date = session_data["attendance_date"]
+            cursor = conn.execute(
+                """
+                INSERT INTO attendance (class_id, record_id, date, status)
+                SELECT cs.class_id, cs.record_id, ?, 'A'
+                FROM class_students cs
+                JOIN enrollments e ON e.class_id = cs.class_id AND e.record_id = cs.record_id AND e.status = 'active'
+                WHERE cs.class_id = ?
+                  AND cs.record_id NOT IN (SELECT record_id FROM qr_scans WHERE class_id = ?)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM attendance a
+                      WHERE a.class_id = cs.class_id AND a.record_id = cs.record_id AND a.date = ?
+                  )
+                """,
+                (attendance_date, class_id, class_id, attendance_date),
+            )
+            marked_absent = cursor.rowcount
+
+            session_data["status"] = "stopped"
+            session_data["stopped_at"] = datetime.utcnow().isoformat()
+            self._write_session(conn, class_id, session_data)
+
+        return {
+            "success": True,
+            "scanned_count": len(session_data.get("scanned_students", [])),
+            "absent_count": marked_absent,
+            "date": attendance_date,
+        }
+
+    # ==================== BACKUP & MAINTENANCE ====================
+
+    def backup_user_data(self, user_id: str, backup_dir: str = "backups"):
+        """
+        Export a teacher and their classes in the file store's user directory layout.
+
+        Snapshots share the file store's content-addressed object store: each
+        document is stored once in backup_dir/objects by SHA-256, hardlinked into
+        the snapshot and listed in manifest.json.
+        """
+        user_data = self._read_user(user_id)
+        if not user_data:
+            raise ValueError(f"User {user_id} not found")
+
+        documents = {"user.json": user_data}
+        for (class_id,) in self._conn().execute("SELECT id FROM classes WHERE teacher_id = ?", (user_id,)).fetchall():
+            documents[os.path.join("classes", f"class_{class_id}.json")] = self._load_class(class_id)
+
+        backup_path = self._new_backup_path(user_id, backup_dir)
+
+        files = {}
+        stored = linked = 0
+        for relative, document in documents.items():
+            content = json.dumps(document, indent=2, ensure_ascii=False).encode("utf-8")
+            digest = hashlib.sha256(content).hexdigest()
+            if os.path.exists(self._backup_object_path(backup_dir, digest)):
+                linked += 1
+            else:
+                self._store_backup_object(backup_dir, digest, content)
+                stored += 1
+            self._link_backup_object(backup_dir, digest, content, os.path.join(backup_path, relative))
+            files[relative] = {"sha256": digest, "size": len(content)}
+
+        self._write_backup_manifest(backup_path, {
+            "user_id": user_id,
+            "created_at": datetime.utcnow().isoformat(),
+            "files": files,
+        })
+        print(f"[BACKUP] {user_id}: {stored} new objects, {linked} unchanged documents linked -> {backup_path}")
+        return backup_path
+
+    def _iter_user_ids(self) -> Iterator[str]:
+        for (user_id,) in self._conn().execute("SELECT id FROM users ORDER BY rowid").fetchall():
+            yield user_id
+
+    def restore_user_backup(self, user_id: str, backup_path: Optional[str] = None, backup_dir: str = "backups") -> str:
+        """Restore a teacher and their classes from a snapshot (the latest one by default)"""
+        backup_path, manifest = self._load_backup_manifest(user_id, backup_path, backup_dir)
+        documents = {
+            relative: json.loads(self._read_backup_file(backup_path, relative, entry))
+            for relative, entry in manifest["files"].items()
+        }
+        user_data = documents.get("user.json")
+        if not user_data:
+            raise ValueError(f"{backup_path} has no user.json")
+        restored_classes = {
+            str(class_data["id"]): class_data for relative, class_data in documents.items()
+            if relative.startswith(f"classes{os.sep}class_")
+        }
+
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (id, email, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET email = excluded.email, data = excluded.data",
+                (user_id, user_data.get("email", ""), _dumps(user_data)),
+            )
+            current_classes = {r[0] for r in conn.execute("SELECT id FROM classes WHERE teacher_id = ?", (user_id,))}
+            for class_id in current_classes - restored_classes.keys():
+                self._delete_class_rows(conn, class_id)
+            for class_id, class_data in restored_classes.items():
+                # Enrollments and QR state live outside the snapshot and are kept
+                conn.execute("DELETE FROM class_students WHERE class_id = ?", (class_id,))
+                conn.execute("DELETE FROM attendance WHERE class_id = ?", (class_id,))
+                students = class_data.get("students", [])
+                self._write_class_row(conn, class_id, user_id, class_data)
+                self._write_student_rows(conn, class_id, students)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO attendance (class_id, record_id, date, status) VALUES (?, ?, ?, ?)",
+                    [
+                        (class_id, s.get("id"), date, status)
+                        for s in students
+                        for date, status in (s.get("attendance") or {}).items()
+                    ],
+                )
+            self.update_user_overview(user_id)
+
+        print(f"[BACKUP] Restored {user_id} from {backup_path} ({len(manifest['files'])} files)")
+        return backup_path
+
+    def verify_attendance_counters(self, class_id: Optional[str] = None, repair: bool = True) -> Dict[str, Any]:
+        """Counters are derived from the attendance table on every load - nothing can drift"""
+        if class_id is not None:
+            checked = 1
+        else:
+            checked = self._conn().execute("SELECT COUNT(*) FROM classes").fetchone()[0]
+        return {"classes_checked": checked, "drifted": [], "repaired": False}
+
+    def reconcile_database_stats(self) -> Dict[str, Any]:
+        """COUNT(*) over indexed tables is already exact - nothing to reconcile"""
+        stats = self.get_database_stats()
+        return {
+            "users": stats["total_users"],
+            "students": stats["total_students"],
+            "classes": stats["total_classes"],
+            "class_students": stats["total_class_students"],
+            "drift": {},
+        }
+
+    def get_database_stats(self) -> Dict[str, Any]:
+        """Get overall database statistics"""
+        conn = self._conn()
+        total_class_students = conn.execute(
+            """
+            SELECT COUNT(*) FROM class_students cs
+            JOIN enrollments e ON e.class_id = cs.class_id AND e.record_id = cs.record_id AND e.status = 'active'
+            """
+        ).fetchone()[0]
+        return {
+            "total_users": conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            "total_students": conn.execute("SELECT COUNT(*) FROM students").fetchone()[0],
+            "total_classes": conn.execute("SELECT COUNT(*) FROM classes").fetchone()[0],
+            "total_class_students": total_class_students,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+
+    # ==================== INDEX MAINTENANCE ====================
+
+    def resolve_class_teacher(self, class_id: str) -> Optional[str]:
+        """Resolve which teacher owns class_id (indexed by the classes table itself)"""
+        row = self._conn().execute("SELECT teacher_id FROM classes WHERE id = ?", (str(class_id),)).fetchone()
+        return row[0] if row else None
+
+    def invalidate_user_overview(self, user_id: str):
+        """The overview is kept eager here, so recompute it right away"""
+        self.update_user_overview(user_id)
+
+    def rebuild_email_indexes(self) -> Dict[str, int]:
+        """Rebuild the email indexes (REINDEX) and report how many rows they cover"""
+        with self._transaction() as conn:
+            conn.execute("REINDEX idx_users_email")
+            conn.execute("REINDEX idx_students_email")
+            users = conn.execute("SELECT COUNT(DISTINCT email) FROM users WHERE email != ''").fetchone()[0]
+            students = conn.execute("SELECT COUNT(DISTINCT email) FROM students WHERE email != ''").fetchone()[0]
+        return {"users": users, "students": students}
+
+    def rebuild_class_routes(self) -> int:
+        """Class ownership is the indexed classes.teacher_id column - rebuild that index"""
+        with self._transaction() as conn:
+            conn.execute("REINDEX idx_classes_teacher")
+            return conn.execute("SELECT COUNT(*) FROM classes").fetchone()[0]
+
+    def rebuild_contact_index(self) -> int:
+        """Rebuild the contact email index and report how many messages it covers"""
+        with self._transaction() as conn:
+            conn.execute("REINDEX idx_contact_messages_email")
+            return conn.execute("SELECT COUNT(*) FROM contact_messages").fetchone()[0]
@@ -0,0 +1,73 @@
+"""Serialization formats for the file-based DatabaseManager"""
+import json
+from typing import Any, Dict, Type
+
+try:
+    import msgpack
+except ImportError:  # optional - only needed for codec="msgpack"
+    msgpack = None
+
+
+class JSONCodec:
+    """Pretty-printed JSON (the original on-disk format)"""
+    name = "json"
+
+    def encode(self, data: Any) -> bytes:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+    def decode(self, raw: bytes) -> Any:
+        return json.loads(raw)
+
+
+class CompactJSONCodec(JSONCodec):
+    """JSON without indentation or spaces - same data, smaller and faster"""
+    name = "compact-json"
+
+    def encode(self, data: Any) -> bytes:
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class MessagePackCodec:
+    """Binary MessagePack"""
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack must be installed to use codec='msgpack'")
+
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, raw: bytes) -> Any:
+        # Attendance maps are keyed by strings, but older files may hold int keys
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+CODECS: Dict[str, Type] = {
+    JSONCodec.name: JSONCodec,
+    CompactJSONCodec.name: CompactJSONCodec,
+    MessagePackCodec.name: MessagePackCodec,
+}
+
+
+def get_codec(name: str):
+    """Get a codec instance by name"""
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}' (expected one of: {', '.join(CODECS)})")
+    return CODECS[name]()
+
+
+def decode_any(raw: bytes) -> Any:
+    """
+    Decode a file written by any codec.
+
+    Every file holds a dict or a list, so JSON starts with '{', '[', whitespace
+    or a UTF-8 BOM, while MessagePack maps/arrays always start with a byte >= 0x80.
+    """
+    if raw.startswith(b"\xef\xbb\xbf"):
+        return json.loads(raw[3:])
+    if raw and raw[0] >= 0x80:
+        if msgpack is None:
+            raise RuntimeError("File is MessagePack encoded but msgpack is not installed")
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    return json.loads(raw)
@@ -0,0 +1,496 @@
+"""Storage-agnostic base class of the database engines"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional, Dict, Any, Iterator, List, Tuple
+
+from attendance_stats import counts_tuple, record_counts, summarize_class, summarize_student
+from storage_codecs import decode_any
+
+# Backups: snapshots kept per user by prune_backups, and parallelism of backup_all_users
+BACKUP_KEEP = 7
+BACKUP_WORKERS = 4
+# How often start_stats_reconciler re-derives the get_database_stats counters
+STATS_RECONCILE_INTERVAL = 3600
+
+
+class StorageEngine(ABC):
+    """
+    The database API the app codes against, and the logic shared by every engine.
+
+    Engines implement the abstract methods over their own storage (one JSON
+    file per entity in DatabaseManager, tables in SQLiteDatabaseManager).
+    Statistics, enrollment lookups, the backup object store and the stats
+    reconciler are built on those here and never touch the engine's storage.
+    """
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        # Write lock wait metrics, reported by get_lock_stats
+        self._lock_stats_lock = threading.Lock()
+        self._lock_counters = {"acquired": 0, "contended": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+        # Background stats reconciliation (see start_stats_reconciler)
+        self._stats_reconciler: Optional[threading.Thread] = None
+        self._stats_reconciler_stop = threading.Event()
+
+    # ==================== ENGINE API ====================
+
+    @abstractmethod
+    def create_user(self, user_id: str, email: str, name: str, password_hash: str) -> Dict[str, Any]:
+        """Create (or overwrite) a teacher"""
+
+    @abstractmethod
+    def create_student(self, student_id: str, email: str, name: str, password_hash: str) -> Dict[str, Any]:
+        """Create (or overwrite) a student"""
+
+    @abstractmethod
+    def _read_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """The teacher document as stored, without refreshing a stale overview"""
+
+    @abstractmethod
+    def _iter_user_ids(self) -> Iterator[str]:
+        """Ids of every teacher"""
+
+    @abstractmethod
+    def get_student(self, student_id: str) -> Optional[Dict[str, Any]]:
+        """Get student data"""
+
+    @abstractmethod
+    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """Get user by email (teachers)"""
+
+    @abstractmethod
+    def get_student_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """Get student by email"""
+
+    @abstractmethod
+    def update_user(self, user_id: str, **updates) -> Dict[str, Any]:
+        """Update user data"""
+
+    @abstractmethod
+    def update_student(self, student_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+        """Update student data"""
+
+    @abstractmethod
+    def delete_user(self, user_id: str) -> bool:
+        """Delete a teacher and their classes"""
+
+    @abstractmethod
+    def delete_student(self, student_id: str) -> bool:
+        """Delete a student and their enrollments"""
+
+    @abstractmethod
+    def update_user_overview(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Recompute a teacher's class and student totals"""
+
+    @abstractmethod
+    def invalidate_user_overview(self, user_id: str):
+        """Have the overview recomputed before it is next read"""
+
+    @abstractmethod
+    def create_class(self, user_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create a class for a teacher"""
+
+    @abstractmethod
+    def get_class(self, user_id: str, class_id: str) -> Optional[Dict[str, Any]]:
+        """A teacher's class with its active students"""
+
+    @abstractmethod
+    def get_class_by_id(self, class_id: str) -> Optional[Dict[str, Any]]:
+        """A class with its active students, whoever owns it"""
+
+    @abstractmethod
+    def get_all_classes(self, user_id: str) -> List[Dict[str, Any]]:
+        """Every class of a teacher"""
+
+    @abstractmethod
+    def update_class(self, user_id: str, class_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Replace a class's name, settings, roster and attendance"""
+
+    @abstractmethod
+    def delete_class(self, user_id: str, class_id: str) -> bool:
+        """Delete a class and its enrollments"""
+
+    @abstractmethod
+    def resolve_class_teacher(self, class_id: str) -> Optional[str]:
+        """Id of the teacher who owns class_id"""
+
+    @abstractmethod
+    def enroll_student(self, student_id: str, class_id: str, student_info: dict) -> dict:
+        """Enroll (or re-enroll) a student in a class"""
+
+    @abstractmethod
+    def unenroll_student(self, student_id: str, class_id: str) -> bool:
+        """Deactivate a student's enrollment, keeping their record"""
+
+    @abstractmethod
+    def get_class_enrollments(self, class_id: str) -> List[Dict[str, Any]]:
+        """Get all ACTIVE enrollments for a class"""
+
+    @abstractmethod
+    def save_contact_message(self, email: str, message_data: Dict[str, Any]) -> bool:
+        """Store a contact form message"""
+
+    @abstractmethod
+    def get_contact_messages(self, email: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Contact messages, oldest first, optionally for one email"""
+
+    @abstractmethod
+    def start_qr_session(self, class_id: str, teacher_id: str, rotation_interval: int = 5) -> dict:
+        """Start (or restart) the QR attendance session of a class"""
+
+    @abstractmethod
+    def get_qr_session(self, class_id: str) -> dict:
+        """The active session, its code rotated when due; None when there is none"""
+
+    @abstractmethod
+    def scan_qr_code(self, student_id: str, class_id: str, qr_code: str) -> Dict[str, Any]:
+        """Mark a student present for the session's date"""
+
+    @abstractmethod
+    def stop_qr_session(self, class_id: str, teacher_id: str) -> Dict[str, Any]:
+        """Stop the session, marking students who did not scan absent"""
+
+    @abstractmethod
+    def backup_user_data(self, user_id: str, backup_dir: str = "backups"):
+        """Snapshot a teacher into backup_dir; returns the snapshot path"""
+
+    @abstractmethod
+    def restore_user_backup(self, user_id: str, backup_path: Optional[str] = None, backup_dir: str = "backups") -> str:
+        """Restore a teacher from a snapshot (the latest one by default)"""
+
+    @abstractmethod
+    def verify_attendance_counters(self, class_id: Optional[str] = None, repair: bool = True) -> Dict[str, Any]:
+        """Check the per-record attendance counters against the marks"""
+
+    @abstractmethod
+    def reconcile_database_stats(self) -> Dict[str, Any]:
+        """Recount the get_database_stats counters and report any drift"""
+
+    @abstractmethod
+    def get_database_stats(self) -> Dict[str, Any]:
+        """Get overall database statistics"""
+
+    @abstractmethod
+    def rebuild_email_indexes(self) -> Dict[str, int]:
+        """Rebuild the email lookup indexes; counts per index"""
+
+    @abstractmethod
+    def rebuild_class_routes(self) -> int:
+        """Rebuild the class -> teacher lookup; number of classes"""
+
+    @abstractmethod
+    def rebuild_contact_index(self) -> int:
+        """Rebuild the contact email lookup; number of messages"""
+
+    # ==================== LOCK METRICS ====================
+
+    def get_lock_stats(self) -> Dict[str, Any]:
+        """Lock acquisition counts and wait times (ms) for contended acquisitions"""
+        with self._lock_stats_lock:
+            counters = dict(self._lock_counters)
+        counters["avg_wait_ms"] = round(counters["total_wait_ms"] / counters["contended"], 3) if counters["contended"] else 0.0
+        counters["total_wait_ms"] = round(counters["total_wait_ms"], 3)
+        counters["max_wait_ms"] = round(counters["max_wait_ms"], 3)
+        return counters
+
+    # ==================== USER OPERATIONS ====================
+
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Get user data, recomputing the overview first if it was left stale"""
+        user_data = self._read_user(user_id)
+        if user_data and (user_data.get("overview") or {}).get("stale"):
+            user_data = self.update_user_overview(user_id) or user_data
+        return user_data
+
+    # ==================== STATISTICS ====================
+
+    def _active_students(self, class_data: Dict[str, Any], class_id: str = None) -> List[Dict[str, Any]]:
+        """Student records of a class that have an ACTIVE enrollment (all records without class_id)"""
+        students = class_data.get("students", [])
+        if not class_id:
+            return students
+        enrollments = self.get_class_enrollments(str(class_id))
+        active_record_ids = {e.get("student_record_id") for e in enrollments}
+        return [s for s in students if s.get("id") in active_record_ids]
+
+    def calculate_class_statistics(self, class_data: Dict[str, Any], class_id: str = None) -> Dict[str, Any]:
+        """Calculate statistics for a class - counts only ACTIVE students"""
+        active_students = self._active_students(class_data, class_id)
+        
+        if not active_students:
+            return {
+                "total_students": 0,
+                "avg_attendance": 0.000,
+                "at_risk_count": 0,
+                "excellent_count": 0
+            }
+        
+        counts = [counts_tuple(record_counts(s)) for s in active_students]
+        stats = summarize_class(counts, class_data.get("thresholds"))
+        stats["last_calculated"] = datetime.utcnow().isoformat()
+        return stats
+
+    def get_teacher_statistics(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        """Statistics for every class of a teacher, keyed by class id"""
+        # get_all_classes already filters each class down to its active students
+        return {
+            str(class_data.get("id")): self.calculate_class_statistics(class_data)
+            for class_data in self.get_all_classes(user_id)
+        }
+
+    def calculate_student_statistics(self, student_record: Dict[str, Any], thresholds: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Calculate attendance statistics for a student"""
+        present, late, absent, total = counts_tuple(record_counts(student_record))
+        return summarize_student(present, late, absent, total, thresholds)
+
+    # ==================== ENROLLMENT OPERATIONS ====================
+
+    def _generate_student_record_id(self) -> int:
+        """Generate unique student record ID for a class"""
+        return int(datetime.utcnow().timestamp() * 1000)
+
+    def get_teacher_name(self, teacher_id: str) -> str:
+        """Get teacher name by ID"""
+        teacher = self._read_user(teacher_id)
+        return teacher.get('name', 'Unknown') if teacher else 'Unknown'
+
+    def get_student_enrollments(self, student_id: str) -> List[Dict[str, Any]]:
+        """Get all classes a student is enrolled in"""
+        student_data = self.get_student(student_id)
+        if not student_data:
+            return []
+        return student_data.get("enrolled_classes", [])
+
+    def get_student_class_details(self, student_id: str, class_id: str) -> Optional[Dict[str, Any]]:
+        """Get detailed information about a student's enrollment in a class"""
+        print(f"[GET_DETAILS] Getting details for student {student_id} in class {class_id}")
+        
+        class_data = self.get_class_by_id(class_id)
+        if not class_data:
+            print(f"[GET_DETAILS] Class not found")
+            return None
+        
+        enrollments = self.get_class_enrollments(class_id)
+        student_enrollment = None
+        for e in enrollments:
+            if e.get("student_id") == student_id:
+                student_enrollment = e
+                break
+        
+        if not student_enrollment:
+            print(f"[GET_DETAILS] Student not enrolled (no active enrollment)")
+            return None
+        
+        print(f"[GET_DETAILS] Student has active enrollment")
+        
+        student_record_id = student_enrollment.get("student_record_id")
+        student_record = None
+        for student in class_data.get("students", []):
+            if student.get("id") == student_record_id:
+                student_record = student
+                print(f"[GET_DETAILS] Found student record by record_id: {student_record_id}")
+                break
+        
+        if not student_record:
+            print(f"[GET_DETAILS] Student record not found in class")
+            return None
+        
+        print(f"[GET_DETAILS] Returning class details with {len(student_record.get('attendance', {}))} attendance records")
+        
+        return {
+            "class_id": class_id,
+            "class_name": class_data.get("name", ""),
+            "teacher_id": class_data.get("teacher_id", ""),
+            "student_record": student_record,
+            "thresholds": class_data.get("thresholds"),
+            "statistics": self.calculate_student_statistics(student_record, class_data.get("thresholds"))
+        }
+
+    # ==================== QR CODE SYSTEM ====================
+
+    def _generate_qr_code(self) -> str:
+        import random, string
+        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+
+    # ==================== BACKUP & MAINTENANCE ====================
+
+    def _backup_object_path(self, backup_dir: str, digest: str) -> str:
+        return os.path.join(backup_dir, "objects", digest[:2], digest)
+
+    def _store_backup_object(self, backup_dir: str, digest: str, content: bytes) -> str:
+        """Write content into the object store once (content-addressed, atomic)"""
+        object_path = self._backup_object_path(backup_dir, digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, object_path)
+        return object_path
+
+    def _link_backup_object(self, backup_dir: str, digest: str, content: Optional[bytes], target: str):
+        """Hardlink an object into a snapshot (copy when the filesystem can't link)"""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        object_path = self._backup_object_path(backup_dir, digest)
+        try:
+            os.link(object_path, target)
+        except FileNotFoundError:
+            # Garbage-collected since the previous snapshot referenced it
+            if content is None:
+                raise
+            os.link(self._store_backup_object(backup_dir, digest, content), target)
+        except OSError:
+            shutil.copy2(object_path, target)
+
+    def _read_backup_manifest(self, backup_path: str) -> Optional[Dict[str, Any]]:
+        """A snapshot's manifest.json (older snapshots may use the file store's codec)"""
+        try:
+            with open(os.path.join(backup_path, "manifest.json"), 'rb') as f:
+                return decode_any(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error reading manifest of {backup_path}: {e}")
+            return None
+
+    def _write_backup_manifest(self, backup_path: str, manifest: Dict[str, Any]):
+        """Write manifest.json last and atomically: a snapshot without one is ignored"""
+        manifest_path = os.path.join(backup_path, "manifest.json")
+        tmp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, manifest_path)
+
+    def _new_backup_path(self, user_id: str, backup_dir: str) -> str:
+        """Create an empty, uniquely named snapshot directory"""
+        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        backup_path = os.path.join(backup_dir, f"user_{user_id}_{timestamp}")
+        suffix = 1
+        while os.path.exists(backup_path):
+            suffix += 1
+            backup_path = os.path.join(backup_dir, f"user_{user_id}_{timestamp}_{suffix}")
+        os.makedirs(backup_path)
+        return backup_path
+
+    def list_backups(self, user_id: Optional[str] = None, backup_dir: str = "backups") -> List[Dict[str, Any]]:
+        """Manifests of the incremental snapshots in backup_dir, oldest first"""
+        if not os.path.exists(backup_dir):
+            return []
+        backups = []
+        for name in os.listdir(backup_dir):
+            if not name.startswith("user_"):
+                continue
+            manifest = self._read_backup_manifest(os.path.join(backup_dir, name))
+            if manifest and (user_id is None or manifest.get("user_id") == user_id):
+                backups.append({**manifest, "path": os.path.join(backup_dir, name)})
+        backups.sort(key=lambda m: m.get("created_at", ""))
+        return backups
+
+    def backup_all_users(self, backup_dir: str = "backups", max_workers: int = BACKUP_WORKERS) -> Dict[str, Any]:
+        """Back up every teacher in parallel on a bounded worker pool; maps user_id -> path (or error)"""
+        results: Dict[str, Any] = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="backup") as pool:
+            futures = {pool.submit(self.backup_user_data, user_id, backup_dir): user_id for user_id in self._iter_user_ids()}
+            for future, user_id in futures.items():
+                try:
+                    results[user_id] = future.result()
+                except Exception as e:
+                    print(f"[BACKUP] {user_id} failed: {e}")
+                    results[user_id] = {"error": str(e)}
+        return results
+
+    def _load_backup_manifest(self, user_id: str, backup_path: Optional[str], backup_dir: str) -> Tuple[str, Dict[str, Any]]:
+        """(path, manifest) of the snapshot to restore - the latest one when backup_path is None"""
+        if backup_path is None:
+            backups = self.list_backups(user_id, backup_dir)
+            if not backups:
+                raise ValueError(f"No backups found for user {user_id}")
+            backup_path = backups[-1]["path"]
+        manifest = self._read_backup_manifest(backup_path)
+        if not manifest or manifest.get("user_id") != user_id:
+            raise ValueError(f"{backup_path} is not a backup of user {user_id}")
+        return backup_path, manifest
+
+    def _read_backup_file(self, backup_path: str, relative: str, entry: Dict[str, Any]) -> bytes:
+        """Content of one snapshot file, checked against its manifest checksum"""
+        with open(os.path.join(backup_path, relative), 'rb') as f:
+            content = f.read()
+        if hashlib.sha256(content).hexdigest() != entry["sha256"]:
+            raise ValueError(f"Backup file {relative} is corrupted (checksum mismatch)")
+        return content
+
+    def _user_footprint(self, user_id: str) -> Dict[str, int]:
+        """What a teacher contributes to the persisted stats counters"""
+        if self._read_user(user_id) is None:
+            return {"users": 0, "classes": 0, "class_students": 0}
+        classes = self.get_all_classes(user_id)
+        return {
+            "users": 1,
+            "classes": len(classes),
+            "class_students": sum(len(c.get("students", [])) for c in classes),
+        }
+
+    def prune_backups(self, keep: int = BACKUP_KEEP, user_id: Optional[str] = None, backup_dir: str = "backups") -> Dict[str, int]:
+        """Keep the newest `keep` snapshots per user, then drop objects no remaining manifest references"""
+        by_user: Dict[str, List[Dict[str, Any]]] = {}
+        for manifest in self.list_backups(user_id, backup_dir):
+            by_user.setdefault(manifest["user_id"], []).append(manifest)
+        
+        removed_snapshots = 0
+        for manifests in by_user.values():
+            for manifest in manifests[:max(len(manifests) - keep, 0)]:
+                shutil.rmtree(manifest["path"])
+                removed_snapshots += 1
+        
+        # Link counts can't tell: snapshots copied on filesystems without
+        # hardlinks still need their objects. Ask every remaining manifest.
+        referenced = {
+            entry["sha256"]
+            for manifest in self.list_backups(None, backup_dir)
+            for entry in manifest.get("files", {}).values()
+        }
+        removed_objects = 0
+        objects_dir = os.path.join(backup_dir, "objects")
+        if os.path.exists(objects_dir):
+            for root, _, filenames in os.walk(objects_dir):
+                for filename in filenames:
+                    object_path = os.path.join(root, filename)
+                    if filename not in referenced and not filename.endswith(".tmp"):
+                        os.remove(object_path)
+                        removed_objects += 1
+        
+        print(f"[BACKUP] Pruned {removed_snapshots} snapshots and {removed_objects} objects")
+        return {"snapshots": removed_snapshots, "objects": removed_objects}
+
+    def start_stats_reconciler(self, interval: float = STATS_RECONCILE_INTERVAL) -> threading.Thread:
+        """Re-derive the stats counters every `interval` seconds on a daemon thread"""
+        if self._stats_reconciler and self._stats_reconciler.is_alive():
+            return self._stats_reconciler
+        
+        def run():
+            while not self._stats_reconciler_stop.wait(interval):
+                try:
+                    self.reconcile_database_stats()
+                except Exception as e:
+                    print(f"[STATS] Reconciliation failed: {e}")
+        
+        self._stats_reconciler_stop.clear()
+        self._stats_reconciler = threading.Thread(target=run, name="stats-reconciler", daemon=True)
+        self._stats_reconciler.start()
+        return self._stats_reconciler
+
+    def stop_stats_reconciler(self):
+        self._stats_reconciler_stop.set()
+        if self._stats_reconciler:
+            self._stats_reconciler.join()
+            self._stats_reconciler = None
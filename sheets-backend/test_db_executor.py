@@ -0,0 +1,98 @@
+"""DBExecutor and the query helpers that run on it"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import db_executor
+from db_executor import DBExecutor
+
+
+def test_calls_run_off_the_event_loop_thread():
+    executor = DBExecutor(max_workers=2)
+
+    async def main():
+        return await executor.run(threading.current_thread)
+
+    try:
+        worker = asyncio.run(main())
+        assert worker is not threading.main_thread()
+        assert worker.name.startswith("supabase")
+    finally:
+        executor.shutdown()
+
+
+def test_in_flight_calls_never_exceed_the_pool_size():
+    executor = DBExecutor(max_workers=2)
+    active, peak = 0, 0
+    lock = threading.Lock()
+
+    def slow_call():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.02)
+        with lock:
+            active -= 1
+
+    async def main():
+        await asyncio.gather(*(executor.run(slow_call) for _ in range(6)))
+
+    try:
+        asyncio.run(main())
+        stats = executor.stats()
+    finally:
+        executor.shutdown()
+
+    assert peak == 2
+    assert stats["peak_in_flight"] == 2
+    assert stats["peak_queued"] >= 4
+    assert stats["total_calls"] == 6
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+
+
+def test_errors_are_counted_and_release_the_slot():
+    executor = DBExecutor(max_workers=1)
+
+    def boom():
+        raise RuntimeError("connection reset")
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await executor.run(boom)
+        # The failed call gave its slot back
+        return await asyncio.wait_for(executor.run(lambda: "ok"), timeout=1)
+
+    try:
+        assert asyncio.run(main()) == "ok"
+        stats = executor.stats()
+    finally:
+        executor.shutdown()
+
+    assert stats["total_calls"] == 2
+    assert stats["total_errors"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_db_call_and_fetch_one(supabase, monkeypatch):
+    executor = DBExecutor(max_workers=2)
+    monkeypatch.setattr(db_executor, "db_executor", executor)
+    supabase.rows("users").append({"id": "t1", "email": "t@example.com"})
+
+    async def main():
+        res = await db_executor.db_call(supabase.table("users").select("id"))
+        found = await db_executor.fetch_one(supabase.table("users").select("*").eq("id", "t1"))
+        missing = await db_executor.fetch_one(supabase.table("users").select("*").eq("id", "t2"))
+        return res.data, found, missing
+
+    try:
+        rows, found, missing = asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+    assert rows == [{"id": "t1"}]
+    assert found == {"id": "t1", "email": "t@example.com"}
+    assert missing is None
+    assert executor.stats()["total_calls"] == 3
@@ -0,0 +1,317 @@
+"""File-store internals of the JSON engine: journals, caches, locks and layouts"""
+import json
+import os
+import threading
+
+import pytest
+
+import db_manager
+from db_manager import DatabaseManager
+
+
+@pytest.fixture
+def db(tmp_path):
+    return DatabaseManager(base_dir=str(tmp_path / "data"))
+
+
+def reopen(db):
+    """A second manager on the same files, as another worker process would have"""
+    return DatabaseManager(base_dir=db.base_dir)
+
+
+def add_class_with_students(db, count=2, teacher_id="u1", class_id="10"):
+    db.create_user(teacher_id, f"{teacher_id}@example.com", "Teacher", "hash")
+    db.create_class(teacher_id, {"id": int(class_id), "name": "Math", "students": [], "customColumns": []})
+    records = []
+    for i in range(count):
+        db.create_student(f"s{i}", f"s{i}@example.com", f"S{i}", "hash")
+        records.append(db.enroll_student(f"s{i}", class_id, {"name": f"S{i}", "rollNo": str(i), "email": None}))
+    return [r["student_record_id"] for r in records]
+
+
+def attendance(db, teacher_id="u1", class_id="10"):
+    return {s["id"]: s.get("attendance", {}) for s in db.get_class(teacher_id, class_id)["students"]}
+
+
+# ==================== CLASS ROUTING ====================
+
+
+def no_probing(db, monkeypatch):
+    """Fail the test if a lookup falls back to walking the teacher directories"""
+    probes = []
+    real = db._probe_class_teacher
+    monkeypatch.setattr(db, "_probe_class_teacher", lambda class_id: probes.append(class_id) or real(class_id))
+    return probes
+
+
+def test_classes_resolve_from_the_routing_table(db, monkeypatch):
+    db.create_user("u1", "u1@example.com", "A", "hash")
+    db.create_user("u2", "u2@example.com", "B", "hash")
+    other = reopen(db)
+    other.resolve_class_teacher("missing")  # builds its table before the classes exist
+    db.create_class("u2", {"id": 20, "name": "Art", "students": [], "customColumns": []})
+
+    probes = no_probing(other, monkeypatch)
+    # Another worker picks the new route up from the change log
+    assert other.get_class_by_id("20")["name"] == "Art"
+    assert probes == []
+
+    db.delete_class("u2", "20")
+    assert other.resolve_class_teacher("20") is None
+
+
+def test_lost_route_is_healed_by_one_probe(db, monkeypatch):
+    db.create_user("u1", "u1@example.com", "A", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+    for path in (db.get_index_file(db_manager.CLASS_ROUTES_INDEX), db.get_class_routes_log()):
+        if os.path.exists(path):
+            os.remove(path)
+    db._save_class_routes({})
+
+    fresh = reopen(db)
+    probes = no_probing(fresh, monkeypatch)
+    assert fresh.resolve_class_teacher("10") == "u1"
+    assert fresh.resolve_class_teacher("10") == "u1"
+    assert reopen(db).resolve_class_teacher("10") == "u1"
+    # Unknown ids are probed once per table change, not on every lookup
+    assert fresh.resolve_class_teacher("99") is None
+    assert fresh.resolve_class_teacher("99") is None
+    assert probes == ["10", "99"]
+
+
+def test_route_log_is_folded_into_the_snapshot(db, monkeypatch):
+    monkeypatch.setattr(db_manager, "CLASS_ROUTES_LOG_BYTES", 1)
+    db.create_user("u1", "u1@example.com", "A", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+    assert not os.path.exists(db.get_class_routes_log())
+    assert db.read_json(db.get_index_file(db_manager.CLASS_ROUTES_INDEX)) == {"10": "u1"}
+    assert reopen(db).resolve_class_teacher("10") == "u1"
+
+
+# ==================== ATTENDANCE JOURNAL ====================
+
+
+def test_scans_are_journaled_and_folded_in_on_stop(db):
+    ids = add_class_with_students(db)
+    class_file = db.get_class_file("u1", "10")
+    journal_file = db.get_attendance_journal_file("10")
+    code = db.start_qr_session("10", "u1")["current_code"]
+
+    before = os.stat(class_file).st_mtime_ns
+    date = db.scan_qr_code("s0", "10", code)["date"]
+    assert os.stat(class_file).st_mtime_ns == before
+    assert os.path.getsize(journal_file) > 0
+    # Readers, in this process or another, replay the journal over the snapshot
+    assert attendance(db)[ids[0]] == {date: "P"}
+    assert attendance(reopen(db))[ids[0]] == {date: "P"}
+
+    db.stop_qr_session("10", "u1")
+    assert not os.path.exists(journal_file)
+    snapshot = db.read_json(class_file)
+    assert {s["id"]: s["attendance"] for s in snapshot["students"]} == {ids[0]: {date: "P"}, ids[1]: {date: "A"}}
+    assert snapshot["attendance_counts"] == {"present": 1, "late": 0, "absent": 1, "total": 2}
+
+
+def test_torn_journal_line_is_skipped(db):
+    ids = add_class_with_students(db, count=1)
+    db._append_attendance_marks("10", [("2026-03-01", ids[0], "P")])
+    with open(db.get_attendance_journal_file("10"), "a", encoding="utf-8") as f:
+        f.write('{"date": "2026-03-02", "record_')
+    assert attendance(db)[ids[0]] == {"2026-03-01": "P"}
+
+
+def test_interrupted_compaction_is_replayed_and_finished(db):
+    ids = add_class_with_students(db, count=1)
+    db._append_attendance_marks("10", [("2026-03-01", ids[0], "P")])
+    journal_file = db.get_attendance_journal_file("10")
+    # A compaction that crashed after setting the journal aside
+    os.replace(journal_file, f"{journal_file}.compacting")
+    db._append_attendance_marks("10", [("2026-03-01", ids[0], "L"), ("2026-03-02", ids[0], "A")])
+
+    assert attendance(db)[ids[0]] == {"2026-03-01": "L", "2026-03-02": "A"}
+    assert db.compact_attendance_journal("10")
+    assert not os.path.exists(f"{journal_file}.compacting")
+    assert attendance(db)[ids[0]] == {"2026-03-01": "L", "2026-03-02": "A"}
+
+
+def test_journal_is_compacted_past_its_size_limit(db, monkeypatch):
+    ids = add_class_with_students(db, count=1)
+    monkeypatch.setattr(db_manager, "JOURNAL_COMPACT_BYTES", 1)
+    db._append_attendance_marks("10", [("2026-03-01", ids[0], "P")])
+    assert not os.path.exists(db.get_attendance_journal_file("10"))
+    assert db.read_json(db.get_class_file("u1", "10"))["students"][0]["attendance"] == {"2026-03-01": "P"}
+
+
+# ==================== READ CACHE ====================
+
+
+def test_read_cache_serves_unchanged_files_and_private_copies(db):
+    path = os.path.join(db.base_dir, "sample.json")
+    db.write_json(path, {"items": [1, 2]})
+    db.clear_read_cache()
+
+    first = db.read_json(path)
+    first["items"].append(3)
+    assert db.read_json(path) == {"items": [1, 2]}
+    stats = db.get_read_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_read_cache_sees_writes_from_other_processes(db):
+    path = os.path.join(db.base_dir, "sample.json")
+    db.write_json(path, {"version": 1})
+    assert db.read_json(path) == {"version": 1}
+
+    # Same size, same tick: the atomic rename still changes the inode
+    reopen(db).write_json(path, {"version": 2})
+    assert db.read_json(path) == {"version": 2}
+
+    os.remove(path)
+    assert db.read_json(path) is None
+    assert db.get_read_cache_stats()["entries"] == 0
+
+
+def test_read_cache_stays_within_its_byte_budget(tmp_path):
+    db = DatabaseManager(base_dir=str(tmp_path / "data"), read_cache_max_bytes=4096)
+    for i in range(20):
+        db.write_json(os.path.join(db.base_dir, f"f{i}.json"), {"payload": "x" * 200})
+    stats = db.get_read_cache_stats()
+    assert stats["bytes"] <= 4096
+    assert stats["evictions"] > 0
+    # Entries over a quarter of the budget are never cached
+    db.write_json(os.path.join(db.base_dir, "big.json"), {"payload": "x" * 2048})
+    assert os.path.join(db.base_dir, "big.json") not in db._read_cache
+
+
+def test_read_cache_can_be_disabled(tmp_path):
+    db = DatabaseManager(base_dir=str(tmp_path / "data"), read_cache=False)
+    path = os.path.join(db.base_dir, "sample.json")
+    db.write_json(path, {"a": 1})
+    assert db.read_json(path) == {"a": 1}
+    assert db.get_read_cache_stats()["entries"] == 0
+
+
+# ==================== FILE LOCKS ====================
+
+
+def test_locks_are_taken_in_rank_order(db, monkeypatch):
+    db.create_user("u1", "u1@example.com", "A", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+    taken = []
+    real = db._acquire_file_lock
+    monkeypatch.setattr(db, "_acquire_file_lock", lambda lock_file: taken.append(lock_file) or real(lock_file))
+
+    paths = [
+        db.get_index_file("users_by_email"),
+        db.get_user_file("u1"),
+        db.get_qr_session_file("10"),
+        db.get_enrollment_file("10"),
+        db.get_class_file("u1", "10"),
+    ]
+    with db._locked(*paths):
+        # Re-entrant: already held locks are not taken again
+        with db._locked(db.get_user_file("u1"), db.get_class_file("u1", "10")):
+            pass
+    assert taken == [db._get_lock_file(p) for p in reversed(paths)]
+
+
+def test_locks_serialize_read_modify_writes(db):
+    path = os.path.join(db.base_dir, "counter.json")
+    db.write_json(path, {"n": 0})
+    workers = [reopen(db) for _ in range(4)]
+
+    def bump(worker):
+        for _ in range(25):
+            with worker._locked(path):
+                data = worker.read_json(path)
+                data["n"] += 1
+                worker.write_json(path, data)
+
+    threads = [threading.Thread(target=bump, args=(w,)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db.read_json(path)["n"] == 100
+    assert sum(w.get_lock_stats()["acquired"] for w in workers) == 100
+
+
+def test_flat_and_sharded_paths_share_a_lock(db):
+    flat = os.path.join(db.users_dir, "u1", "user.json")
+    sharded = os.path.join(db.users_dir, *db._shard_parts("u1"), "u1", "user.json")
+    assert db._get_lock_file(flat) == db._get_lock_file(sharded)
+
+
+# ==================== CONTACT LOG ====================
+
+
+def test_contact_log_rotates_and_stays_indexed(db, monkeypatch):
+    monkeypatch.setattr(db_manager, "CONTACT_SEGMENT_BYTES", 200)
+    for i in range(6):
+        assert db.save_contact_message(f"{'a' if i % 2 else 'b'}@example.com", {"subject": f"m{i}"})
+
+    assert len(db._contact_segments()) > 1
+    assert [m["subject"] for m in db.get_contact_messages()] == [f"m{i}" for i in range(6)]
+    assert [m["subject"] for m in db.get_contact_messages("a@example.com")] == ["m1", "m3", "m5"]
+    assert [m["subject"] for m in db.get_contact_messages("a@example.com", offset=1, limit=1)] == ["m3"]
+    # Another worker follows the index log written here
+    assert [m["subject"] for m in reopen(db).get_contact_messages("b@example.com")] == ["m0", "m2", "m4"]
+
+
+def test_contact_index_is_rebuilt_when_lost(db):
+    db.save_contact_message("a@example.com", {"subject": "one"})
+    os.remove(db.get_contact_index_log())
+    assert [m["subject"] for m in reopen(db).get_contact_messages("a@example.com")] == ["one"]
+
+
+def test_torn_contact_line_does_not_corrupt_the_next_message(db):
+    db.save_contact_message("a@example.com", {"subject": "one"})
+    with open(db.get_contact_segment_file(db._contact_segments()[-1]), "ab") as f:
+        f.write(b'{"email": "a@exa')
+    db.save_contact_message("a@example.com", {"subject": "two"})
+    assert [m["subject"] for m in db.get_contact_messages("a@example.com")] == ["one", "two"]
+    assert db.rebuild_contact_index() == 2
+
+
+def test_legacy_contact_file_is_migrated_once(db):
+    legacy = os.path.join(db.contact_dir, "contact.json")
+    with open(legacy, "w", encoding="utf-8") as f:
+        json.dump([{"email": "old@example.com", "subject": "legacy"}], f)
+    db.save_contact_message("new@example.com", {"subject": "fresh"})
+    assert [m["subject"] for m in db.get_contact_messages()] == ["legacy", "fresh"]
+    assert not os.path.exists(legacy)
+    assert [m["subject"] for m in reopen(db).get_contact_messages("old@example.com")] == ["legacy"]
+
+
+# ==================== SHARDED LAYOUT ====================
+
+
+def test_flat_trees_migrate_to_the_sharded_layout(tmp_path):
+    base_dir = str(tmp_path / "data")
+    flat = DatabaseManager(base_dir=base_dir, sharded_layout=False)
+    add_class_with_students(flat, count=1)
+    ids = [s["id"] for s in flat.get_class("u1", "10")["students"]]
+    assert os.path.exists(os.path.join(base_dir, "users", "u1", "user.json"))
+
+    db = DatabaseManager(base_dir=base_dir)
+    # Flat trees keep working before the migration...
+    assert db.get_class_by_id("10")["name"] == "Math"
+    stale_path = db.get_class_file("u1", "10")
+
+    assert db.migrate_to_sharded_layout() == {"users": 1, "students": 1}
+    assert not os.path.exists(os.path.join(base_dir, "users", "u1"))
+    assert db.get_user_dir("u1") == os.path.join(base_dir, "users", *db._shard_parts("u1"), "u1")
+    assert db.get_student_dir("s0").startswith(os.path.join(base_dir, "students", *db._shard_parts("s0")))
+
+    # ... and after it, even through a path built before the move
+    assert db.read_json(stale_path)["name"] == "Math"
+    assert db.get_user_by_email("u1@example.com")["id"] == "u1"
+    assert [s["id"] for s in reopen(db).get_class("u1", "10")["students"]] == ids
+    assert sorted(db._iter_user_ids()) == ["u1"]
+    assert db.migrate_to_sharded_layout() == {"users": 0, "students": 0}
+
+
+def test_new_entities_start_sharded(db):
+    db.create_user("u9", "u9@example.com", "A", "hash")
+    assert os.path.exists(os.path.join(db.users_dir, *db._shard_parts("u9"), "u9", "user.json"))
+    assert not os.path.exists(os.path.join(db.users_dir, "u9"))
@@ -0,0 +1,496 @@
+"""API helpers and endpoints of main.py, against the in-memory Supabase stand-in"""
+import asyncio
+import time
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches(supabase):
+    for cache in (main.identity_cache, main.token_version_cache, main.qr_roster_cache):
+        cache.clear()
+    yield
+    for cache in (main.identity_cache, main.token_version_cache, main.qr_roster_cache):
+        cache.clear()
+
+
+def add_teacher(supabase, teacher_id="t1", email="t@example.com", password="secret"):
+    row = {
+        "id": teacher_id,
+        "email": email,
+        "name": "Teacher",
+        "password": main.get_password_hash(password),
+        "verified": True,
+    }
+    supabase.rows("teachers").append(row)
+    return main.teacher_from_row(row)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def rejected(token):
+    with pytest.raises(HTTPException) as err:
+        run(main.resolve_principal(token))
+    return err.value
+
+
+# ==================== TOKENS ====================
+
+
+def test_token_resolves_from_claims_and_cached_version(supabase):
+    teacher = add_teacher(supabase)
+    token = main.create_user_token(teacher, "teacher")
+
+    assert run(main.resolve_principal(token)) == {"id": "t1", "email": "t@example.com", "role": "teacher"}
+    assert run(main.resolve_principal(token))["id"] == "t1"
+    # The version is read once, then served from the cache
+    assert supabase.count("teachers", "select") == 1
+
+
+def test_password_change_revokes_older_tokens(supabase):
+    teacher = add_teacher(supabase)
+    old_token = main.create_user_token(teacher, "teacher")
+    run(main.resolve_principal(old_token))
+
+    new_hash = main.get_password_hash("changed")
+    supabase.rows("teachers")[0]["password"] = new_hash
+    main.bump_token_version(teacher, new_hash)
+
+    assert rejected(old_token).status_code == 401
+    new_token = main.create_user_token({**teacher, "password": new_hash}, "teacher")
+    assert run(main.resolve_principal(new_token))["id"] == "t1"
+
+
+def test_password_changed_on_another_worker_is_picked_up(supabase):
+    teacher = add_teacher(supabase)
+    old_token = main.create_user_token(teacher, "teacher")
+    run(main.resolve_principal(old_token))
+
+    # Another worker changed the password; this one still caches the old version
+    time.sleep(1)
+    new_hash = main.get_password_hash("changed")
+    supabase.rows("teachers")[0]["password"] = new_hash
+    new_token = main.create_user_token({**teacher, "password": new_hash}, "teacher")
+
+    assert run(main.resolve_principal(new_token))["id"] == "t1"
+    assert rejected(old_token).status_code == 401
+
+
+def test_deleted_account_revokes_tokens(supabase):
+    teacher = add_teacher(supabase)
+    token = main.create_user_token(teacher, "teacher")
+    supabase.rows("teachers").clear()
+    main.bump_token_version(teacher, None)
+    assert rejected(token).status_code == 401
+
+
+def test_tokens_without_version_claims_are_refused(supabase):
+    add_teacher(supabase)
+    legacy = main.create_access_token({"sub": "t@example.com", "role": "teacher"})
+    assert rejected(legacy).status_code == 401
+    assert supabase.count("teachers", "select") == 0
+
+
+def test_verify_token_returns_the_principals_email(supabase):
+    teacher = add_teacher(supabase)
+    token = main.create_user_token(teacher, "teacher")
+    principal = run(main.resolve_principal(token))
+    assert run(main.verify_token(principal)) == "t@example.com"
+
+
+def test_forged_token_is_refused(supabase):
+    teacher = add_teacher(supabase)
+    forged = jwt.encode({"sub": teacher["email"], "uid": "t1", "ver": "x"}, "a-different-secret-key-of-32-bytes!", algorithm="HS256")
+    assert rejected(forged).status_code == 401
+
+
+# ==================== CLASSES ====================
+
+
+def auth(teacher, role="teacher"):
+    return {"Authorization": f"Bearer {main.create_user_token(teacher, role)}"}
+
+
+def add_class(supabase, class_id=10, teacher_id="t1", students=0, dates=()):
+    supabase.rows("classes").append({
+        "id": class_id, "teacher_id": teacher_id, "name": "Math",
+        "custom_columns": [], "thresholds": {}, "statistics": {},
+        "created_at": "2026-01-01T00:00:00", "updated_at": "2026-01-01T00:00:00",
+    })
+    for srid in range(1, students + 1):
+        supabase.rows("class_enrollments").append({
+            "class_id": class_id, "student_id": f"s{srid}", "student_record_id": srid,
+            "name": f"Student {srid}", "roll_no": str(srid), "email": None, "status": "active",
+        })
+        for day in dates:
+            supabase.rows("attendance_entries").append({
+                "class_id": class_id, "student_record_id": srid, "attendance_date": day, "status": "P",
+            })
+
+
+def class_payload(students, dates, class_id=10):
+    return {
+        "id": class_id, "name": "Math", "customColumns": [],
+        "students": [
+            {"id": srid, "studentId": f"s{srid}", "name": f"Student {srid}", "rollNo": str(srid),
+             "email": None, "attendance": {day: "P" for day in dates}}
+            for srid in range(1, students + 1)
+        ],
+    }
+
+
+def test_class_list_pages_by_keyset_cursor(supabase, client):
+    teacher = add_teacher(supabase)
+    for class_id in (5, 1, 4, 2, 3):
+        add_class(supabase, class_id=class_id)
+    add_class(supabase, class_id=9, teacher_id="t2")
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        res = client.get("/classes", params=params, headers=auth(teacher))
+        pages.append([c["id"] for c in res.json()])
+        cursor = res.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert pages == [[1, 2], [3, 4], [5]]
+
+    everything = client.get("/classes", headers=auth(teacher))
+    assert [c["id"] for c in everything.json()] == [1, 2, 3, 4, 5]
+    assert "X-Next-Cursor" not in everything.headers
+
+
+def test_class_list_projection_and_summary(supabase, client):
+    teacher = add_teacher(supabase)
+    add_class(supabase)
+
+    res = client.get("/classes", params={"fields": "name, thresholds"}, headers=auth(teacher))
+    assert res.json() == [{"id": 10, "name": "Math", "thresholds": {}}]
+    res = client.get("/classes", params={"summary": "true", "fields": "thresholds"}, headers=auth(teacher))
+    assert res.json() == [{"id": 10, "name": "Math", "updated_at": "2026-01-01T00:00:00"}]
+
+
+@pytest.mark.parametrize("params", [
+    {"fields": "name,password"},
+    {"fields": "teacher_id,students"},
+    {"limit": 0},
+    {"limit": main.CLASS_LIST_MAX_LIMIT + 1},
+])
+def test_class_list_rejects_bad_parameters(supabase, client, params):
+    teacher = add_teacher(supabase)
+    res = client.get("/classes", params=params, headers=auth(teacher))
+    assert res.status_code == 400
+    assert supabase.count("classes", "select") == 0
+
+
+@pytest.mark.parametrize("args, expected", [
+    ((None, None, None), (None, None)),
+    ((None, None, "2026-02"), ("2026-02-01", "2026-02-28")),
+    ((None, None, "2024-02"), ("2024-02-01", "2024-02-29")),
+    (("2026-03-01", None, None), ("2026-03-01", None)),
+    ((None, "2026-03-31", None), (None, "2026-03-31")),
+    (("2026-03-01", "2026-03-01", None), ("2026-03-01", "2026-03-01")),
+])
+def test_resolve_date_range(args, expected):
+    assert main.resolve_date_range(*args) == expected
+
+
+@pytest.mark.parametrize("args", [
+    ("2026-03-01", None, "2026-03"),
+    (None, None, "2026-13"),
+    (None, None, "2026"),
+    ("2026-02-30", None, None),
+    ("03/01/2026", None, None),
+    ("2026-03-02", "2026-03-01", None),
+])
+def test_resolve_date_range_rejects(args):
+    with pytest.raises(HTTPException) as err:
+        main.resolve_date_range(*args)
+    assert err.value.status_code == 400
+
+
+def test_get_class_returns_only_the_requested_month(supabase, client):
+    teacher = add_teacher(supabase)
+    add_class(supabase, students=2, dates=["2026-02-27", "2026-03-01", "2026-03-31", "2026-04-01"])
+
+    res = client.get("/classes/10", params={"month": "2026-03"}, headers=auth(teacher))
+    body = res.json()
+    assert body["attendance_range"] == {"from": "2026-03-01", "to": "2026-03-31"}
+    assert [sorted(s["attendance"]) for s in body["students"]] == [["2026-03-01", "2026-03-31"]] * 2
+
+    res = client.get("/classes/10", headers=auth(teacher))
+    assert "attendance_range" not in res.json()
+    assert len(res.json()["students"][0]["attendance"]) == 4
+    assert client.get("/classes/10", params={"month": "March"}, headers=auth(teacher)).status_code == 400
+
+
+def test_get_class_reads_histories_past_one_response(supabase, client):
+    teacher = add_teacher(supabase)
+    dates = [f"2026-{month:02d}-{day:02d}" for month in range(1, 7) for day in range(1, 29)]
+    add_class(supabase, students=6, dates=dates)  # 6 x 168 = 1008 cells
+
+    students = client.get("/classes/10", headers=auth(teacher)).json()["students"]
+    assert sum(len(s["attendance"]) for s in students) == 1008
+
+
+def test_update_class_diffs_against_every_stored_cell(supabase, client):
+    teacher = add_teacher(supabase)
+    dates = [f"2026-03-{day:02d}" for day in range(1, 31)]
+    # 40 x 30 = 1200 stored cells, more than one PostgREST response holds
+    add_class(supabase, students=40, dates=dates)
+    payload = class_payload(40, dates)
+    payload["students"][-1]["attendance"][dates[-1]] = "A"
+
+    res = client.put("/classes/10", json=payload, headers=auth(teacher))
+    assert res.status_code == 200
+    body = res.json()
+    assert (body["attendance_written"], body["enrollments_added"], body["enrollments_updated"]) == (1, 0, 0)
+    assert len(supabase.rows("attendance_entries")) == 1200
+    assert len(supabase.rows("class_enrollments")) == 40
+
+
+def test_update_class_without_attendance_skips_the_attendance_read(supabase, client):
+    teacher = add_teacher(supabase)
+    add_class(supabase, students=2, dates=["2026-02-01", "2026-03-01"])
+
+    res = client.put("/classes/10", json=class_payload(2, []), headers=auth(teacher))
+    assert res.json()["attendance_written"] == 0
+    assert supabase.count("attendance_entries", "select") == 0
+
+
+# ==================== QR STREAM TICKETS ====================
+
+
+@pytest.fixture
+def client(supabase):
+    from fastapi.testclient import TestClient
+    yield TestClient(main.app)
+    main.qr_registry.forget(10)
+
+
+def add_session(supabase, class_id=10, teacher_id="t1"):
+    from test_qr_sessions import active_session
+    supabase.rows("qr_sessions").append({**active_session(class_id, code_age=0), "teacher_id": teacher_id})
+
+
+def test_stream_ticket_is_issued_to_the_session_owner_only(supabase, client):
+    teacher = add_teacher(supabase)
+    other = add_teacher(supabase, "t2", "other@example.com")
+    add_session(supabase)
+
+    def ticket_for(user):
+        headers = {"Authorization": f"Bearer {main.create_user_token(user, 'teacher')}"}
+        return client.post("/qr/session/10/stream-ticket", headers=headers)
+
+    res = ticket_for(teacher)
+    assert res.status_code == 200
+    assert main.decode_stream_ticket(res.json()["ticket"], 10) == "t1"
+    assert ticket_for(other).status_code == 404
+    assert client.post("/qr/session/10/stream-ticket").status_code in (401, 403)
+
+
+def test_stream_accepts_only_a_ticket_for_that_class(supabase, client):
+    teacher = add_teacher(supabase)
+    add_session(supabase)
+    access_token = main.create_user_token(teacher, "teacher")
+
+    assert client.get("/qr/session/10/stream", params={"ticket": access_token}).status_code == 401
+    assert client.get("/qr/session/10/stream", params={"token": access_token}).status_code == 422
+    wrong_class = main.create_stream_ticket("t1", 11)
+    assert client.get("/qr/session/10/stream", params={"ticket": wrong_class}).status_code == 401
+
+
+def test_stream_ticket_expires_and_is_no_access_token(supabase, monkeypatch):
+    add_teacher(supabase)
+    ticket = main.create_stream_ticket("t1", 10)
+    assert rejected(ticket).status_code == 401
+
+    monkeypatch.setattr(main, "QR_STREAM_TICKET_TTL", -1)
+    expired = main.create_stream_ticket("t1", 10)
+    with pytest.raises(HTTPException) as err:
+        main.decode_stream_ticket(expired, 10)
+    assert err.value.status_code == 401
+
+
+# ==================== LIFECYCLE ====================
+
+
+def test_lifespan_starts_and_stops_the_background_work(supabase, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    class RecordingExecutor:
+        closed = False
+
+        def shutdown(self):
+            self.closed = True
+
+    executor = RecordingExecutor()
+    monkeypatch.setattr(main, "db_executor", executor)
+    add_session(supabase)
+
+    with TestClient(main.app):
+        assert main.qr_registry._task is not None
+        assert 10 in main.qr_registry._entries
+    assert main.qr_registry._task is None
+    assert executor.closed
+    main.qr_registry.forget(10)
+
+
+def test_create_class_bulk_inserts_in_chunks(supabase, client, monkeypatch):
+    monkeypatch.setattr(main, "DB_INSERT_CHUNK_SIZE", 2)
+    teacher = add_teacher(supabase)
+
+    res = client.post("/classes", json=class_payload(5, ["2026-01-05", "2026-01-06"]), headers=auth(teacher))
+
+    assert res.status_code == 200
+    body = res.json()
+    assert body["rows_inserted"] == 1 + 5 + 10
+    # 1 class row, 3 enrollment chunks, 5 attendance chunks
+    assert body["round_trips"] == 9
+    assert supabase.count("class_enrollments", "insert") == 3
+    assert supabase.count("attendance_entries", "insert") == 5
+    assert len(supabase.rows("class_enrollments")) == 5
+    assert len(supabase.rows("attendance_entries")) == 10
+
+
+# ==================== QR SESSIONS ====================
+
+
+def start_session(client, teacher, class_id=10):
+    res = client.post("/qr/start-session", json={"class_id": class_id}, headers=auth(teacher))
+    assert res.status_code == 200
+    return res.json()["session"]
+
+
+def test_stop_session_marks_the_rest_absent_in_one_write(supabase, client):
+    teacher = add_teacher(supabase)
+    add_class(supabase, students=4)
+    supabase.rows("class_enrollments")[3]["status"] = "inactive"
+    date = start_session(client, teacher)["attendance_date"]
+    # Record 1 scanned, record 2 was marked late by hand, 3 did neither, 4 left the class
+    supabase.rows("qr_scanned_students").append({"class_id": 10, "student_record_id": 1})
+    supabase.rows("attendance_entries").extend([
+        {"class_id": 10, "student_record_id": 1, "attendance_date": date, "status": "P"},
+        {"class_id": 10, "student_record_id": 2, "attendance_date": date, "status": "L"},
+    ])
+    upserts_before = supabase.count("attendance_entries", "upsert")
+
+    res = client.post("/qr/stop-session", json={"class_id": 10}, headers=auth(teacher))
+    assert res.json() == {"success": True, "absent_count": 1, "date": date}
+    assert supabase.count("attendance_entries", "upsert") == upserts_before + 1
+    marks = {r["student_record_id"]: r["status"] for r in supabase.rows("attendance_entries")}
+    assert marks == {1: "P", 2: "L", 3: "A"}
+    assert supabase.rows("qr_sessions")[0]["status"] == "stopped"
+    assert client.get("/qr/session/10", headers=auth(teacher)).json() == {"active": False}
+
+
+def test_stop_session_keeps_a_mark_written_after_its_read(supabase, client, monkeypatch):
+    teacher = add_teacher(supabase)
+    add_class(supabase, students=1)
+    date = start_session(client, teacher)["attendance_date"]
+
+    real_bulk_upsert = main.bulk_upsert
+
+    async def scan_lands_first(table, rows, on_conflict, ignore_duplicates=False):
+        supabase.rows("attendance_entries").append(
+            {"class_id": 10, "student_record_id": 1, "attendance_date": date, "status": "P"}
+        )
+        return await real_bulk_upsert(table, rows, on_conflict, ignore_duplicates)
+
+    monkeypatch.setattr(main, "bulk_upsert", scan_lands_first)
+    res = client.post("/qr/stop-session", json={"class_id": 10}, headers=auth(teacher))
+    assert res.status_code == 200
+    assert [r["status"] for r in supabase.rows("attendance_entries")] == ["P"]
+
+
+def test_only_the_owner_can_stop_a_session(supabase, client):
+    teacher = add_teacher(supabase)
+    other = add_teacher(supabase, "t2", "other@example.com")
+    add_class(supabase, students=1)
+    start_session(client, teacher)
+
+    res = client.post("/qr/stop-session", json={"class_id": 10}, headers=auth(other))
+    assert res.status_code == 400
+    assert supabase.rows("qr_sessions")[0]["status"] == "active"
+    assert supabase.rows("attendance_entries") == []
+
+
+def add_student(supabase, student_id, email=None):
+    row = {
+        "id": student_id,
+        "email": email or f"{student_id}@example.com",
+        "name": student_id.upper(),
+        "password": main.get_password_hash("secret"),
+        "verified": True,
+    }
+    supabase.rows("students").append(row)
+    return main.student_from_row(row)
+
+
+def scan(client, user, code, class_id=10, role="student"):
+    return client.post(
+        "/qr/scan", params={"class_id": class_id, "qr_code": code}, headers=auth(user, role)
+    )
+
+
+def test_scan_marks_present_from_cached_session_and_roster(supabase, client):
+    teacher = add_teacher(supabase)
+    add_class(supabase, students=2)
+    students = [add_student(supabase, "s1"), add_student(supabase, "s2")]
+    session = start_session(client, teacher)
+    for student in students:
+        scan(client, student, "warm-up")  # resolves the tokens; wrong code, nothing written
+    reads_before = list(supabase.calls)
+
+    for student in students:
+        res = scan(client, student, session["current_code"])
+        assert res.json() == {"success": True, "message": "Attendance marked as Present", "date": session["attendance_date"]}
+
+    new_calls = supabase.calls[len(reads_before):]
+    # One roster read serves both scans; the session is never read back
+    assert new_calls.count(("class_enrollments", "select")) == 1
+    assert ("qr_sessions", "select") not in new_calls
+    assert new_calls.count(("attendance_entries", "upsert")) == 2
+    assert {r["student_record_id"]: r["status"] for r in supabase.rows("attendance_entries")} == {1: "P", 2: "P"}
+    assert len(supabase.rows("qr_scanned_students")) == 2
+    assert client.get("/qr/session/10", headers=auth(teacher)).json()["session"]["scanned_count"] == 2
+
+    # Scanning twice is harmless
+    scan(client, students[0], session["current_code"])
+    assert len(supabase.rows("qr_scanned_students")) == 2
+
+
+def test_scan_rejects_bad_codes_and_strangers(supabase, client):
+    teacher = add_teacher(supabase)
+    add_class(supabase, students=1)
+    student = add_student(supabase, "s1")
+    stranger = add_student(supabase, "s9")
+    code = start_session(client, teacher)["current_code"]
+
+    res = scan(client, student, "WRONG1")
+    assert (res.status_code, res.json()["detail"]) == (400, "Invalid or expired QR code")
+    res = scan(client, stranger, code)
+    assert (res.status_code, res.json()["detail"]) == (400, "Student not actively enrolled in this class")
+    assert scan(client, teacher, code, role="teacher").status_code == 404
+    assert supabase.rows("attendance_entries") == []
+
+
+def test_scan_sees_a_student_enrolled_after_the_roster_was_cached(supabase, client):
+    teacher = add_teacher(supabase)
+    add_class(supabase, students=1)
+    first, late = add_student(supabase, "s1"), add_student(supabase, "late")
+    code = start_session(client, teacher)["current_code"]
+    assert scan(client, first, code).status_code == 200
+
+    supabase.rows("class_enrollments").append({
+        "class_id": 10, "student_id": "late", "student_record_id": 7,
+        "name": "Late", "roll_no": "7", "email": None, "status": "active",
+    })
+    assert scan(client, late, code).status_code == 200
+    assert {r["student_record_id"] for r in supabase.rows("attendance_entries")} == {1, 7}
@@ -0,0 +1,273 @@
+"""QR session registry and broker, against the in-memory Supabase stand-in"""
+import asyncio
+from datetime import datetime, timedelta
+
+import qr_sessions
+from qr_sessions import QRSessionBroker, QRSessionRegistry
+
+
+def active_session(class_id=10, code="111111", code_age=60, rotation_interval=5):
+    started = datetime.utcnow() - timedelta(minutes=10)
+    return {
+        "class_id": class_id,
+        "teacher_id": "t1",
+        "started_at": started.isoformat(),
+        "rotation_interval": rotation_interval,
+        "current_code": code,
+        "code_generated_at": (datetime.utcnow() - timedelta(seconds=code_age)).isoformat(),
+        "attendance_date": started.date().isoformat(),
+        "status": "active",
+        "last_scan_at": None,
+        "stopped_at": None,
+    }
+
+
+def test_only_one_worker_adopts_an_orphaned_session(supabase):
+    supabase.rows("qr_sessions").append(active_session())
+
+    async def scenario():
+        workers = [QRSessionRegistry(), QRSessionRegistry()]
+        for worker in workers:
+            await worker.load_active()
+        # Both see the same stale code and try to take the session over
+        entries = [await worker._load(10) for worker in workers]
+        landed = [await worker._rotate(10, entry) for worker, entry in zip(workers, entries)]
+        return workers, landed
+
+    workers, landed = asyncio.run(scenario())
+    assert landed == [True, False]
+    assert [w._entries[10].owned for w in workers] == [True, False]
+    stored_code = supabase.rows("qr_sessions")[0]["current_code"]
+    assert stored_code != "111111"
+    # The loser re-read the session instead of keeping a code nobody else knows
+    assert {w._entries[10].session["current_code"] for w in workers} == {stored_code}
+
+
+def test_loser_accepts_the_winners_code(supabase):
+    supabase.rows("qr_sessions").append(active_session())
+
+    async def scenario():
+        winner, loser = QRSessionRegistry(), QRSessionRegistry()
+        for worker in (winner, loser):
+            await worker.load_active()
+        stale = await loser._load(10)
+        await winner._tick()
+        await loser._rotate(10, stale)
+        code = supabase.rows("qr_sessions")[0]["current_code"]
+        return await loser.check_code(10, code)
+
+    assert asyncio.run(scenario())["status"] == "active"
+
+
+def test_stopped_session_is_dropped_on_rotation(supabase):
+    supabase.rows("qr_sessions").append(active_session(code_age=0))
+
+    async def scenario():
+        registry = QRSessionRegistry()
+        await registry.start(10, "t1", 5)
+        supabase.rows("qr_sessions")[0]["status"] = "stopped"
+        landed = await registry._rotate(10, registry._entries[10])
+        return registry, landed
+
+    registry, landed = asyncio.run(scenario())
+    assert landed is False
+    assert 10 not in registry._entries
+
+
+def test_owner_rotates_and_briefly_accepts_the_previous_code(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        session = await registry.start(10, "t1", 5)
+        old_code = session["current_code"]
+        await registry._tick()
+        assert registry.stats()["rotations"] == 0  # not due yet
+
+        registry._entries[10].session["code_generated_at"] = (datetime.utcnow() - timedelta(seconds=6)).isoformat()
+        await registry._tick()
+        new_code = supabase.rows("qr_sessions")[0]["current_code"]
+        assert new_code != old_code
+        assert (await registry.check_code(10, new_code))["current_code"] == new_code
+        assert await registry.check_code(10, old_code)
+        registry._entries[10].previous_valid_until = 0
+        try:
+            await registry.check_code(10, old_code)
+        except ValueError as e:
+            return str(e)
+
+    assert asyncio.run(scenario()) == "Invalid or expired QR code"
+
+
+def test_other_workers_serve_from_memory_between_reads(supabase):
+    supabase.rows("qr_sessions").append(active_session(code_age=0))
+
+    async def scenario():
+        registry = QRSessionRegistry()
+        await registry.get(10)
+        reads = supabase.count("qr_sessions", "select")
+        for _ in range(5):
+            await registry.get(10)
+        assert supabase.count("qr_sessions", "select") == reads
+        registry._entries[10].loaded_at -= 60
+        await registry.get(10)
+        assert supabase.count("qr_sessions", "select") == reads + 1
+        # A fresh code means the owner is alive - nobody takes over
+        await registry._tick()
+        return registry._entries[10].owned
+
+    assert asyncio.run(scenario()) is False
+    assert supabase.rows("qr_sessions")[0]["current_code"] == "111111"
+
+
+def test_classes_without_a_session_are_remembered_briefly(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        assert await registry.get(10) is None
+        assert await registry.get(10) is None
+
+    asyncio.run(scenario())
+    assert supabase.count("qr_sessions", "select") == 1
+
+
+def test_scans_are_counted_once_and_last_scan_at_is_coalesced(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        await registry.start(10, "t1", 5)
+        assert registry.record_scan(10, 1) is True
+        assert registry.record_scan(10, 1) is False
+        assert registry.record_scan(10, 2) is True
+        updates = supabase.count("qr_sessions", "update")
+        await registry.flush_last_scan_times()
+        assert supabase.count("qr_sessions", "update") == updates + 1
+        return await registry.get(10)
+
+    session = asyncio.run(scenario())
+    assert (session["scanned_count"], session["scanned_students"]) == (2, [1, 2])
+    assert supabase.rows("qr_sessions")[0]["last_scan_at"] is not None
+
+
+def test_owner_picks_up_scans_handled_by_other_workers(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        changed = []
+        registry.add_listener(changed.append)
+        await registry.start(10, "t1", 5)
+        supabase.rows("qr_scanned_students").append({"class_id": 10, "student_record_id": 7})
+        registry._entries[10].loaded_at -= 60
+        changed.clear()
+        await registry._tick()
+        return changed, await registry.get(10)
+
+    changed, session = asyncio.run(scenario())
+    assert changed == [10]
+    assert session["scanned_students"] == [7]
+
+
+def test_idle_sessions_are_evicted(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        await registry.start(10, "t1", 5)
+        registry._entries[10].last_access -= 7200
+        await registry._tick()
+        return registry.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["sessions"], stats["evictions"]) == (0, 1)
+
+
+# ==================== BROKER ====================
+
+
+async def next_event(events):
+    return await asyncio.wait_for(events.__anext__(), timeout=2)
+
+
+def test_stream_sends_the_session_then_its_changes(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        broker = QRSessionBroker(registry)
+        await registry.start(10, "t1", 5)
+        events = broker.events(10)
+        received = [await next_event(events)]
+
+        registry._entries[10].session["code_generated_at"] = (datetime.utcnow() - timedelta(seconds=6)).isoformat()
+        await registry._tick()
+        received.append(await next_event(events))
+        registry.record_scan(10, 3)
+        received.append(await next_event(events))
+        await registry.stop(10)
+        received.append(await next_event(events))
+        await events.aclose()
+        return received, broker.stats()
+
+    received, stats = asyncio.run(scenario())
+    assert [event for event, _ in received] == ["session", "code", "scan", "end"]
+    assert received[1][1]["current_code"] == supabase.rows("qr_sessions")[0]["current_code"]
+    assert received[2][1] == {"scanned_count": 1}
+    assert (stats["watchers"], stats["producers"]) == (0, 0)
+
+
+def test_watchers_of_a_class_share_one_producer(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        broker = QRSessionBroker(registry)
+        await registry.start(10, "t1", 5)
+        streams = [broker.events(10) for _ in range(3)]
+        for events in streams:
+            assert (await next_event(events))[0] == "session"
+        during = broker.stats()
+        registry.record_scan(10, 1)
+        scans = [await next_event(events) for events in streams]
+        for events in streams:
+            await events.aclose()
+        return during, scans, broker.stats()
+
+    during, scans, after = asyncio.run(scenario())
+    assert (during["watchers"], during["producers"]) == (3, 1)
+    assert scans == [("scan", {"scanned_count": 1})] * 3
+    assert (after["watchers"], after["producers"]) == (0, 0)
+
+
+def test_slow_watcher_keeps_only_the_latest_events(supabase, monkeypatch):
+    monkeypatch.setattr(qr_sessions, "QR_STREAM_QUEUE_SIZE", 2)
+
+    async def scenario():
+        registry = QRSessionRegistry()
+        broker = QRSessionBroker(registry)
+        await registry.start(10, "t1", 5)
+        queue = broker.subscribe(10)
+        await asyncio.sleep(0)  # let the producer take its first snapshot
+        for record_id in range(1, 5):
+            registry.record_scan(10, record_id)
+            await asyncio.sleep(0.01)
+        received = [queue.get_nowait() for _ in range(queue.qsize())]
+        broker.unsubscribe(10, queue)
+        return received, broker.stats()
+
+    received, stats = asyncio.run(scenario())
+    assert received == [("scan", {"scanned_count": 3}), ("scan", {"scanned_count": 4})]
+    assert stats["dropped"] == 2
+
+
+def test_stream_of_a_class_without_a_session_ends_at_once(supabase):
+    async def scenario():
+        broker = QRSessionBroker(QRSessionRegistry())
+        return [event async for event in broker.events(10)]
+
+    assert asyncio.run(scenario()) == [("end", {"active": False})]
+
+
+def test_close_stops_every_producer(supabase):
+    async def scenario():
+        registry = QRSessionRegistry()
+        broker = QRSessionBroker(registry)
+        await registry.start(10, "t1", 5)
+        await registry.start(11, "t1", 5)
+        broker.subscribe(10)
+        broker.subscribe(11)
+        producers = list(broker._producers.values())
+        await broker.close()
+        return producers, broker.stats()
+
+    producers, stats = asyncio.run(scenario())
+    assert all(p.done() for p in producers)
+    assert stats["producers"] == 0
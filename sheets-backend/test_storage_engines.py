@@ -0,0 +1,312 @@
+"""Behavioural tests shared by the JSON file store and the SQLite engine"""
+import itertools
+from datetime import datetime, timedelta
+import os
+import re
+
+import pytest
+
+from db_manager import DatabaseManager, create_database_manager
+from sqlite_db_manager import SQLiteDatabaseManager
+from storage_engine import StorageEngine
+
+ENGINES = ["json", "sqlite"]
+TIMESTAMP = re.compile(r"^\d{4}-\d\d-\d\dT")
+
+
+def open_engine(engine, base_dir):
+    manager = create_database_manager(engine, str(base_dir))
+    # Deterministic record ids, so both engines produce comparable documents
+    record_ids = itertools.count(1000)
+    manager._generate_student_record_id = lambda: next(record_ids)
+    return manager
+
+
+@pytest.fixture(params=ENGINES)
+def db(request, tmp_path):
+    return open_engine(request.param, tmp_path / "data")
+
+
+def normalize(value):
+    """Drop timestamps and other per-run values before comparing engines"""
+    if isinstance(value, dict):
+        return {
+            k: normalize(v) for k, v in sorted(value.items())
+            if not (isinstance(v, str) and TIMESTAMP.match(v))
+            and k not in ("last_calculated", "current_code", "teacher_name")
+        }
+    if isinstance(value, list):
+        return [normalize(v) for v in value]
+    return value
+
+
+def run_scenario(db):
+    """create/enroll/scan/stop/update/unenroll/stats/contact, returning every observable result"""
+    results = []
+    record = lambda value: results.append(normalize(value))
+
+    record(db.create_user("u1", "old@example.com", "A", "hash"))
+    # Creating an existing id overwrites it
+    record(db.create_user("u1", "a@example.com", "A", "hash"))
+    record(db.create_user("u2", "b@example.com", "B", "hash"))
+    for i in range(4):
+        record(db.create_student(f"s{i}", f"s{i}@example.com", f"S{i}", "hash"))
+
+    record(db.create_class("u1", {
+        "id": 10, "name": "Math", "customColumns": [], "thresholds": None,
+        "students": [{"id": 1, "name": "Manual", "rollNo": "0", "attendance": {"2024-01-01": "P"}}],
+    }))
+    record(db.create_class("u2", {"id": 20, "name": "Art", "students": [], "customColumns": []}))
+    for i in range(3):
+        record(db.enroll_student(f"s{i}", "10", {"name": f"S{i}", "rollNo": str(i), "email": f"s{i}@example.com"}))
+    record(db.enroll_student("s3", "20", {"name": "S3", "rollNo": "3", "email": "s3@example.com"}))
+    with pytest.raises(ValueError):
+        db.enroll_student("s0", "10", {"name": "again", "rollNo": "x", "email": "s0@example.com"})
+
+    session = db.start_qr_session("10", "u1")
+    record(session)
+    record(db.scan_qr_code("s0", "10", session["current_code"]))
+    with pytest.raises(ValueError):
+        db.scan_qr_code("s1", "10", "WRONG")
+    with pytest.raises(ValueError):
+        db.scan_qr_code("s3", "10", session["current_code"])
+    record(db.get_qr_session("10"))
+    record(db.stop_qr_session("10", "u1"))
+
+    class_data = db.get_class("u1", "10")
+    class_data["name"] = "Math II"
+    class_data["students"][0]["attendance"]["2024-02-02"] = "L"
+    record(db.update_class("u1", "10", class_data))
+    record(db.get_class("u1", "10"))
+    record(db.get_class_by_id("10"))
+    record(db.get_all_classes("u1"))
+
+    record(db.unenroll_student("s1", "10"))
+    record(db.unenroll_student("s1", "10"))
+    record(db.get_class_enrollments("10"))
+    record(db.get_student_class_details("s0", "10"))
+    record(db.get_user("u1"))
+
+    record(db.save_contact_message("c@example.com", {"subject": "hi"}))
+    record(db.save_contact_message("d@example.com", {"subject": "yo"}))
+    record(db.get_contact_messages())
+    record(db.get_contact_messages("d@example.com"))
+
+    record({k: v for k, v in db.get_database_stats().items() if k != "timestamp"})
+    record(db.delete_class("u2", "20"))
+    record(db.delete_user("u1"))
+    record({k: v for k, v in db.get_database_stats().items() if k != "timestamp"})
+    return results
+
+
+def test_class_lifecycle(db):
+    db.create_user("u1", "a@example.com", "A", "hash")
+    db.create_student("s0", "s0@example.com", "S0", "hash")
+    db.create_student("s1", "s1@example.com", "S1", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+    db.enroll_student("s0", "10", {"name": "S0", "rollNo": "1", "email": "s0@example.com"})
+    db.enroll_student("s1", "10", {"name": "S1", "rollNo": "2", "email": "s1@example.com"})
+    assert db.get_user("u1")["overview"]["total_students"] == 2
+
+    session = db.start_qr_session("10", "u1")
+    result = db.scan_qr_code("s0", "10", session["current_code"])
+    stopped = db.stop_qr_session("10", "u1")
+    assert stopped["scanned_count"] == 1
+    assert stopped["absent_count"] == 1
+
+    students = {s["name"]: s for s in db.get_class("u1", "10")["students"]}
+    assert students["S0"]["attendance"] == {result["date"]: "P"}
+    assert students["S1"]["attendance"] == {result["date"]: "A"}
+
+    assert db.unenroll_student("s1", "10")
+    assert [e["student_id"] for e in db.get_class_enrollments("10")] == ["s0"]
+    assert db.get_user("u1")["overview"]["total_students"] == 1
+    assert db.get_student_enrollments("s1") == []
+
+    stats = db.get_database_stats()
+    assert (stats["total_users"], stats["total_students"], stats["total_classes"]) == (1, 2, 1)
+
+    assert db.save_contact_message("c@example.com", {"subject": "hi"})
+    assert [m["subject"] for m in db.get_contact_messages("c@example.com")] == ["hi"]
+
+
+def test_maintenance_entry_points(db, tmp_path):
+    db.create_user("u1", "a@example.com", "A", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+
+    assert db.resolve_class_teacher("10") == "u1"
+    assert db.rebuild_email_indexes()["users"] == 1
+    assert db.rebuild_class_routes() == 1
+    assert set(db.get_lock_stats()) >= {"acquired", "contended", "avg_wait_ms"}
+    db.invalidate_user_overview("u1")
+    assert db.get_user("u1")["overview"]["total_classes"] == 1
+
+    backup_dir = str(tmp_path / "backups")
+    db.backup_user_data("u1", backup_dir)
+    db.backup_user_data("u1", backup_dir)
+    assert len(db.list_backups("u1", backup_dir)) == 2
+    assert db.prune_backups(keep=1, backup_dir=backup_dir)["snapshots"] == 1
+    assert len(db.list_backups("u1", backup_dir)) == 1
+
+
+def test_prune_keeps_objects_of_copied_snapshots(db, tmp_path, monkeypatch):
+    db.create_user("u1", "a@example.com", "A", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+
+    def no_hardlinks(src, dst):
+        raise OSError("hard links not supported")
+
+    # Snapshot files become copies, so every object keeps a link count of 1
+    monkeypatch.setattr(os, "link", no_hardlinks)
+    backup_dir = str(tmp_path / "backups")
+    db.backup_user_data("u1", backup_dir)
+    assert db.prune_backups(keep=1, backup_dir=backup_dir) == {"snapshots": 0, "objects": 0}
+
+    db.delete_class("u1", "10")
+    db.restore_user_backup("u1", backup_dir=backup_dir)
+    assert db.get_class("u1", "10")["name"] == "Math"
+
+    db.backup_user_data("u1", backup_dir)
+    db.update_class("u1", "10", {"id": 10, "name": "Algebra", "students": [], "customColumns": []})
+    db.backup_user_data("u1", backup_dir)
+    # Only what the dropped snapshots alone referenced goes
+    assert db.prune_backups(keep=1, backup_dir=backup_dir)["snapshots"] == 2
+    db.restore_user_backup("u1", backup_dir=backup_dir)
+    assert db.get_class("u1", "10")["name"] == "Algebra"
+
+
+def test_excellent_students_are_never_also_at_risk(db):
+    # With "excellent" set below "moderate", 6 of 7 (85.7%) is excellent, not also at risk
+    class_data = {
+        "thresholds": {"excellent": 80.0, "good": 85.0, "moderate": 90.0},
+        "students": [
+            {"id": 1, "attendance": {f"2026-03-0{d}": "P" if d < 7 else "A" for d in range(1, 8)}},
+            {"id": 2, "attendance": {"2026-03-01": "A"}},
+        ],
+    }
+    stats = db.calculate_class_statistics(class_data)
+    assert (stats["excellent_count"], stats["at_risk_count"]) == (1, 1)
+
+
+def test_engines_share_only_the_engine_api(db):
+    assert isinstance(db, StorageEngine)
+    # The file layout (paths, read cache, journals, codecs) belongs to the JSON engine alone
+    assert isinstance(db, DatabaseManager) != hasattr(db, "_conn")
+    assert hasattr(db, "get_class_file") == isinstance(db, DatabaseManager)
+
+
+def test_engines_agree(tmp_path):
+    json_results, sqlite_results = (run_scenario(open_engine(engine, tmp_path / engine)) for engine in ENGINES)
+    assert len(json_results) == len(sqlite_results)
+    for step, (expected, actual) in enumerate(zip(json_results, sqlite_results)):
+        assert actual == expected, f"engines differ at step {step}"
+
+
+def test_backup_and_restore(db, tmp_path):
+    backup_dir = str(tmp_path / "backups")
+    db.create_user("u1", "a@example.com", "A", "hash")
+    db.create_student("s0", "s0@example.com", "S0", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+    db.enroll_student("s0", "10", {"name": "S0", "rollNo": "1", "email": "s0@example.com"})
+    snapshot = db.backup_user_data("u1", backup_dir)
+    db.backup_user_data("u1", backup_dir)
+    objects = [f for _, _, files in os.walk(os.path.join(backup_dir, "objects")) for f in files]
+    assert len(objects) == 2  # user.json and one class, stored once for both snapshots
+
+    db.create_class("u1", {"id": 11, "name": "Art", "students": [], "customColumns": []})
+    class_data = db.get_class("u1", "10")
+    class_data["name"] = "Changed"
+    db.update_class("u1", "10", class_data)
+
+    db.restore_user_backup("u1", snapshot)
+    assert [c["name"] for c in db.get_all_classes("u1")] == ["Math"]
+    assert db.get_class_by_id("11") is None
+    assert db.get_class_by_id("10")["teacher_id"] == "u1"
+    assert db.get_user("u1")["overview"]["total_classes"] == 1
+    stats = db.get_database_stats()
+    assert (stats["total_classes"], stats["total_class_students"]) == (1, 1)
+
+
+def age_qr_code(db, class_id, seconds=60):
+    """Make the session's code old enough to rotate; returns the session as stored"""
+    generated_at = (datetime.now() - timedelta(seconds=seconds)).isoformat()
+    if isinstance(db, SQLiteDatabaseManager):
+        with db._transaction() as conn:
+            conn.execute(
+                "UPDATE qr_sessions SET data = json_set(data, '$.code_generated_at', ?) WHERE class_id = ?",
+                (generated_at, class_id),
+            )
+        return db._load_session(class_id)
+    session_file = db.get_qr_session_file(class_id)
+    session = db.read_json(session_file)
+    session["code_generated_at"] = generated_at
+    db.write_json(session_file, session)
+    return session
+
+
+def serve_stale_session_once(db, stale):
+    """get_qr_session's first (unlocked) read returns stale; later reads see the store"""
+    name = "_load_session" if isinstance(db, SQLiteDatabaseManager) else "read_json"
+    real = getattr(db, name)
+    reads = iter([stale])
+    setattr(db, name, lambda *args: next(reads, None) or real(*args))
+    return lambda: setattr(db, name, real)
+
+
+def test_qr_rotation_keeps_changes_made_after_the_unlocked_read(db):
+    db.create_user("u1", "a@example.com", "A", "hash")
+    db.create_student("s0", "s0@example.com", "S0", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+    record = db.enroll_student("s0", "10", {"name": "S0", "rollNo": "1", "email": "s0@example.com"})
+    db.start_qr_session("10", "u1")
+
+    # A scan lands between the unlocked read and the rotation
+    stale = age_qr_code(db, "10")
+    db.scan_qr_code("s0", "10", stale["current_code"])
+    restore = serve_stale_session_once(db, stale)
+    session = db.get_qr_session("10")
+    restore()
+    assert session["current_code"] != stale["current_code"]
+    assert session["scanned_students"] == [record["student_record_id"]]
+    assert db.get_qr_session("10")["current_code"] == session["current_code"]
+
+    # ... or a stop does
+    stale = age_qr_code(db, "10")
+    db.stop_qr_session("10", "u1")
+    restore = serve_stale_session_once(db, stale)
+    assert db.get_qr_session("10") is None
+    restore()
+    assert db.get_qr_session("10") is None
+
+
+def test_qr_scans_are_journaled_until_stop(tmp_path):
+    db = open_engine("json", tmp_path)
+    db.create_user("u1", "a@example.com", "A", "hash")
+    db.create_class("u1", {"id": 10, "name": "Math", "students": [], "customColumns": []})
+    records = []
+    for i in range(3):
+        db.create_student(f"s{i}", f"s{i}@example.com", f"S{i}", "hash")
+        records.append(db.enroll_student(f"s{i}", "10", {"name": f"S{i}", "rollNo": str(i), "email": None}))
+    code = db.start_qr_session("10", "u1")["current_code"]
+
+    session_file = db.get_qr_session_file("10")
+    writes = []
+    real_write = db.write_json
+    db.write_json = lambda path, data: (writes.append(path), real_write(path, data))
+    db.scan_qr_code("s0", "10", code)
+    db.scan_qr_code("s1", "10", code)
+    db.scan_qr_code("s1", "10", code)
+    assert session_file not in writes
+
+    # Scans are visible to readers, including another process's manager
+    reopened = open_engine("json", tmp_path)
+    ids = [r["student_record_id"] for r in records]
+    assert reopened.get_qr_session("10")["scanned_students"] == ids[:2]
+
+    stopped = db.stop_qr_session("10", "u1")
+    assert (stopped["scanned_count"], stopped["absent_count"]) == (2, 1)
+    assert db.read_json(session_file)["scanned_students"] == ids[:2]
+    assert not os.path.exists(db.get_qr_scan_journal_file("10"))
+
+    db.start_qr_session("10", "u1")
+    assert db.get_qr_session("10")["scanned_students"] == []
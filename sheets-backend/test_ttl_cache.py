@@ -0,0 +1,111 @@
+"""TTLCache and the identity lookups cached with it"""
+import asyncio
+import types
+
+import pytest
+
+import main
+import ttl_cache
+from ttl_cache import MISSING, TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    # Only the cache's clock - the event loop keeps the real one
+    monkeypatch.setattr(ttl_cache, "time", types.SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def test_hits_misses_and_expiry(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    assert cache.get("a") is MISSING
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    clock.now += 61
+    assert cache.get("a") is MISSING
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"], stats["size"]) == (1, 2, 1, 0)
+
+
+def test_none_is_a_cached_value_with_its_own_ttl(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("gone", None, ttl=5)
+    assert cache.get("gone") is None
+    assert cache.stats()["negative_hits"] == 1
+    clock.now += 6
+    assert cache.get("gone") is MISSING
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate_and_clear(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    assert cache.get("a") is MISSING
+    cache.clear()
+    assert cache.get("b") is MISSING
+
+
+# ==================== IDENTITY LOOKUPS ====================
+
+
+@pytest.fixture
+def identities(supabase):
+    main.identity_cache.clear()
+    yield supabase
+    main.identity_cache.clear()
+
+
+def test_identity_lookups_are_cached(identities):
+    identities.rows("teachers").append(
+        {"id": "t1", "email": "t@example.com", "name": "T", "password": "x"}
+    )
+    first = asyncio.run(main.get_teacher_by_email("t@example.com"))
+    first["name"] = "changed by the caller"
+    assert asyncio.run(main.get_teacher_by_email("t@example.com"))["name"] == "T"
+    assert identities.count("teachers", "select") == 1
+
+    assert asyncio.run(main.get_teacher_by_email("t@example.com", fresh=True))["id"] == "t1"
+    assert identities.count("teachers", "select") == 2
+
+
+def test_unknown_emails_are_cached_briefly(identities, clock):
+    assert asyncio.run(main.get_student_by_email("nobody@example.com")) is None
+    assert asyncio.run(main.get_student_by_email("nobody@example.com")) is None
+    assert identities.count("students", "select") == 1
+
+    identities.rows("students").append(
+        {"id": "s1", "email": "nobody@example.com", "name": "S", "password": "x"}
+    )
+    clock.now += main.IDENTITY_NEGATIVE_TTL + 1
+    assert asyncio.run(main.get_student_by_email("nobody@example.com"))["id"] == "s1"
+
+
+def test_invalidate_identity_drops_both_roles(identities):
+    identities.rows("teachers").append(
+        {"id": "t1", "email": "t@example.com", "name": "T", "password": "x"}
+    )
+    asyncio.run(main.get_teacher_by_email("t@example.com"))
+    identities.rows("teachers")[0]["name"] = "Renamed"
+    main.invalidate_identity("t@example.com")
+    assert asyncio.run(main.get_teacher_by_email("t@example.com"))["name"] == "Renamed"
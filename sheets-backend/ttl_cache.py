@@ -0,0 +1,78 @@
+"""Small thread-safe TTL + LRU cache for hot lookups in main.py"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# Returned by get() on a miss, so None can be cached as a real value
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded mapping whose entries expire after ttl seconds, least recently used evicted first"""
+
+    def __init__(self, maxsize: int, ttl: float, name: str = "cache"):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Cached value for key, or MISSING"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._misses += 1
+                return MISSING
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self._expirations += 1
+                self._misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self._hits += 1
+            if value is None:
+                self._negative_hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store value for ttl seconds (the cache default when None)"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self._hits,
+                "negative_hits": self._negative_hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
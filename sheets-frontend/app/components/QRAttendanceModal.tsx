@@ -1,6 +1,6 @@
 'use client';
 
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef, useCallback } from 'react';
 import { X, QrCode, Users, Clock, Zap, CheckCircle } from 'lucide-react';
 
 // @ts-ignore - Fix for qrcode types
@@ -20,12 +20,32 @@ export const QRAttendanceModal: React.FC<QRAttendanceModalProps> = ({
     onClose,
 }) => {
     const [qrCodeUrl, setQrCodeUrl] = useState<string>('');
-    const [currentCode, setCurrentCode] = useState<string>('');
     const [scannedCount, setScannedCount] = useState<number>(0);
     const [rotationInterval, setRotationInterval] = useState<number>(5);
     const [isActive, setIsActive] = useState<boolean>(false);
     const [isStopping, setIsStopping] = useState<boolean>(false);
     const [timeLeft, setTimeLeft] = useState(rotationInterval);
+    const currentCodeRef = useRef<string>('');
+
+    // Show a (new) session code as a QR image
+    const showCode = useCallback(async (code: string) => {
+        if (!code || code === currentCodeRef.current) return;
+        currentCodeRef.current = code;
+        setTimeLeft(rotationInterval);
+
+        const qrData = JSON.stringify({
+            class_id: String(classId),
+            code,
+        });
+
+        const url = await QRCode.toDataURL(qrData, {
+            width: 300,
+            margin: 2,
+            color: { dark: '#059669', light: '#ffffff' },
+        });
+
+        setQrCodeUrl(url);
+    }, [classId, rotationInterval]);
 
     // Start QR session
     const startSession = async () => {
@@ -60,39 +80,27 @@ export const QRAttendanceModal: React.FC<QRAttendanceModalProps> = ({
 
             // 1) mark session active so UI switches to QR view
             setIsActive(true);
-            setCurrentCode(data.session.current_code);
             setScannedCount(data.session.scanned_students?.length ?? 0);
-            setTimeLeft(rotationInterval);
 
             // 2) generate QR image
-            const qrData = JSON.stringify({
-                class_id: String(classId),
-                code: data.session.current_code,
-            });
-
-            const url = await QRCode.toDataURL(qrData, {
-                width: 300,
-                margin: 2,
-                color: { dark: '#059669', light: '#ffffff' },
-            });
-
-
-            setQrCodeUrl(url);
+            await showCode(data.session.current_code);
         } catch (err: any) {
             console.error('Start session error:', err);
             alert(err.message || 'Error starting QR session');
         }
     };
 
-    // Poll for session updates
+    // Follow session updates: server-sent events, polling as the fallback
     useEffect(() => {
         if (!isActive) return;
 
-        const interval = setInterval(async () => {
-            try {
-                const token = localStorage.getItem('access_token');
-                if (!token) return;
+        const token = localStorage.getItem('access_token');
+        if (!token) return;
+
+        let pollTimer: ReturnType<typeof setInterval> | null = null;
 
+        const poll = async () => {
+            try {
                 const res = await fetch(
                     `${process.env.NEXT_PUBLIC_API_URL}/qr/session/${classId}`,
                     {
@@ -106,33 +114,91 @@ export const QRAttendanceModal: React.FC<QRAttendanceModalProps> = ({
                 const data = await res.json();
                 if (!data.active || !data.session) return;
 
-                setScannedCount(data.session.scanned_students.length);
+                setScannedCount(data.session.scanned_students?.length ?? 0);
+                await showCode(data.session.current_code);
+            } catch (e) {
+                console.error('Poll error', e);
+            }
+        };
+
+        const startPolling = () => {
+            if (pollTimer) return;
+            pollTimer = setInterval(poll, 1000);
+        };
+
+        if (typeof EventSource === 'undefined') {
+            startPolling();
+            return () => {
+                if (pollTimer) clearInterval(pollTimer);
+            };
+        }
 
-                if (data.session.current_code !== currentCode) {
-                    // new code from backend
-                    setCurrentCode(data.session.current_code);
-                    setTimeLeft(rotationInterval);
+        let source: EventSource | null = null;
+        let cancelled = false;
+        let reopened = false;
 
-                    const qrData = JSON.stringify({
-                        class_id: String(classId),
-                        code: data.session.current_code,
-                    });
+        // The stream URL carries a short-lived ticket, never the access token
+        const openStream = async () => {
+            let ticket: string;
+            try {
+                const res = await fetch(
+                    `${process.env.NEXT_PUBLIC_API_URL}/qr/session/${classId}/stream-ticket`,
+                    {
+                        method: 'POST',
+                        headers: {
+                            Authorization: `Bearer ${token}`,
+                        },
+                    }
+                );
+                if (!res.ok) throw new Error(`HTTP ${res.status}`);
+                ticket = (await res.json()).ticket;
+            } catch (e) {
+                console.error('Stream ticket error', e);
+                if (!cancelled) startPolling();
+                return;
+            }
+            if (cancelled) return;
 
-                    const url = await QRCode.toDataURL(qrData, {
-                        width: 300,
-                        margin: 2,
-                        color: { dark: '#059669', light: '#ffffff' },
-                    });
+            const stream = new EventSource(
+                `${process.env.NEXT_PUBLIC_API_URL}/qr/session/${classId}/stream?ticket=${encodeURIComponent(ticket)}`
+            );
+            source = stream;
 
-                    setQrCodeUrl(url);
+            stream.addEventListener('session', (e) => {
+                reopened = false;
+                const session = JSON.parse((e as MessageEvent).data);
+                setScannedCount(session.scanned_count ?? 0);
+                showCode(session.current_code);
+            });
+            stream.addEventListener('code', (e) => {
+                showCode(JSON.parse((e as MessageEvent).data).current_code);
+            });
+            stream.addEventListener('scan', (e) => {
+                setScannedCount(JSON.parse((e as MessageEvent).data).scanned_count);
+            });
+            stream.addEventListener('end', () => stream.close());
+            stream.onerror = () => {
+                // EventSource reconnects by itself with the same URL, and gives up
+                // (CLOSED) once that fails - typically because the ticket expired.
+                // Retry once with a fresh ticket, then fall back to polling
+                if (stream.readyState !== EventSource.CLOSED || cancelled) return;
+                if (reopened) {
+                    startPolling();
+                } else {
+                    reopened = true;
+                    openStream();
                 }
-            } catch (e) {
-                console.error('Poll error', e);
-            }
-        }, 1000);
+            };
+        };
+
+        openStream();
 
-        return () => clearInterval(interval);
-    }, [isActive, classId, currentCode, rotationInterval]);
+        return () => {
+            cancelled = true;
+            source?.close();
+            if (pollTimer) clearInterval(pollTimer);
+        };
+    }, [isActive, classId, showCode]);
 
 
     // Countdown timer
@@ -1,9 +1,9 @@
 'use client';
 
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useRouter } from 'next/navigation';
 import { useAuth } from '../lib/auth-context-email';
-import { classService, Class } from '../lib/classService';
+import { classService, Class, ClassPage, ClassSummary } from '../lib/classService';
 import { Menu, User, Users, LayoutDashboard } from 'lucide-react';
 import Sidebar from '../components/dashboard/Sidebar';
 import EmptyState from '../components/dashboard/EmptyState';
@@ -21,6 +21,9 @@ import MonthYearSelector from '../components/dashboard/MonthYearSelector';
 import { AttendanceThresholds, Student, CustomColumn } from '../types';
 import QRAttendanceModal from '../components/QRAttendanceModal';
 
+// Classes per GET /classes request while the sidebar list loads
+const CLASS_PAGE_SIZE = 50;
+
 export default function DashboardPage() {
   const router = useRouter();
   const { user, logout, isAuthenticated, loading } = useAuth();
@@ -37,6 +40,10 @@ export default function DashboardPage() {
   const [syncing, setSyncing] = useState(false);
   const [syncError, setSyncError] = useState<string | null>(null);
   const [showQRModal, setShowQRModal] = useState(false);
+  const [loadingClassId, setLoadingClassId] = useState<number | null>(null);
+  // Classes whose roster and columns came from the server or were created here.
+  // The rest are id/name summaries and must never be sent to PUT /classes/{id}
+  const loadedClassIds = useRef<Set<number>>(new Set());
   
   const [defaultThresholds, setDefaultThresholds] = useState<AttendanceThresholds>({
     excellent: 95,
@@ -88,6 +95,29 @@ export default function DashboardPage() {
     }
   }, [user, isAuthenticated]);
 
+  // Load the open class with only the displayed month's attendance
+  useEffect(() => {
+    if (!user || !isAuthenticated || activeClassId === null) return;
+    let cancelled = false;
+    const classId = activeClassId;
+    if (!loadedClassIds.current.has(classId)) setLoadingClassId(classId);
+
+    fetchClass(classId)
+      .then((loaded) => {
+        if (cancelled || !loaded) return;
+        setClasses((prev) => prev.map((cls: SafeClass) =>
+          cls.id === classId ? mergeLoadedClass(cls, loaded) : cls
+        ) as SafeClass[]);
+      })
+      .finally(() => {
+        if (!cancelled) setLoadingClassId((current) => (current === classId ? null : current));
+      });
+
+    return () => {
+      cancelled = true;
+    };
+  }, [activeClassId, currentMonth, currentYear, user, isAuthenticated]);
+
   // Load thresholds from localStorage
   useEffect(() => {
     if (user) {
@@ -105,19 +135,77 @@ export default function DashboardPage() {
     }
   }, [defaultThresholds, user]);
 
+  // GET /classes/{id} for the displayed month; null if it is not on the server (yet)
+  const fetchClass = async (classId: number): Promise<any | null> => {
+    const month = `${currentYear}-${String(currentMonth + 1).padStart(2, '0')}`;
+    try {
+      const loaded = await classService.getClass(String(classId), { month });
+      loadedClassIds.current.add(classId);
+      return loaded;
+    } catch (error) {
+      // A class created a moment ago may not be on the server yet - keep the local copy
+      console.error('Error loading class:', error);
+      return null;
+    }
+  };
+
+  const mergeLoadedClass = (cls: SafeClass, loaded: any): SafeClass => {
+    const known = new Map((cls.students || []).map((s) => [s.id, s]));
+    return {
+      ...cls,
+      name: loaded.name ?? cls.name,
+      customColumns: loaded.customColumns ?? loaded.custom_columns ?? cls.customColumns,
+      // The backend stores {} for "use the defaults"
+      thresholds: loaded.thresholds && Object.keys(loaded.thresholds).length > 0
+        ? loaded.thresholds
+        : cls.thresholds,
+      students: (loaded.students ?? []).map((s: Student) => ({
+        ...known.get(s.id),
+        ...s,
+        // Months fetched earlier stay; this month's marks come from the server
+        attendance: { ...known.get(s.id)?.attendance, ...s.attendance },
+      })),
+    };
+  };
+
+  // Only full classes go to localStorage; a summary keeps its last full copy there
+  const storeClassesLocally = (classesToStore: SafeClass[]) => {
+    if (!user) return;
+    const key = `classes-${user.id}`;
+    const stored = JSON.parse(localStorage.getItem(key) || '[]') as SafeClass[];
+    const storedById = new Map(stored.map((c) => [c.id, c]));
+    const toStore = classesToStore
+      .map((c) => (loadedClassIds.current.has(c.id) ? c : storedById.get(c.id)))
+      .filter((c): c is SafeClass => c !== undefined);
+    localStorage.setItem(key, JSON.stringify(toStore));
+  };
+
   // ✅ FIX 2: Normalize loaded classes - students always array
   const loadClassesFromBackend = async () => {
     if (!user) return;
     try {
       setSyncing(true);
       setSyncError(null);
-      const backendClasses = await classService.loadClasses();
+      // Only id/name for the list - a class's students load when it is opened
+      const backendClasses: ClassSummary[] = [];
+      let cursor: string | null = null;
+      do {
+        const page: ClassPage<ClassSummary> = await classService.getClassPage<ClassSummary>({
+          summary: true,
+          limit: CLASS_PAGE_SIZE,
+          cursor,
+        });
+        backendClasses.push(...page.classes);
+        cursor = page.nextCursor;
+      } while (cursor);
       
-      if (backendClasses && backendClasses.length > 0) {
+      if (backendClasses.length > 0) {
         // Normal case - classes exist on server
-        const normalizedClasses: SafeClass[] = backendClasses.map((c: any) => ({
-          ...c,
-          students: c.students ?? [],  // ✅ FIX: guarantee array
+        const normalizedClasses: SafeClass[] = backendClasses.map((c) => ({
+          id: c.id,
+          name: c.name,
+          students: [],  // ✅ FIX: guarantee array
+          customColumns: [],
         }));
         setClasses(normalizedClasses);
         setShowSnapshot(true);
@@ -141,6 +229,8 @@ export default function DashboardPage() {
           ...c,
           students: c.students ?? [],  // ✅ FIX: guarantee array
         }));
+        // storeClassesLocally only keeps full classes, so these can be saved
+        normalizedClasses.forEach((c) => loadedClassIds.current.add(c.id));
         setClasses(normalizedClasses);
       }
     } finally {
@@ -165,11 +255,16 @@ export default function DashboardPage() {
     ) as SafeClass[];
     setClasses(updatedClasses);
 
-    // Save to localStorage immediately
-    if (user) {
-      localStorage.setItem(`classes-${user.id}`, JSON.stringify(updatedClasses));
+    // A summary has no roster: PUT would unenroll every student and clear the columns
+    if (!loadedClassIds.current.has(updatedClass.id)) {
+      console.error(`Class ${updatedClass.id} is not loaded; not saving it`);
+      setSyncError('Class not loaded yet - changes were not saved');
+      return;
     }
 
+    // Save to localStorage immediately
+    storeClassesLocally(updatedClasses);
+
     // Sync to backend asynchronously (don't block UI)
     try {
       await classService.updateClass(String(updatedClass.id), updatedClass);
@@ -193,7 +288,7 @@ export default function DashboardPage() {
     setShowChangePasswordModal(true);
   };
 
-  const handleSaveThresholds = (newThresholds: AttendanceThresholds, applyToClassIds: number[]) => {
+  const handleSaveThresholds = async (newThresholds: AttendanceThresholds, applyToClassIds: number[]) => {
     const updatedClasses = classes.map((cls: SafeClass) =>
       applyToClassIds.includes(cls.id)
         ? { ...cls, thresholds: newThresholds }
@@ -201,16 +296,32 @@ export default function DashboardPage() {
     ) as SafeClass[];
     setClasses(updatedClasses);
 
-    // Sync each updated class
-    updatedClasses.forEach((cls: SafeClass) => {
-      if (applyToClassIds.includes(cls.id)) {
-        saveClass(cls);
-      }
-    });
-
     if (applyToClassIds.includes(-1)) {
       setDefaultThresholds(newThresholds);
     }
+
+    // Sync each updated class, loading the ones never opened so their roster goes along
+    let syncedClasses = updatedClasses;
+    for (const cls of updatedClasses) {
+      if (!applyToClassIds.includes(cls.id)) continue;
+      let fullClass: SafeClass = cls;
+      if (!loadedClassIds.current.has(cls.id)) {
+        const loaded = await fetchClass(cls.id);
+        if (!loaded) {
+          setSyncError('Failed to sync some changes');
+          continue;
+        }
+        fullClass = { ...mergeLoadedClass(cls, loaded), thresholds: newThresholds };
+        syncedClasses = syncedClasses.map((c) => (c.id === cls.id ? fullClass : c));
+        setClasses((prev) => prev.map((c: SafeClass) => (c.id === cls.id ? fullClass : c)) as SafeClass[]);
+      }
+      try {
+        await classService.updateClass(String(cls.id), fullClass);
+      } catch (error) {
+        console.error('Error saving class to backend:', error);
+      }
+    }
+    storeClassesLocally(syncedClasses);
   };
 
   const handleOpenClassSettings = (classId: number) => {
@@ -237,6 +348,7 @@ export default function DashboardPage() {
     };
     
     const updatedClasses = [...classes, newClass] as SafeClass[];
+    loadedClassIds.current.add(newClass.id);
     setClasses(updatedClasses);
     setActiveClassId(newClass.id);
     setShowImportState(false);
@@ -263,6 +375,7 @@ export default function DashboardPage() {
     };
     
     const updatedClasses = [...classes, newClass] as SafeClass[];
+    loadedClassIds.current.add(newClass.id);
     setClasses(updatedClasses);
     setActiveClassId(newClass.id);
     setShowImportState(false);
@@ -299,9 +412,8 @@ export default function DashboardPage() {
     setClasses(updatedClasses);
 
     // Update localStorage immediately
-    if (user) {
-      localStorage.setItem(`classes-${user.id}`, JSON.stringify(updatedClasses));
-    }
+    storeClassesLocally(updatedClasses);
+    loadedClassIds.current.delete(classToDelete.id);
 
     if (activeClassId === classToDelete.id) {
       if (updatedClasses.length === 0) {
@@ -653,6 +765,10 @@ export default function DashboardPage() {
               currentYear={currentYear}
               defaultThresholds={defaultThresholds}
             />
+          ) : activeClass && loadingClassId === activeClass.id ? (
+            <div className="flex items-center justify-center py-24">
+              <div className="w-10 h-10 border-4 border-emerald-600 border-t-transparent rounded-full animate-spin"></div>
+            </div>
           ) : activeClass ? (
             <AttendanceSheet
               activeClass={activeClass as Class}
@@ -263,11 +263,17 @@ export function AuthProvider({ children }: { children: React.ReactNode }) {
 
   const changePassword = async (code: string, newPassword: string) => {
     try {
-      await apiCall('auth/change-password', {
+      const response = await apiCall('auth/change-password', {
         method: 'POST',
         body: JSON.stringify({ code, new_password: newPassword }),
       });
 
+      // Changing the password revokes older tokens, so keep the fresh one
+      if (response.access_token) {
+        localStorage.setItem('accesstoken', response.access_token);
+        setToken(response.access_token);
+      }
+
       return { success: true, message: 'Password changed successfully' };
     } catch (error: any) {
       return { success: false, message: error.message || 'Change failed' };
@@ -37,6 +37,36 @@ export interface Class {
   thresholds?: AttendanceThresholds;
 }
 
+// Fields of a GET /classes row (snake_case, as stored)
+export type ClassListField =
+  | 'id' | 'teacher_id' | 'name' | 'custom_columns' | 'thresholds'
+  | 'statistics' | 'created_at' | 'updated_at';
+
+export interface ClassAttendanceRange {
+  from?: string;
+  to?: string;
+  month?: string;
+}
+
+export interface ClassPageOptions {
+  limit?: number;
+  cursor?: string | null;
+  fields?: ClassListField[];
+  summary?: boolean;
+}
+
+// A GET /classes?summary=true row
+export interface ClassSummary {
+  id: number;
+  name: string;
+  updated_at: string;
+}
+
+export interface ClassPage<T = Record<string, any>> {
+  classes: T[];
+  nextCursor: string | null;
+}
+
 class ClassService {
   private getAuthHeaders(): Record<string, string> {
     const token = typeof window !== 'undefined' ? localStorage.getItem('accesstoken') : null;
@@ -73,9 +103,43 @@ class ClassService {
     }
   }
   
-  async getClass(classId: string): Promise<Class> {
+  // One page of the class list - pass nextCursor back until it is null
+  async getClassPage<T = Record<string, any>>(options: ClassPageOptions = {}): Promise<ClassPage<T>> {
+    try {
+      const params = new URLSearchParams();
+      if (options.limit) params.set('limit', String(options.limit));
+      if (options.cursor) params.set('cursor', options.cursor);
+      if (options.fields?.length) params.set('fields', options.fields.join(','));
+      if (options.summary) params.set('summary', 'true');
+
+      const response = await fetch(`${API_URL}/classes?${params.toString()}`, {
+        headers: this.getAuthHeaders(),
+      });
+
+      if (!response.ok) {
+        const error = await response.json().catch(() => ({}));
+        throw new Error(error.detail || error.message || `API Error: ${response.statusText}`);
+      }
+
+      return {
+        classes: await response.json(),
+        nextCursor: response.headers.get('X-Next-Cursor'),
+      };
+    } catch (error) {
+      console.error('Error fetching class page:', error);
+      throw error;
+    }
+  }
+
+  // from/to (YYYY-MM-DD) or month (YYYY-MM) limit the attendance returned; omit for full history
+  async getClass(classId: string, range: ClassAttendanceRange = {}): Promise<Class> {
     try {
-      const result = await this.apiCall<Class>(`/classes/${classId}`);  // 👈 type
+      const params = new URLSearchParams();
+      if (range.month) params.set('month', range.month);
+      if (range.from) params.set('from', range.from);
+      if (range.to) params.set('to', range.to);
+      const query = params.toString();
+      const result = await this.apiCall<Class>(`/classes/${classId}${query ? `?${query}` : ''}`);  // 👈 type
       return result;                                                    // 👈 no .class
     } catch (error) {
       console.error('Error fetching class:', error);